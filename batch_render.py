@@ -0,0 +1,119 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+import rtstruct_cache
+import utils
+
+"""Moduł renderujący bez interfejsu graficznego obrazy wszystkich slice'ów serii CT z naniesionymi konturami struktur.
+
+Plik RTStruct parsowany jest jednokrotnie w procesie głównym, a sparsowane struktury przekazywane są raz do każdego
+procesu roboczego puli. Procesy robocze rysują slice'y przy pomocy backendu Agg (bez globalnego stanu pyplota)
+i zapisują je na dysk. Slice'y, których obrazy już istnieją, są pomijane - przerwane renderowanie można wznowić.
+
+Przykład użycia:
+    python batch_render.py CT_DIR RTSTRUCT_FILE OUTPUT_DIR --workers 8 --format png
+
+Wymagane zewnętrzne biblioteki
+-----------------------------
+matplotlib
+"""
+
+matplotlib.use("Agg")
+
+# Struktury z pliku RTStruct i parametry renderowania przekazywane jednorazowo do każdego procesu roboczego
+_worker_structures = None
+_worker_options = None
+
+
+def _init_worker(structures, options):
+    """Inicjalizacja procesu roboczego - zapamiętanie sparsowanych struktur i parametrów renderowania."""
+    global _worker_structures, _worker_options
+    _worker_structures = structures
+    _worker_options = options
+
+
+def _render_slice(task):
+    """
+    Renderowanie pojedynczego slice'a z konturami struktur do pliku (wywoływane w procesie roboczym).
+    :param task: krotka (ścieżka pliku DICOM z danymi obrazowymi, ścieżka pliku wyjściowego)
+    :return: ścieżka pliku wyjściowego
+    """
+    ct_path, output_path = task
+    dicom = utils.Slice(ct_path)
+    dicom.load_RTStruct(_worker_structures)
+    canvas = FigureCanvasAgg(Figure(figsize=_worker_options["figsize"]))
+    dicom.set_axes(canvas.figure.subplots())
+    dicom.draw_structures(_worker_options["lw"])
+
+    # Zapis do pliku tymczasowego i podmiana - przerwany zapis nie zostawi niekompletnego obrazu
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    canvas.print_figure(tmp_path, format=_worker_options["format"], dpi=_worker_options["dpi"])
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def render_series(ct_dir, rtstruct_path, output_dir, workers: int = None, image_format: str = "png",
+                  dpi: int = 100, figsize=(8, 8), lw: float = 0.9, overwrite: bool = False):
+    """
+    Funkcja renderująca wszystkie slice'y serii CT z naniesionymi konturami struktur z pliku RTStruct.
+    :param ct_dir: katalog z plikami DICOM serii CT
+    :param rtstruct_path: ścieżka do pliku DICOM z danymi RTStruct
+    :param output_dir: katalog, do którego zapisywane są obrazy
+    :param workers: liczba procesów roboczych (domyślnie liczba rdzeni procesora)
+    :param image_format: format zapisywanych obrazów (png, jpg, ...)
+    :param dpi: rozdzielczość zapisywanych obrazów
+    :param figsize: rozmiar rysunku w calach
+    :param lw: grubość linii konturów
+    :param overwrite: flaga decydująca, czy renderować ponownie slice'y, których obrazy już istnieją
+    :return: liczba wyrenderowanych slice'ów, liczba pominiętych slice'ów, czas renderowania [s]
+    """
+    cache = rtstruct_cache.RTStructCache()
+    structures, _ = cache.load(rtstruct_path)
+    cache.close()
+    volume = utils.Volume(ct_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    tasks = []
+    for index, (ct_path, header) in enumerate(zip(volume.file_paths, volume.headers)):
+        output_path = os.path.join(output_dir, f"{index:04d}_{header.SOPInstanceUID}.{image_format}")
+        if overwrite or not os.path.exists(output_path):
+            tasks.append((ct_path, output_path))
+    skipped = len(volume) - len(tasks)
+    volume.close()  # Z obiektu Volume potrzebna była tylko posortowana lista plików serii
+
+    options = {"format": image_format, "dpi": dpi, "figsize": figsize, "lw": lw}
+    start = time.perf_counter()
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(structures, options)) as pool:
+        for done, _ in enumerate(pool.imap_unordered(_render_slice, tasks), 1):
+            print(f"\rRendered {done}/{len(tasks)} slices", end="", file=sys.stderr)
+    if tasks:
+        print(file=sys.stderr)
+    return len(tasks), skipped, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render every slice of a CT series with RTStruct contour overlays.")
+    parser.add_argument("ct_dir", help="directory with the DICOM files of the CT series")
+    parser.add_argument("rtstruct_path", help="DICOM RTStruct file")
+    parser.add_argument("output_dir", help="directory for the rendered images")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("--format", default="png", choices=["png", "jpg", "jpeg"], help="output image format")
+    parser.add_argument("--dpi", type=int, default=100)
+    parser.add_argument("--overwrite", action="store_true", help="render slices whose images already exist")
+    args = parser.parse_args()
+
+    rendered, skipped, elapsed = render_series(args.ct_dir, args.rtstruct_path, args.output_dir, args.workers,
+                                               args.format, args.dpi, overwrite=args.overwrite)
+    rate = rendered / elapsed if elapsed > 0 else 0.0
+    print(f"Rendered {rendered} slices ({skipped} already rendered) in {elapsed:.1f}s - {rate:.1f} slices/s")
+
+
+if __name__ == "__main__":
+    main()
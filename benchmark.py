@@ -0,0 +1,278 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import matplotlib
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+import synthetic
+import utils
+
+"""Moduł do pomiaru czasu działania najważniejszych operacji modułu utils.
+
+Zestaw benchmarków (polecenie suite) mierzy czas i szczytowe zużycie pamięci wczytywania RTStructa, wczytywania slice'a,
+dopasowywania konturów i rysowania na syntetycznych danych o kilku rozmiarach (moduł synthetic). Wyniki można zapisać
+jako plik bazowy, a kolejne uruchomienia porównać z nim - pomiary gorsze od bazowych o więcej niż zadaną tolerancję
+zgłaszane są jako regresje (kod wyjścia 1). Polecenie decode porównuje czasy dekodowania całej serii CT
+(Volume.decode_all) w puli wątków i w puli procesów dla różnej liczby wątków/procesów.
+
+Przykład użycia:
+    python benchmark.py draw CT_FILE RTSTRUCT_FILE --repeat 5
+    python benchmark.py suite --tiers small --save-baseline benchmark_baseline.json
+    python benchmark.py suite --tiers small --baseline benchmark_baseline.json
+    python benchmark.py decode CT_DIR --workers 1 2 4 8 --backends threads processes
+
+Wymagane zewnętrzne biblioteki
+-----------------------------
+matplotlib
+"""
+
+matplotlib.use("Agg")
+
+# Rozmiary syntetycznych zestawów danych (argumenty synthetic.generate_dataset)
+TIERS = {
+    "small": dict(slices=20, size=128, rois=2, contours=1, points=64),
+    "medium": dict(slices=60, size=256, rois=10, contours=3, points=128),
+    "large": dict(slices=100, size=512, rois=20, contours=4, points=128),
+}
+DEFAULT_DATA_DIR = os.path.join(os.path.expanduser("~"), ".cache", "rtstruct_on_ct", "benchmark")
+DEFAULT_TOLERANCE = 0.25
+# Różnice czasu poniżej tej wartości [s] to szum pomiarowy (operacje trwające ułamki milisekundy) - nie są regresjami
+MIN_TIME_DELTA = 0.001
+
+
+def benchmark_draw_modes(ct_path, rtstruct_path, repeat: int = 5):
+    """
+    Funkcja porównująca czas rysowania slice'a z konturami struktur w kolejnych trybach rysowania.
+    Mierzony jest osobno czas wywołania Slice.draw_structures i czas rasteryzacji płótna (canvas.draw).
+    :param ct_path: ścieżka do pliku DICOM z danymi obrazowymi
+    :param rtstruct_path: ścieżka do pliku DICOM z danymi RTStruct
+    :param repeat: liczba powtórzeń pomiaru dla każdego trybu (raportowany jest najlepszy wynik)
+    :return: słownik {tryb rysowania: (czas draw_structures [s], czas canvas.draw [s])}
+    """
+    structures, _ = utils.read_rtstruct(rtstruct_path)
+    dicom = utils.Slice(ct_path)
+    dicom.load_RTStruct(structures)
+    dicom.pixel_array  # Dekodowanie danych obrazowych nie powinno wliczać się do pomiaru
+
+    results = {}
+    for mode in (utils.RENDER_LINES, utils.RENDER_COLLECTION, utils.RENDER_FILLED):
+        dicom.render_mode = mode
+        best_draw = best_raster = float("inf")
+        for _ in range(repeat):
+            canvas = FigureCanvasAgg(Figure(figsize=(10, 10)))
+            dicom.set_axes(canvas.figure.subplots())
+            start = time.perf_counter()
+            dicom.draw_structures()
+            drawn = time.perf_counter()
+            canvas.draw()
+            rasterized = time.perf_counter()
+            best_draw = min(best_draw, drawn - start)
+            best_raster = min(best_raster, rasterized - drawn)
+        results[mode] = best_draw, best_raster
+    return results
+
+
+def benchmark_decode(ct_dir, workers=(1, 2, 4), backends=(utils.DECODE_THREADS, utils.DECODE_PROCESSES),
+                     decoding_plugin: str = ""):
+    """
+    Funkcja porównująca czas dekodowania danych obrazowych całej serii CT dla różnych sposobów zrównoleglenia.
+    Każdy pomiar wykonywany jest na nowym obiekcie Volume, a wynik porównywany jest z dekodowaniem sekwencyjnym.
+    :param ct_dir: katalog zawierający pliki DICOM serii CT
+    :param workers: liczby wątków/procesów dekodujących
+    :param backends: sposoby zrównoleglenia (utils.DECODE_THREADS, utils.DECODE_PROCESSES)
+    :param decoding_plugin: nazwa wtyczki dekodującej pydicom ("" - pierwsza dostępna)
+    :return: słownik {(sposób zrównoleglenia, liczba wątków/procesów): czas dekodowania [s]}
+    """
+    reference = None
+    results = {}
+    for backend in backends:
+        for count in workers:
+            if count == 1 and backend != backends[0]:
+                continue  # Dekodowanie w bieżącym wątku nie zależy od sposobu zrównoleglenia
+            volume = utils.Volume(ct_dir, decoding_plugin=decoding_plugin)
+            start = time.perf_counter()
+            volume.decode_all(workers=count, backend=backend)
+            results[backend if count > 1 else "serial", count] = time.perf_counter() - start
+            if reference is None:
+                reference = np.array(volume.pixels)
+            elif not np.array_equal(reference, volume.pixels):
+                raise AssertionError(f"Decoded series differs for {backend} x {count}")
+            volume.close()
+    return results
+
+
+def tier_dataset(tier: str, data_dir: str = DEFAULT_DATA_DIR):
+    """
+    Funkcja zwracająca syntetyczny zestaw danych o podanym rozmiarze - generowany tylko, jeśli nie istnieje
+    (lub został wygenerowany z innymi parametrami).
+    :param tier: nazwa rozmiaru zestawu danych (klucz słownika TIERS)
+    :param data_dir: katalog z wygenerowanymi zestawami danych
+    :return: katalog serii CT, ścieżka pliku RTStruct
+    """
+    directory = os.path.join(data_dir, tier)
+    params_path = os.path.join(directory, "params.json")
+    ct_dir, rtstruct_path = os.path.join(directory, "ct"), os.path.join(directory, "rtstruct.dcm")
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            if json.load(f) == TIERS[tier]:
+                return ct_dir, rtstruct_path
+    print(f"Generating {tier} dataset in {directory}", file=sys.stderr)
+    ct_dir, rtstruct_path = synthetic.generate_dataset(directory, **TIERS[tier])
+    with open(params_path, "w") as f:
+        json.dump(TIERS[tier], f)
+    return ct_dir, rtstruct_path
+
+
+def measure(func, repeat: int = 3):
+    """
+    Pomiar czasu i szczytowego zużycia pamięci funkcji. Czas mierzony jest bez tracemalloc (który spowalnia alokacje),
+    a pamięć - w dodatkowym wywołaniu pod kontrolą tracemalloc.
+    :param func: mierzona funkcja (bez argumentów)
+    :param repeat: liczba powtórzeń pomiaru czasu (raportowany jest najlepszy wynik)
+    :return: słownik {"time": czas [s], "peak": szczytowa ilość zaalokowanej pamięci [B]}
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"time": best, "peak": peak}
+
+
+def benchmark_tier(ct_dir, rtstruct_path, repeat: int = 3):
+    """
+    Funkcja mierząca najważniejsze operacje modułu utils na jednym zestawie danych.
+    :param ct_dir: katalog serii CT
+    :param rtstruct_path: ścieżka pliku RTStruct
+    :param repeat: liczba powtórzeń pomiaru czasu
+    :return: słownik {nazwa operacji: {"time": czas [s], "peak": pamięć [B]}}
+    """
+    ct_paths = sorted(os.path.join(ct_dir, name) for name in os.listdir(ct_dir))
+    ct_path = ct_paths[len(ct_paths) // 2]  # Środkowy slice serii - kontury wszystkich struktur
+    structures, _ = utils.read_rtstruct(rtstruct_path)
+    dicom = utils.Slice(ct_path)
+    dicom.pixel_array
+
+    def add_structures():
+        dicom.structures.clear()
+        for structure in structures:
+            dicom.add_structure(structure)
+
+    def draw():
+        canvas = FigureCanvasAgg(Figure(figsize=(8, 8)))
+        dicom.set_axes(canvas.figure.subplots())
+        dicom.draw_structures()
+        canvas.draw()
+
+    operations = {
+        "read_rtstruct": lambda: utils.read_rtstruct(rtstruct_path),
+        "read_rtstruct(streaming)": lambda: utils.read_rtstruct(rtstruct_path, streaming=True),
+        "Slice.__init__": lambda: utils.Slice(ct_path),
+        "Slice.pixel_array": lambda: utils.Slice(ct_path).pixel_array,
+        "Slice.load_RTStruct": lambda: dicom.load_RTStruct(structures),
+        "Slice.add_structure": add_structures,
+        "draw_structures(Agg)": draw,
+    }
+    return {name: measure(func, repeat) for name, func in operations.items()}
+
+
+def run_suite(tiers, repeat: int = 3, data_dir: str = DEFAULT_DATA_DIR):
+    """
+    Funkcja uruchamiająca benchmarki na zestawach danych o podanych rozmiarach.
+    :return: słownik {rozmiar: {nazwa operacji: {"time": czas [s], "peak": pamięć [B]}}}
+    """
+    return {tier: benchmark_tier(*tier_dataset(tier, data_dir), repeat=repeat) for tier in tiers}
+
+
+def find_regressions(results, baseline, tolerance: float = DEFAULT_TOLERANCE):
+    """
+    Porównanie wyników z wynikami bazowymi.
+    :param results: wyniki funkcji run_suite
+    :param baseline: wczytane z pliku wyniki bazowe
+    :param tolerance: dopuszczalny względny wzrost czasu i zużycia pamięci
+    :return: lista opisów regresji
+    """
+    regressions = []
+    for tier, operations in results.items():
+        for name, result in operations.items():
+            base = baseline.get(tier, {}).get(name)
+            if base is None:
+                continue
+            for metric in ("time", "peak"):
+                if metric == "time" and result["time"] - base["time"] < MIN_TIME_DELTA:
+                    continue
+                if base[metric] > 0 and result[metric] > base[metric] * (1 + tolerance):
+                    regressions.append(f"{tier}/{name}: {metric} {result[metric] / base[metric]:.2f}x baseline")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the RTStruct-on-CT hot paths.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    draw_parser = subparsers.add_parser("draw", help="compare Slice.draw_structures render modes")
+    draw_parser.add_argument("ct_path")
+    draw_parser.add_argument("rtstruct_path")
+    draw_parser.add_argument("--repeat", type=int, default=5)
+    decode_parser = subparsers.add_parser("decode", help="compare parallel decoding of a whole CT series")
+    decode_parser.add_argument("ct_dir")
+    decode_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    decode_parser.add_argument("--backends", nargs="+", choices=[utils.DECODE_THREADS, utils.DECODE_PROCESSES],
+                               default=[utils.DECODE_THREADS, utils.DECODE_PROCESSES])
+    decode_parser.add_argument("--plugin", default="", help="pydicom decoding plugin (default: first available)")
+    suite_parser = subparsers.add_parser("suite", help="time and memory of the hot paths on synthetic data tiers")
+    suite_parser.add_argument("--tiers", nargs="+", choices=list(TIERS), default=["small", "medium"])
+    suite_parser.add_argument("--repeat", type=int, default=3)
+    suite_parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR, help="directory for the generated datasets")
+    suite_parser.add_argument("--save-baseline", metavar="FILE", help="store the results as a baseline JSON file")
+    suite_parser.add_argument("--baseline", metavar="FILE", help="compare the results with a baseline JSON file")
+    suite_parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                              help="allowed relative slowdown / memory growth before reporting a regression")
+    args = parser.parse_args()
+
+    if args.command == "draw":
+        results = benchmark_draw_modes(args.ct_path, args.rtstruct_path, args.repeat)
+        print(f"{'mode':<12}{'draw_structures [ms]':>22}{'canvas.draw [ms]':>18}")
+        for mode, (draw_time, raster_time) in results.items():
+            print(f"{mode:<12}{draw_time * 1000:>22.1f}{raster_time * 1000:>18.1f}")
+    elif args.command == "decode":
+        results = benchmark_decode(args.ct_dir, args.workers, args.backends, args.plugin)
+        serial = results.get(("serial", 1))
+        print(f"{'backend':<12}{'workers':>8}{'time [ms]':>12}{'speedup':>10}")
+        for (backend, count), elapsed in results.items():
+            speedup = f"{serial / elapsed:.2f}x" if serial else "-"
+            print(f"{backend:<12}{count:>8}{elapsed * 1000:>12.1f}{speedup:>10}")
+    elif args.command == "suite":
+        results = run_suite(args.tiers, args.repeat, args.data_dir)
+        baseline = {}
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        print(f"{'tier':<8}{'operation':<26}{'time [ms]':>12}{'peak [MB]':>12}{'vs baseline':>14}")
+        for tier, operations in results.items():
+            for name, result in operations.items():
+                base = baseline.get(tier, {}).get(name)
+                ratio = f"{result['time'] / base['time']:.2f}x" if base and base["time"] > 0 else "-"
+                print(f"{tier:<8}{name:<26}{result['time'] * 1000:>12.2f}{result['peak'] / 2 ** 20:>12.2f}{ratio:>14}")
+        if args.save_baseline:
+            with open(args.save_baseline, "w") as f:
+                json.dump(results, f, indent=2)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
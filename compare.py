@@ -0,0 +1,338 @@
+import argparse
+import csv
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+
+import rasterize
+import rtstruct_cache
+import structure_stats
+import utils
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+"""Moduł porównujący dwa pliki RTStruct opisujące tę samą serię CT (np. segmentację automatyczną i segmentację
+poprawioną przez lekarza) - kontrola jakości segmentacji.
+
+Struktury obu plików parowane są po nazwach (bez rozróżniania wielkości liter) lub po numerach (ROINumber). Dla każdej
+pary wyznaczany jest współczynnik Dice'a z masek struktur na siatce pikseli serii CT (moduł rasterize.py - maski
+wyznaczane są slice po slice'u, bez przechowywania masek całej serii) oraz odległość Hausdorffa, jej 95. percentyl
+i średnia odległość powierzchni. Powierzchnią struktury są jej kontury próbkowane co SURFACE_SPACING mm, a odległości
+między powierzchniami wyznaczane są przy pomocy drzewa KD (scipy.spatial.cKDTree; bez scipy - przeszukiwaniem
+wszystkich par punktów w blokach).
+
+Porównanie wielu pacjentów wykonywane jest równolegle (pacjenci rozdzielani są między procesy robocze), a wynikiem jest
+tabela z jednym wierszem na parę struktur zapisywana do pliku CSV lub Parquet.
+
+Przykład użycia:
+    python compare.py report.csv --pair CT_DIR REFERENCE_RTSTRUCT TEST_RTSTRUCT
+    python compare.py report.csv --batch pairs.csv --workers 8 --by number
+
+Wymagane zewnętrzne biblioteki
+-----------------------------
+numpy
+scipy (opcjonalnie - szybsze wyznaczanie odległości między powierzchniami)
+"""
+
+# Sposoby parowania struktur porównywanych plików RTStruct
+MATCH_BY_NAME = "name"
+MATCH_BY_NUMBER = "number"
+
+# Odstęp [mm] między punktami próbkowanych konturów (powierzchni struktur)
+SURFACE_SPACING = 1.0
+# Maksymalna liczba odległości wyznaczanych jednocześnie bez scipy (rozmiar bloku macierzy odległości)
+BRUTE_FORCE_BLOCK = 2 ** 22
+
+REPORT_COLUMNS = ["patient", "roi_name", "reference_number", "test_number", "reference_voxels", "test_voxels",
+                  "dice", "hausdorff_mm", "hd95_mm", "msd_mm"]
+
+# Pary porównywanych struktur i nagłówki slice'ów przekazywane jednorazowo do każdego procesu roboczego
+_worker_pairs = None
+_worker_headers = None
+_worker_options = None
+
+
+def match_rois(reference, test, by: str = MATCH_BY_NAME):
+    """
+    Funkcja parująca struktury dwóch plików RTStruct.
+    :param reference: lista obiektów klasy Structure pliku referencyjnego
+    :param test: lista obiektów klasy Structure pliku porównywanego
+    :param by: sposób parowania (MATCH_BY_NAME lub MATCH_BY_NUMBER)
+    :return: lista par (struktura referencyjna, struktura porównywana) w kolejności struktur pliku referencyjnego
+    """
+    if by == MATCH_BY_NAME:
+        key = lambda structure: str(structure.name).strip().lower()
+    else:
+        key = lambda structure: int(structure.number)
+    test_by_key = {key(structure): structure for structure in test}
+    return [(structure, test_by_key[key(structure)]) for structure in reference if key(structure) in test_by_key]
+
+
+def surface_points(structure, spacing: float = SURFACE_SPACING):
+    """
+    Funkcja próbkująca kontury struktury (wraz z krawędzią domykającą każdy kontur) punktami odległymi o co najwyżej
+    spacing - wszystkie krawędzie wszystkich konturów próbkowane są jednocześnie.
+    :param structure: obiekt klasy Structure z konturami we współrzędnych pacjenta
+    :param spacing: maksymalna odległość między kolejnymi punktami [mm]
+    :return: macierz M x 3 punktów powierzchni struktury
+    """
+    if structure.contour_count() == 0:
+        return np.empty((0, 3))
+    points, offsets = structure.points, structure.offsets
+    following = np.arange(1, len(points) + 1)
+    following[offsets[1:] - 1] = offsets[:-1]
+    step = points[following] - points
+    samples = np.maximum(np.ceil(np.linalg.norm(step, axis=1) / spacing).astype(np.int64), 1)
+
+    # Krawędź podzielona na samples odcinków - punkty: początek krawędzi i samples - 1 punktów pośrednich
+    edge = np.repeat(np.arange(len(points)), samples)
+    starts = np.cumsum(samples) - samples
+    fraction = (np.arange(len(edge)) - starts[edge]) / samples[edge]
+    return points[edge] + fraction[:, None] * step[edge]
+
+
+def directed_distances(source, target):
+    """
+    Odległości każdego punktu source od najbliższego punktu target.
+    :param source: macierz M x 3 punktów
+    :param target: macierz K x 3 punktów
+    :return: macierz M odległości
+    """
+    if cKDTree is not None:
+        return cKDTree(target).query(source)[0]
+    distances = np.empty(len(source))
+    block = max(BRUTE_FORCE_BLOCK // max(len(target), 1), 1)
+    target_squares = np.square(target).sum(axis=1)
+    for start in range(0, len(source), block):
+        chunk = source[start:start + block]
+        # |a - b|^2 = |a|^2 - 2ab + |b|^2 - jedno mnożenie macierzy dla całego bloku
+        squares = np.square(chunk).sum(axis=1)[:, None] - 2 * chunk @ target.T + target_squares
+        distances[start:start + block] = np.sqrt(np.maximum(squares.min(axis=1), 0))
+    return distances
+
+
+def surface_distances(reference, test, spacing: float = SURFACE_SPACING):
+    """
+    Funkcja wyznaczająca odległości między powierzchniami (konturami) dwóch struktur.
+    :param reference: obiekt klasy Structure struktury referencyjnej
+    :param test: obiekt klasy Structure struktury porównywanej
+    :param spacing: odstęp między punktami próbkowanych konturów [mm]
+    :return: odległość Hausdorffa, 95. percentyl odległości (większy z dwóch kierunków), średnia odległość powierzchni
+     [mm] - wartości NaN, jeśli któraś ze struktur nie ma konturów
+    """
+    a, b = surface_points(reference, spacing), surface_points(test, spacing)
+    if len(a) == 0 or len(b) == 0:
+        return np.nan, np.nan, np.nan
+    a_to_b, b_to_a = directed_distances(a, b), directed_distances(b, a)
+    hausdorff = max(a_to_b.max(), b_to_a.max())
+    hd95 = max(np.percentile(a_to_b, 95), np.percentile(b_to_a, 95))
+    return hausdorff, hd95, (a_to_b.sum() + b_to_a.sum()) / (len(a) + len(b))
+
+
+def slice_dice(reference, test, shape, by: str = MATCH_BY_NAME):
+    """
+    Współczynniki Dice'a par struktur dopasowanych do jednego slice'a (np. do wyświetlenia w GUI).
+    :param reference: słownik {numer struktury: obiekt Structure} w układzie współrzędnych pikseli (Slice.structures)
+    :param test: słownik struktur porównywanego RTStructa dopasowanych do tego samego slice'a
+    :param shape: rozmiar obrazu slice'a (liczba wierszy, liczba kolumn)
+    :param by: sposób parowania struktur (MATCH_BY_NAME lub MATCH_BY_NUMBER)
+    :return: słownik {nazwa struktury: Dice} dla par struktur obecnych na slice'u w obu RTStructach
+    """
+    scores = {}
+    for reference_structure, test_structure in match_rois(list(reference.values()), list(test.values()), by):
+        reference_mask = rasterize.structure_mask(reference_structure, shape)
+        test_mask = rasterize.structure_mask(test_structure, shape)
+        total = np.count_nonzero(reference_mask) + np.count_nonzero(test_mask)
+        if total:
+            scores[str(reference_structure.name)] = 2 * np.count_nonzero(reference_mask & test_mask) / total
+    return scores
+
+
+def _init_worker(pairs, headers, options):
+    """Inicjalizacja procesu roboczego - zapamiętanie par struktur, nagłówków slice'ów i parametrów dopasowania."""
+    global _worker_pairs, _worker_headers, _worker_options
+    _worker_pairs = pairs
+    _worker_headers = headers
+    _worker_options = options
+
+
+def _slice_overlap(index):
+    """
+    Liczby pikseli masek par struktur na jednym slice'u (wywoływane w procesie roboczym).
+    :param index: indeks slice'a w serii
+    :return: indeks slice'a, macierz (para, [piksele struktury referencyjnej, porównywanej, części wspólnej])
+    """
+    dicom = utils.Slice(index=index, header=_worker_headers[index])
+    dicom.match_mode = _worker_options["match_mode"]
+    shape = (dicom.dcm.Rows, dicom.dcm.Columns)
+    counts = np.zeros((len(_worker_pairs), 3), dtype=np.int64)
+    for i, (reference, test) in enumerate(_worker_pairs):
+        matched_reference, matched_test = dicom.match_structure(reference), dicom.match_structure(test)
+        if matched_reference is None and matched_test is None:
+            continue
+        reference_mask = rasterize.structure_mask(matched_reference, shape) if matched_reference is not None else None
+        test_mask = rasterize.structure_mask(matched_test, shape) if matched_test is not None else None
+        counts[i, 0] = reference_mask.sum() if reference_mask is not None else 0
+        counts[i, 1] = test_mask.sum() if test_mask is not None else 0
+        if reference_mask is not None and test_mask is not None:
+            counts[i, 2] = np.count_nonzero(reference_mask & test_mask)
+    return index, counts
+
+
+def overlap_counts(volume, pairs, workers: int = 1, match_mode: str = utils.MATCH_UID_Z, progress=None):
+    """
+    Funkcja sumująca liczby pikseli masek par struktur na wszystkich slice'ach serii.
+    :param volume: obiekt klasy utils.Volume
+    :param pairs: lista par (struktura referencyjna, struktura porównywana) - wynik match_rois
+    :param workers: liczba procesów roboczych (None - liczba rdzeni procesora, 1 - bez puli procesów)
+    :param match_mode: sposób dopasowywania konturów do slice'ów (Slice.match_mode)
+    :param progress: funkcja wywoływana po każdym slice'u z argumentami (liczba gotowych slice'ów, liczba slice'ów)
+    :return: macierz (para, [woksele struktury referencyjnej, porównywanej, części wspólnej])
+    """
+    totals = np.zeros((len(pairs), 3), dtype=np.int64)
+    initargs = (pairs, volume.headers, {"match_mode": match_mode})
+    indices = range(len(volume))
+    if workers == 1:
+        _init_worker(*initargs)
+        results = map(_slice_overlap, indices)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs)
+        results = pool.imap_unordered(_slice_overlap, indices, chunksize=4)
+    try:
+        for done, (index, counts) in enumerate(results, 1):
+            totals += counts
+            if progress is not None:
+                progress(done, len(volume))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return totals
+
+
+def compare_rtstructs(volume, reference, test, by: str = MATCH_BY_NAME, workers: int = 1,
+                      match_mode: str = utils.MATCH_UID_Z, spacing: float = SURFACE_SPACING, patient: str = None):
+    """
+    Funkcja porównująca struktury dwóch plików RTStruct opisujących tę samą serię CT.
+    :param volume: obiekt klasy utils.Volume (potrzebne są wyłącznie nagłówki slice'ów - siatka pikseli masek)
+    :param reference: lista obiektów klasy Structure pliku referencyjnego
+    :param test: lista obiektów klasy Structure pliku porównywanego
+    :param by: sposób parowania struktur (MATCH_BY_NAME lub MATCH_BY_NUMBER)
+    :param workers: liczba procesów roboczych rasteryzujących slice'y (1 - bez puli procesów)
+    :param match_mode: sposób dopasowywania konturów do slice'ów (Slice.match_mode)
+    :param spacing: odstęp między punktami próbkowanych konturów [mm]
+    :param patient: identyfikator pacjenta w raporcie (domyślnie PatientName serii)
+    :return: lista wierszy raportu (REPORT_COLUMNS) - jeden na parę struktur
+    """
+    pairs = match_rois(reference, test, by)
+    if patient is None:
+        patient = str(volume.headers[0].PatientName)
+    counts = overlap_counts(volume, pairs, workers, match_mode)
+    rows = []
+    for (reference_structure, test_structure), (reference_voxels, test_voxels, common) in zip(pairs, counts):
+        hausdorff, hd95, msd = surface_distances(reference_structure, test_structure, spacing)
+        total = reference_voxels + test_voxels
+        rows.append({"patient": patient, "roi_name": str(reference_structure.name),
+                     "reference_number": reference_structure.number, "test_number": test_structure.number,
+                     "reference_voxels": int(reference_voxels), "test_voxels": int(test_voxels),
+                     "dice": 2 * common / total if total else np.nan,
+                     "hausdorff_mm": hausdorff, "hd95_mm": hd95, "msd_mm": msd})
+    return rows
+
+
+def _compare_patient(task):
+    """
+    Porównanie plików RTStruct jednego pacjenta (wywoływane w procesie roboczym compare_batch).
+    :param task: krotka (katalog serii CT, plik RTStruct referencyjny, plik RTStruct porównywany, parametry)
+    :return: lista wierszy raportu
+    """
+    ct_dir, reference_path, test_path, options = task
+    cache = rtstruct_cache.RTStructCache()
+    reference, _ = cache.load(reference_path)
+    test, _ = cache.load(test_path)
+    cache.close()
+    volume = utils.Volume(ct_dir)
+    try:
+        return compare_rtstructs(volume, reference, test, options["by"], options["workers"], options["match_mode"],
+                                 options["spacing"])
+    finally:
+        volume.close()
+
+
+def compare_batch(tasks, workers: int = None, by: str = MATCH_BY_NAME, match_mode: str = utils.MATCH_UID_Z,
+                  spacing: float = SURFACE_SPACING, progress=None):
+    """
+    Funkcja porównująca pliki RTStruct wielu pacjentów - pacjenci rozdzielani są między procesy robocze. Przy jednym
+    pacjencie między procesy robocze rozdzielane są slice'y serii.
+    :param tasks: lista krotek (katalog serii CT, plik RTStruct referencyjny, plik RTStruct porównywany)
+    :param workers: liczba procesów roboczych (domyślnie liczba rdzeni procesora, 1 - bez puli procesów)
+    :param by: sposób parowania struktur (MATCH_BY_NAME lub MATCH_BY_NUMBER)
+    :param match_mode: sposób dopasowywania konturów do slice'ów (Slice.match_mode)
+    :param spacing: odstęp między punktami próbkowanych konturów [mm]
+    :param progress: funkcja wywoływana po każdym pacjencie z argumentami (liczba gotowych pacjentów, liczba pacjentów)
+    :return: lista wierszy raportu wszystkich pacjentów (w kolejności zakończenia porównań)
+    """
+    options = {"by": by, "match_mode": match_mode, "spacing": spacing, "workers": workers if len(tasks) == 1 else 1}
+    patient_tasks = [(ct_dir, reference_path, test_path, options) for ct_dir, reference_path, test_path in tasks]
+    if workers == 1 or len(patient_tasks) == 1:
+        results = map(_compare_patient, patient_tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_compare_patient, patient_tasks)
+    rows = []
+    try:
+        for done, patient_rows in enumerate(results, 1):
+            rows.extend(patient_rows)
+            if progress is not None:
+                progress(done, len(patient_tasks))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return rows
+
+
+def read_batch(path):
+    """
+    Wczytanie listy porównań z pliku CSV z kolumnami ct_dir, reference, test.
+    :param path: ścieżka pliku CSV
+    :return: lista krotek (katalog serii CT, plik RTStruct referencyjny, plik RTStruct porównywany)
+    """
+    with open(path, newline="") as f:
+        return [(row["ct_dir"], row["reference"], row["test"]) for row in csv.DictReader(f)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two RTStructs of the same CT series (Dice, Hausdorff, MSD).")
+    parser.add_argument("output", help="per-ROI report (.csv or .parquet)")
+    parser.add_argument("--pair", nargs=3, action="append", default=[], metavar=("CT_DIR", "REFERENCE", "TEST"),
+                        help="CT series directory, reference RTStruct and tested RTStruct (repeatable)")
+    parser.add_argument("--batch", help="CSV file with columns ct_dir, reference, test")
+    parser.add_argument("--by", choices=[MATCH_BY_NAME, MATCH_BY_NUMBER], default=MATCH_BY_NAME,
+                        help="match ROIs by name or by ROI number")
+    parser.add_argument("--spacing", type=float, default=SURFACE_SPACING, help="contour sampling distance in mm")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    args = parser.parse_args()
+
+    tasks = [tuple(pair) for pair in args.pair] + (read_batch(args.batch) if args.batch else [])
+    if not tasks:
+        parser.error("nothing to compare - use --pair or --batch")
+    start = time.perf_counter()
+    rows = compare_batch(tasks, args.workers, args.by, spacing=args.spacing,
+                         progress=lambda done, total: print(f"\rCompared {done}/{total} patients", end="",
+                                                            file=sys.stderr))
+    print(file=sys.stderr)
+    structure_stats.write_table(args.output, rows, REPORT_COLUMNS)
+    print(f"Compared {len(rows)} ROI pairs of {len(tasks)} patients in {time.perf_counter() - start:.1f}s")
+    for row in rows:
+        print(f"  {row['patient']} {row['roi_name']}: Dice {row['dice']:.3f}, HD {row['hausdorff_mm']:.1f}mm, "
+              f"HD95 {row['hd95_mm']:.1f}mm, MSD {row['msd_mm']:.2f}mm")
+
+
+if __name__ == "__main__":
+    main()
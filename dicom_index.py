@@ -0,0 +1,278 @@
+import argparse
+import contextlib
+import fnmatch
+import os
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+
+import utils
+
+"""Moduł indeksujący nagłówki plików DICOM z drzewa katalogów w lokalnej bazie SQLite.
+
+Dla każdego pliku zapisywane są wyłącznie metadane odczytane funkcją utils.probe_dicom (pacjent, badanie, seria,
+modalność, SOPInstanceUID, położenie 'z' slice'a i ścieżka), a dla plików RTStruct dodatkowo SeriesInstanceUID serii
+obrazowej, do której odnoszą się kontury. Pliki czytane są równolegle w puli wątków, a ponowne skanowanie katalogu
+czyta tylko pliki nowe i zmienione (po czasie modyfikacji i rozmiarze) oraz usuwa z indeksu pliki usunięte z dysku.
+Indeks pozwala odnaleźć slice'y CT, do których odnosi się plik RTStruct, bez przeszukiwania katalogów.
+
+Przykład użycia:
+    python dicom_index.py scan Temat6
+    python dicom_index.py find RTSTRUCT_FILE
+
+Wymagane zewnętrzne biblioteki
+-----------------------------
+pydicom
+"""
+
+# Domyślna lokalizacja bazy - można ją zmienić zmienną środowiskową DICOM_INDEX_PATH
+INDEX_PATH_ENV = "DICOM_INDEX_PATH"
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".cache", "rtstruct_on_ct", "dicom_index.sqlite")
+
+# Liczba plików, których nagłówki zlecane są wątkom roboczym jednorazowo (między partiami sprawdzane jest przerwanie)
+SCAN_CHUNK = 500
+
+# Znacznik sekwencji z UID serii obrazowej, do której odnoszą się kontury pliku RTStruct (leży przed konturami)
+REFERENCED_FRAME_TAG = pydicom.tag.Tag("ReferencedFrameOfReferenceSequence")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    patient_name TEXT,
+    patient_id TEXT,
+    study_uid TEXT,
+    series_uid TEXT,
+    sop_uid TEXT,
+    modality TEXT,
+    z REAL,
+    referenced_series_uid TEXT
+);
+CREATE INDEX IF NOT EXISTS files_sop_uid ON files (sop_uid);
+CREATE INDEX IF NOT EXISTS files_series_uid ON files (series_uid, z);
+CREATE INDEX IF NOT EXISTS files_patient ON files (patient_name, kind);
+"""
+
+# Kolumny w kolejności pól utils.DicomHeader
+_HEADER_COLUMNS = "path, kind, patient_name, patient_id, study_uid, series_uid, sop_uid, modality, z"
+
+
+class DicomIndex:
+    """Klasa reprezentująca indeks nagłówków plików DICOM zapisany w bazie SQLite.
+
+    Każda operacja otwiera własne połączenie z bazą, więc obiekt może być używany jednocześnie z wątku głównego GUI
+    i z wątków roboczych.
+
+    Atrybuty
+    --------
+    db_path: str
+        ścieżka pliku bazy SQLite
+    """
+
+    def __init__(self, db_path: str = None):
+        """
+        Inicjalizacja obiektu klasy DicomIndex
+        :param db_path: ścieżka pliku bazy (domyślnie zmienna środowiskowa DICOM_INDEX_PATH
+         lub ~/.cache/rtstruct_on_ct/dicom_index.sqlite)
+        """
+        if db_path is None:
+            db_path = os.environ.get(INDEX_PATH_ENV, DEFAULT_INDEX_PATH)
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as connection:
+            connection.executescript(_SCHEMA)
+
+    def __repr__(self):
+        return f"<db_path={self.db_path}, files={len(self)}>"
+
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def scan(self, root: str, workers: int = 8, pattern: str = "*.dcm", progress=None, cancel=None):
+        """
+        Przyrostowe indeksowanie wszystkich plików DICOM w drzewie katalogów root.
+        :param root: katalog główny skanowanego drzewa
+        :param workers: liczba wątków czytających nagłówki plików
+        :param pattern: wzorzec nazw indeksowanych plików
+        :param progress: funkcja wywoływana z argumentami (liczba przeczytanych plików, liczba plików do przeczytania)
+        :param cancel: opcjonalny obiekt threading.Event - jego ustawienie przerywa indeksowanie (nagłówki przeczytane
+         do tego czasu pozostają w indeksie)
+        :return: liczba przeczytanych (nowych lub zmienionych) plików, liczba niezmienionych plików,
+         liczba plików usuniętych z indeksu - po przerwaniu liczby dotyczą tylko przetworzonej części drzewa
+        """
+        root = os.path.abspath(root)
+        found = {}
+        for directory, _, names in os.walk(root):
+            if cancel is not None and cancel.is_set():
+                return 0, 0, 0
+            for name in fnmatch.filter(names, pattern):
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found[path] = (stat.st_mtime_ns, stat.st_size)
+
+        with self._connect() as connection:
+            # Pliki z indeksu leżące w skanowanym drzewie - LIKE z ucieczką znaków specjalnych ścieżki
+            prefix = os.path.join(root, "").replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            indexed = {path: (mtime_ns, size) for path, mtime_ns, size in connection.execute(
+                "SELECT path, mtime_ns, size FROM files WHERE path LIKE ? ESCAPE '\\'", (prefix + "%",))}
+            removed = [path for path in indexed if path not in found]
+            connection.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in removed))
+        changed = [path for path, signature in found.items() if indexed.get(path) != signature]
+
+        # Nagłówki czytane są w wątkach roboczych partiami po SCAN_CHUNK plików, a zapis do bazy odbywa się w bieżącym
+        # wątku po każdej partii - przerwanie nie czeka na przeczytanie pozostałych plików
+        done = 0
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for start in range(0, len(changed), SCAN_CHUNK):
+                if cancel is not None and cancel.is_set():
+                    break
+                chunk = changed[start:start + SCAN_CHUNK]
+                batch = []
+                for row in executor.map(_index_row, chunk, (found[path] for path in chunk)):
+                    batch.append(row)
+                    done += 1
+                    if progress is not None:
+                        progress(done, len(changed))
+                self._store(batch)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        return done, len(found) - len(changed), len(removed)
+
+    def headers(self, sop_uids):
+        """
+        Metadane plików o podanych SOPInstanceUID.
+        :param sop_uids: kolekcja SOPInstanceUID
+        :return: słownik {SOPInstanceUID: utils.DicomHeader}
+        """
+        sop_uids = list(sop_uids)
+        result = {}
+        with self._connect() as connection:
+            for start in range(0, len(sop_uids), 500):  # Ograniczenie liczby parametrów pojedynczego zapytania
+                chunk = sop_uids[start:start + 500]
+                query = f"SELECT {_HEADER_COLUMNS} FROM files WHERE sop_uid IN ({','.join('?' * len(chunk))})"
+                for row in connection.execute(query, chunk):
+                    result[row[6]] = utils.DicomHeader(*row)
+        return result
+
+    def series(self, series_uid):
+        """Metadane slice'ów CT serii o podanym SeriesInstanceUID posortowane po współrzędnej 'z'."""
+        with self._connect() as connection:
+            rows = connection.execute(f"SELECT {_HEADER_COLUMNS} FROM files WHERE series_uid = ? AND kind = ? "
+                                      "ORDER BY z", (series_uid, utils.CT_IMAGE)).fetchall()
+        return [utils.DicomHeader(*row) for row in rows]
+
+    def patient_series(self, patient_name):
+        """Lista SeriesInstanceUID serii CT pacjenta o podanej nazwie."""
+        with self._connect() as connection:
+            rows = connection.execute("SELECT DISTINCT series_uid FROM files WHERE patient_name = ? AND kind = ?",
+                                      (str(patient_name), utils.CT_IMAGE)).fetchall()
+        return [row[0] for row in rows]
+
+    def referenced_series(self, rt_structure_filename):
+        """SeriesInstanceUID serii obrazowej, do której odnosi się zaindeksowany plik RTStruct (lub None)."""
+        with self._connect() as connection:
+            row = connection.execute("SELECT referenced_series_uid FROM files WHERE path = ?",
+                                     (os.path.abspath(rt_structure_filename),)).fetchone()
+        return row[0] if row else None
+
+    def resolve_ct(self, rt_structure_filename, structures, patient_name=None):
+        """
+        Wyszukanie w indeksie slice'a CT pasującego do pliku RTStruct - kolejno: slice, do którego odnosi się najwięcej
+        konturów (ReferencedSOPInstanceUID), środkowy slice serii wskazanej w nagłówku RTStructa, środkowy slice
+        jedynej serii CT pacjenta.
+        :param rt_structure_filename: ścieżka do pliku DICOM z danymi RTStruct
+        :param structures: lista obiektów klasy utils.Structure wczytana z pliku RTStruct
+        :param patient_name: nazwa pacjenta z pliku RTStruct
+        :return: metadane (utils.DicomHeader) znalezionego slice'a CT lub None
+        """
+        contour_counts = {}
+        for structure in structures:
+            for uid, (first, stop) in structure.uid_index.items():
+                if uid:
+                    contour_counts[uid] = contour_counts.get(uid, 0) + stop - first
+        slices = [header for header in self.headers(contour_counts).values() if header.kind == utils.CT_IMAGE]
+        if slices:
+            return max(slices, key=lambda header: contour_counts[header.sop_uid])
+
+        series_uid = self.referenced_series(rt_structure_filename)
+        if series_uid is None and patient_name is not None:
+            candidates = self.patient_series(patient_name)
+            series_uid = candidates[0] if len(candidates) == 1 else None
+        slices = self.series(series_uid) if series_uid is not None else []
+        return slices[len(slices) // 2] if slices else None
+
+    def _store(self, rows):
+        with self._connect() as connection:
+            connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """Połączenie z bazą zatwierdzające transakcję (lub wycofujące ją w razie błędu) i zamykane po użyciu."""
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+def _index_row(path, signature):
+    """Odczyt nagłówka pliku (w wątku roboczym) i przygotowanie wiersza tabeli files."""
+    try:
+        header = utils.probe_dicom(path)
+    except Exception as ex:  # Uszkodzony plik nie może przerwać indeksowania całego drzewa
+        print(f"Cannot read {path}: {ex}", file=sys.stderr)
+        header = utils.DicomHeader(path, utils.OTHER, None, None, None, None, None, None, None)
+    referenced = _referenced_series(path) if header.kind == utils.RTSTRUCT else None
+    text = [str(value) if value is not None else None for value in header[2:8]]
+    return (path, *signature, header.kind, *text, header.z, referenced)
+
+
+def _referenced_series(path):
+    """SeriesInstanceUID serii obrazowej z nagłówka pliku RTStruct (odczyt kończy się przed sekwencjami konturów)."""
+    try:
+        with open(path, "rb") as f:
+            header = pydicom.filereader.read_partial(f, stop_when=lambda tag, vr, length: tag > REFERENCED_FRAME_TAG)
+        for frame in header.get("ReferencedFrameOfReferenceSequence", []):
+            for study in frame.get("RTReferencedStudySequence", []):
+                for series in study.get("RTReferencedSeriesSequence", []):
+                    return series.SeriesInstanceUID
+    except Exception as ex:
+        print(f"Cannot read referenced series of {path}: {ex}", file=sys.stderr)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Header-only SQLite index of DICOM files.")
+    parser.add_argument("--db", default=None, help=f"index database (default: ${INDEX_PATH_ENV} or {DEFAULT_INDEX_PATH})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    scan_parser = subparsers.add_parser("scan", help="index (or re-index) a DICOM directory tree")
+    scan_parser.add_argument("root")
+    scan_parser.add_argument("--workers", type=int, default=8)
+    find_parser = subparsers.add_parser("find", help="find the CT slice matching an RTStruct file")
+    find_parser.add_argument("rtstruct_path")
+    args = parser.parse_args()
+
+    index = DicomIndex(args.db)
+    if args.command == "scan":
+        read, unchanged, removed = index.scan(args.root, args.workers, progress=lambda done, total: print(
+            f"\rIndexed {done}/{total} files", end="", file=sys.stderr))
+        print(file=sys.stderr)
+        print(f"{read} files read, {unchanged} unchanged, {removed} removed - {len(index)} files in {index.db_path}")
+    elif args.command == "find":
+        structures, patient_name = utils.read_rtstruct(args.rtstruct_path, streaming=True)
+        header = index.resolve_ct(args.rtstruct_path, structures, patient_name)
+        print(header.path if header is not None else "No matching CT slice in the index")
+
+
+if __name__ == "__main__":
+    main()
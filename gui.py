@@ -1,6 +1,7 @@
 import os
 import random
 import sys
+import threading
 
 import matplotlib
 from PyQt5.QtWidgets import *
@@ -8,7 +9,12 @@ from PyQt5 import QtCore
 from matplotlib import pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT
 from matplotlib.figure import Figure
+import numpy as np
 
+import compare
+import dicom_index
+import profiling
+import rtstruct_cache
 import utils
 
 """Moduł odpowiadający za graficzny interfejs użytkownika pozwalający na załadowanie pliku DICOM z danymi obrazowymi pojedynczego slice'a 
@@ -28,10 +34,19 @@ matplotlib.rc("xtick", color="#dddddd")
 matplotlib.rc("ytick", color="#dddddd")
 
 
+# Otwarte okienka z błędami - referencje chronią je przed usunięciem przez garbage collector
+_exception_boxes = []
+
+
 def catch_exceptions(t, val, tb):
-    """Wyświetla błędy w okienku dialogowym."""
+    """Wyświetla błędy w niemodalnym okienku dialogowym (nie blokuje obsługi zdarzeń okna głównego)."""
 
-    QMessageBox.critical(None, "An exception was raised", "Exception type: {}".format(t))
+    messageBox = QMessageBox(QMessageBox.Critical, "An exception was raised", "Exception type: {}".format(t))
+    messageBox.setInformativeText(str(val))
+    messageBox.setModal(False)
+    messageBox.finished.connect(lambda _: _exception_boxes.remove(messageBox))
+    _exception_boxes.append(messageBox)
+    messageBox.show()
     old_hook(t, val, tb)
 
 
@@ -49,6 +64,186 @@ class Canvas(FigureCanvasQTAgg):
         FigureCanvasQTAgg.__init__(self, fig)
 
 
+class ProfiledCanvas(FigureCanvasQTAgg):
+    """Płótno mierzące czas rasteryzacji rysunku (etap canvas.draw modułu profiling)."""
+
+    @profiling.timed("canvas.draw")
+    def draw(self):
+        FigureCanvasQTAgg.draw(self)
+
+
+# Zmiana okna wyświetlania przy przeciąganiu prawym przyciskiem myszy [HU na piksel ekranu]
+WINDOW_DRAG_SENSITIVITY = 2.0
+
+# Dekodowanie całej serii (przekroje): liczba wątków lub procesów (None - liczba rdzeni procesora) i sposób
+# zrównoleglenia (utils.DECODE_THREADS lub utils.DECODE_PROCESSES)
+DECODE_WORKERS = None
+DECODE_BACKEND = utils.DECODE_THREADS
+
+# Etapy wyświetlane na pasku statusu okna głównego: (nazwa etapu w module profiling, etykieta)
+STATUS_STAGES = (("read_rtstruct", "parse"), ("Slice.__init__", "read"), ("Slice.pixel_array", "decode"),
+                 ("Slice.match_structures", "match"), ("SliceRenderer.show", "draw"), ("canvas.draw", "raster"),
+                 ("Volume.decode_all", "series decode"))
+
+
+class LoadCancelled(Exception):
+    """Wyjątek przerywający zadanie wątku roboczego, którego wynik nie jest już potrzebny."""
+    pass
+
+
+class WorkerSignals(QtCore.QObject):
+    """Sygnały emitowane przez obiekt LoadWorker - obsługiwane są w wątku głównym okna."""
+    progress = QtCore.pyqtSignal(int, str)
+    finished = QtCore.pyqtSignal(object)
+    error = QtCore.pyqtSignal(object)
+
+
+class LoadWorker(QtCore.QRunnable):
+    """Klasa zadania wykonywanego w puli wątków roboczych (wczytywanie plików DICOM, dopasowywanie konturów).
+
+    Funkcja zadania dostaje jako pierwszy argument funkcję report(procent, komunikat), którą zgłasza postęp.
+    Po anulowaniu zadania kolejne wywołanie report przerywa zadanie, a jego wynik nie jest emitowany. Zadania, które
+    zgłaszają postęp rzadko, mogą dodatkowo sprawdzać obiekt cancelEvent ustawiany przy anulowaniu.
+    """
+
+    def __init__(self, task, *args, cancelEvent=None):
+        """
+        Inicjalizacja obiektu klasy LoadWorker
+        :param task: funkcja wykonywana w wątku roboczym
+        :param args: argumenty przekazywane do funkcji task (po funkcji report)
+        :param cancelEvent: opcjonalny obiekt threading.Event ustawiany przy anulowaniu zadania
+        """
+        QtCore.QRunnable.__init__(self)
+        self.setAutoDelete(False)
+        self.task = task
+        self.args = args
+        self.signals = WorkerSignals()
+        self.cancelled = False
+        self.cancelEvent = cancelEvent
+
+    def cancel(self):
+        """Anulowanie zadania - zostanie przerwane przy najbliższym zgłoszeniu postępu (lub sprawdzeniu cancelEvent)."""
+        self.cancelled = True
+        if self.cancelEvent is not None:
+            self.cancelEvent.set()
+
+    def report(self, percent, message):
+        """Zgłoszenie postępu zadania."""
+        if self.cancelled:
+            raise LoadCancelled()
+        self.signals.progress.emit(percent, message)
+
+    def run(self):
+        try:
+            result = profiling.profile_call(self.task, self.report, *self.args)
+        except LoadCancelled:
+            return
+        except Exception as ex:
+            if not self.cancelled:
+                self.signals.error.emit(ex)
+            return
+        if not self.cancelled:
+            self.signals.finished.emit(result)
+
+
+def comparison_metric(dicom, compared):
+    """Wynik porównania RTStructów na slice'u (Slice.match_comparison) - współczynniki Dice'a par struktur."""
+    return compare.slice_dice(dicom.structures, compared, (dicom.dcm.Rows, dicom.dcm.Columns))
+
+
+def load_ct_task(report, dicom_path, rt_struct, patient_name, match_mode=utils.MATCH_UID_Z, compare_rt=None):
+    """
+    Zadanie wątku roboczego: wczytanie slice'a z pliku z danymi obrazowymi i dopasowanie do niego konturów struktur.
+    Dane obrazowe wczytywane są tylko, jeśli pacjent zgadza się z pacjentem z RTStructa.
+    :return: metadane pliku (utils.DicomHeader), obiekt utils.Slice lub None przy niezgodności pacjentów
+    """
+    report(5, "Reading DICOM header")
+    header = utils.probe_dicom(dicom_path)
+    if header.kind != utils.CT_IMAGE:
+        raise utils.NotCTImageFileException("Passed DICOM file is not CT image data file")
+    if header.patient_name != patient_name:
+        return header, None
+
+    report(20, "Decoding pixel data")
+    dicom = utils.Slice(dicom_path)
+    with profiling.stage("Slice.pixel_array"):
+        dicom.pixel_array  # Dekodowanie danych obrazowych jeszcze w wątku roboczym
+    dicom.match_mode = match_mode
+    if rt_struct is not None:
+        report(70, "Matching contours")
+        dicom.load_RTStruct(rt_struct)
+    if compare_rt is not None:
+        dicom.match_comparison(compare_rt, comparison_metric)
+    dicom.build_lod()
+    report(100, "Done")
+    return header, dicom
+
+
+def load_rtstruct_task(report, rt_path, cache, dicom, index=None):
+    """
+    Zadanie wątku roboczego: wczytanie pliku RTStruct (przez cache) i dopasowanie jego konturów do wyświetlanego slice'a.
+    Jeśli wyświetlany slice nie pasuje do RTStructa, pasujący slice CT wyszukiwany jest w indeksie plików DICOM.
+    :return: lista struktur, nazwa pacjenta, slice dicom, słownik dopasowanych struktur lub None,
+     metadane (utils.DicomHeader) pasującego slice'a CT z indeksu lub None
+    """
+    report(10, "Parsing RTStruct")
+    structures, patient_name = cache.load(rt_path)
+    matched = referencedCT = None
+    if dicom is not None and dicom.dcm.PatientName == patient_name:
+        report(70, "Matching contours")
+        matched = dicom.match_structures(structures)
+        for structure in matched.values():
+            structure.build_lod()
+    elif index is not None:
+        report(70, "Looking up referenced CT in the index")
+        referencedCT = index.resolve_ct(rt_path, structures, patient_name)
+    report(100, "Done")
+    return structures, patient_name, dicom, matched, referencedCT
+
+
+def load_comparison_task(report, rt_path, cache, dicom):
+    """Zadanie wątku roboczego: wczytanie (przez cache) pliku RTStruct porównywanego z wyświetlanym RTStructem
+     i dopasowanie jego konturów do wyświetlanego slice'a dicom (wraz z wyznaczeniem współczynników Dice'a)."""
+    report(10, "Parsing comparison RTStruct")
+    structures, patient_name = cache.load(rt_path)
+    if patient_name == dicom.dcm.PatientName:
+        report(70, "Comparing contours")
+        dicom.match_comparison(structures, comparison_metric)
+        dicom.build_lod()
+    report(100, "Done")
+    return structures, patient_name
+
+
+def index_folder_task(report, index, root, cancel=None):
+    """Zadanie wątku roboczego: przyrostowe indeksowanie nagłówków plików DICOM z drzewa katalogów root. Ustawienie
+     obiektu cancel (threading.Event) przerywa indeksowanie przed przeczytaniem kolejnej partii plików."""
+    def progress(done, total):
+        if done % 100 == 0 or done == total:  # Ograniczenie liczby sygnałów przy dużych drzewach katalogów
+            report(done * 100 // total, f"Indexing {root}: {done}/{total} files")
+
+    report(0, f"Scanning {root}")
+    counts = index.scan(root, progress=progress, cancel=cancel)
+    if cancel is not None and cancel.is_set():
+        raise LoadCancelled()
+    return counts
+
+
+def decode_series_task(report, volume, workers=None, backend=utils.DECODE_THREADS):
+    """Zadanie wątku roboczego: równoległe dekodowanie danych obrazowych wszystkich slice'ów serii (potrzebne do
+     przekrojów). Anulowanie zadania przerywa dekodowanie przy zgłoszeniu postępu kolejnego slice'a."""
+    def progress(done, total):
+        report(done * 100 // total, f"Decoding series: {done}/{total} slices")
+
+    volume.decode_all(progress, workers, backend)
+    return volume
+
+
+def open_series_task(report, file_path):
+    """Zadanie wątku roboczego: wczytanie nagłówków serii, do której należy podany plik z danymi obrazowymi."""
+    report(0, "Reading series headers")
+    return utils.Volume.from_slice_path(file_path)
+
+
 class MainWindow(QMainWindow):
     """Klasa reprezentująca okno główne programu.
 
@@ -58,27 +253,70 @@ class MainWindow(QMainWindow):
         płótno na którym rysowane będą obrazy z nałożonymi konturami struktur
     currentRT: list
         lista obiektów utils.Structure wczytana z ostatniego, załadowanego pliku DICOM RTStruct
+    compareRT: list
+        lista obiektów utils.Structure drugiego pliku RTStruct, którego kontury rysowane są liniami przerywanymi
+        w celu porównania z currentRT (None - bez porównania)
+    rtCache: rtstruct_cache.RTStructCache
+        trwały cache sparsowanych plików RTStruct
+    dicomIndex: dicom_index.DicomIndex
+        indeks nagłówków plików DICOM, w którym wyszukiwane są slice'y CT pasujące do wczytanych RTStructów
     dicom: utils.Slice
         obecnie załadowany slice danych obrazowych
     dicom_path: str
         ścieżka do pliku DICOM z ostatnio załadowanym slicem
+    pendingCT: utils.DicomHeader
+        metadane pliku z danymi obrazowymi czekającego na pasujący plik RTStruct (dane obrazowe nie są jeszcze wczytane)
     upperLabel: QLabel
         etykieta umieszczona na górze okna głównego, służy do wyświetlania użytkownikowi komunikatów
     toolbar: NavigationToolbar2QT
         pasek narzędziowy matplotliba do operowania na wyswietlanym wykresie/obrazie
     isImageSet: bool
         flaga używana przy wyświetlaniu bądź chowaniu etykiety upperLabel
+    threadPool: QThreadPool
+        pula wątków roboczych, w których wczytywane są pliki DICOM
+    currentWorker: LoadWorker
+        trwające zadanie wczytywania (rozpoczęcie nowego zadania anuluje poprzednie)
+    progressBar: QProgressBar
+        pasek postępu wczytywania umieszczony na pasku statusu
+    renderer: utils.SliceRenderer
+        trwały stan rysowania wyświetlanego slice'a (obraz, kolekcje konturów, tło do blittingu)
+    matchMode: str
+        sposób dopasowywania konturów do slice'ów (utils.MATCH_UID, utils.MATCH_Z lub utils.MATCH_UID_Z)
+    navigator: utils.SeriesNavigator
+        nawigacja po slice'ach serii wyświetlanego slice'a (kółko myszy, klawisze Up/Down/PageUp/PageDown)
+    displayWindow: tuple
+        okno wyświetlania obrazu (środek, szerokość) [HU] lub None - okno zapisane w pliku DICOM slice'a
+    windowDrag: tuple
+        położenie kursora i okno wyświetlania w chwili rozpoczęcia przeciągania prawym przyciskiem myszy
+    viewPlane: str
+        płaszczyzna wyświetlanego obrazu (utils.AXIAL, utils.CORONAL lub utils.SAGITTAL)
+    reformatRenderer: utils.ReformatRenderer
+        trwały stan rysowania przekroju czołowego lub strzałkowego serii (None w widoku osiowym)
+    reformatWorker: LoadWorker
+        trwające dekodowanie serii dla przekroju - zadanie niezależne od currentWorker, więc zmiana płaszczyzny nie
+        anuluje wczytywania pliku (None - brak zadania)
+    crosshairDrag: bool
+        flaga przeciągania lewym przyciskiem myszy linii położenia slice'a osiowego na przekroju
+    timingLabel: QLabel
+        etykieta na pasku statusu z czasami ostatnich etapów wczytywania i rysowania oraz skutecznością cache'y
 
     """
 
+    # Slice wczytany w tle przez nawigator serii (nawigator, indeks slice'a, Future) - obsługiwany w wątku głównym
+    sliceLoaded = QtCore.pyqtSignal(object, int, object)
+
     def __init__(self, *args, **kwargs):
         """Inicjalizacja okna głównego, ustawienie wymiarów, osadzenie widgetów płótna, panelu sterowania obrazem, paska menu."""
         QMainWindow.__init__(self, *args, **kwargs)
         self.setGeometry(200, 200, 720, 720)
         self.setWindowTitle("RTStruct mapping app")
 
-        self.canvas = FigureCanvasQTAgg(plt.figure(figsize=(10, 10), facecolor="#232326"))
+        self.canvas = ProfiledCanvas(plt.figure(figsize=(10, 10), facecolor="#232326"))
         self.currentRT = self.currentPatientName = None
+        self.compareRT = None
+        self.rtCache = rtstruct_cache.RTStructCache()
+        self.dicomIndex = dicom_index.DicomIndex()
+        self.indexWorker = None
         self.toolbar = NavigationToolbar2QT(self.canvas, self)
 
         self.layout = QVBoxLayout()
@@ -90,6 +328,15 @@ class MainWindow(QMainWindow):
         self.layout.addWidget(self.canvas)
         self.dicom_path = None
         self.dicom = None
+        self.pendingCT = None
+        self.renderer = None
+        self.matchMode = utils.MATCH_UID_Z
+        self.displayWindow = None
+        self.windowDrag = None
+        self.viewPlane = utils.AXIAL
+        self.reformatRenderer = None
+        self.reformatWorker = None
+        self.crosshairDrag = False
         self.setCentralWidget(self.canvas)
         self._createActions()
         self._createMenuBar()
@@ -98,6 +345,32 @@ class MainWindow(QMainWindow):
         widget.setLayout(self.layout)
         self.setCentralWidget(widget)
 
+        self.threadPool = QtCore.QThreadPool()
+        self.currentWorker = None
+        self.progressBar = QProgressBar()
+        self.progressBar.setMaximumWidth(200)
+        self.progressBar.setVisible(False)
+        self.statusBar().addPermanentWidget(self.progressBar)
+
+        # Czasy etapów i skuteczność cache'y odświeżane na pasku statusu
+        self.timingLabel = QLabel()
+        self.statusBar().addPermanentWidget(self.timingLabel)
+        self.timingTimer = QtCore.QTimer(self)
+        self.timingTimer.timeout.connect(self.updateTimings)
+        self.timingTimer.start(1000)
+
+        # Przewijanie slice'ów serii kółkiem myszy i klawiszami
+        self.navigator = None
+        self.seriesWorker = None
+        self.sliceLoaded.connect(self.onSliceLoaded, QtCore.Qt.QueuedConnection)
+        self.canvas.setFocusPolicy(QtCore.Qt.StrongFocus)
+        self.canvas.mpl_connect("scroll_event", self.onCanvasScroll)
+        self.canvas.mpl_connect("key_press_event", self.onCanvasKey)
+        # Zmiana okna wyświetlania (window/level) przeciąganiem prawym przyciskiem myszy
+        self.canvas.mpl_connect("button_press_event", self.onCanvasPress)
+        self.canvas.mpl_connect("motion_notify_event", self.onCanvasDrag)
+        self.canvas.mpl_connect("button_release_event", self.onCanvasRelease)
+
     def _createMenuBar(self):
         """Inicjalizacja menuBara na górze okna."""
         menubar = self.menuBar()
@@ -106,6 +379,27 @@ class MainWindow(QMainWindow):
 
         fileMenu.addAction(self.openCTAction)
         fileMenu.addAction(self.openRTStructAction)
+        fileMenu.addAction(self.openComparisonAction)
+        fileMenu.addAction(self.clearComparisonAction)
+        fileMenu.addSeparator()
+        fileMenu.addAction(self.indexFolderAction)
+
+        viewMenu = QMenu("&View", self)
+        menubar.addMenu(viewMenu)
+        matchMenu = viewMenu.addMenu("Contour matching")
+        for action in self.matchModeActions.actions():
+            matchMenu.addAction(action)
+        planeMenu = viewMenu.addMenu("Plane")
+        for action in self.planeActions.actions():
+            planeMenu.addAction(action)
+        windowMenu = viewMenu.addMenu("Window preset")
+        for action in self.windowActions.actions():
+            windowMenu.addAction(action)
+
+        profilingMenu = QMenu("&Profiling", self)
+        menubar.addMenu(profilingMenu)
+        profilingMenu.addAction(self.exportTraceAction)
+        profilingMenu.addAction(self.cProfileAction)
 
     def _createActions(self):
         """Podpięcie metod obsługi wybranej opcji z menu File menuBara."""
@@ -113,6 +407,40 @@ class MainWindow(QMainWindow):
         self.openCTAction.triggered.connect(self.openCTFile)
         self.openRTStructAction = QAction("Open RTStruct File...", self)
         self.openRTStructAction.triggered.connect(self.openRTStructFile)
+        self.openComparisonAction = QAction("Open Comparison RTStruct...", self)
+        self.openComparisonAction.triggered.connect(self.openComparisonFile)
+        self.clearComparisonAction = QAction("Clear Comparison", self)
+        self.clearComparisonAction.triggered.connect(self.clearComparison)
+        self.indexFolderAction = QAction("Index DICOM Folder...", self)
+        self.indexFolderAction.triggered.connect(self.indexFolder)
+        self.exportTraceAction = QAction("Export Timing Trace...", self)
+        self.exportTraceAction.triggered.connect(self.exportTrace)
+        self.cProfileAction = QAction("cProfile Capture", self, checkable=True)
+        self.cProfileAction.toggled.connect(self.toggleCProfile)
+
+        # Wybór sposobu dopasowywania konturów do slice'a - tylko jedna opcja może być zaznaczona
+        self.matchModeActions = QActionGroup(self)
+        for mode, text in ((utils.MATCH_UID, "By referenced SOPInstanceUID"),
+                           (utils.MATCH_Z, "By slice position (z)"),
+                           (utils.MATCH_UID_Z, "By UID with z fallback")):
+            action = QAction(text, self.matchModeActions, checkable=True)
+            action.setChecked(mode == self.matchMode)
+            action.triggered.connect(lambda checked, mode=mode: self.setMatchMode(mode))
+
+        # Wybór płaszczyzny wyświetlanego obrazu - slice'y serii lub przekroje czołowe i strzałkowe
+        self.planeActions = QActionGroup(self)
+        for plane, text in ((utils.AXIAL, "Axial"), (utils.CORONAL, "Coronal"), (utils.SAGITTAL, "Sagittal")):
+            action = QAction(text, self.planeActions, checkable=True)
+            action.setChecked(plane == self.viewPlane)
+            action.triggered.connect(lambda checked, plane=plane: self.setViewPlane(plane))
+
+        # Wybór okna wyświetlania obrazu - okno z pliku DICOM lub jedno z predefiniowanych okien
+        self.windowActions = QActionGroup(self)
+        for name, window in [("DICOM default", None)] + list(utils.WINDOW_PRESETS.items()):
+            text = name if window is None else f"{name} (C {window[0]} / W {window[1]})"
+            action = QAction(text, self.windowActions, checkable=True)
+            action.setChecked(window is None)
+            action.triggered.connect(lambda checked, window=window: self.setDisplayWindow(window))
 
     def openCTFile(self):
         """Metoda odpowiadająca za załadowanie nowego pliku DICOM z danymi obrazowymi slice'a."""
@@ -124,16 +452,23 @@ class MainWindow(QMainWindow):
         if nextCTFile == "":  # Nic nie rób w przypadku kliknięcia 'cancel' w oknie dialogowym wyboru pliku
             return
 
-        self.setWindowTitle(self.windowTitle() + " - loading...")  # Daj znać użytkownikowi, że w tle trwa ładowanie
-        self.repaint()
+        self.loadCT(nextCTFile)
 
-        try:
-            self.plot_new_dicom_image(nextCTFile, self.currentRT)
-        except utils.NotCTImageFileException as ex:
-            self.wrongFileMessage(ex)
+    def loadCT(self, dicom_path):
+        """Uruchomienie w wątku roboczym wczytywania pliku z danymi obrazowymi i dopasowania do niego konturów."""
+        self.startWorker(LoadWorker(load_ct_task, dicom_path, self.currentRT, self.currentPatientName, self.matchMode,
+                                    self.compareRT),
+                         self.onCTLoaded)
 
-        finally:
-            self.setWindowTitle(self.windowTitle().split("-")[0].rstrip())  # Ładowanie pliku zakończone
+    def onCTLoaded(self, result):
+        """Obsługa zakończonego wczytywania pliku z danymi obrazowymi (w wątku głównym)."""
+        header, dicom = result
+        if dicom is not None:
+            self.closeReformat()
+            self.plot_new_dicom_image(dicom)
+            self.attachSeries(dicom)
+        else:
+            self.requestMatchingRTStruct(header)
 
     def openRTStructFile(self):
         """Metoda odpowiadająca za załadowanie nowego pliku DICOM z RTStruct."""
@@ -145,36 +480,40 @@ class MainWindow(QMainWindow):
         if nextRTStructFile == "":  # Nic nie rób w przypadku kliknięcia 'cancel' w oknie dialogowym wyboru pliku
             return
 
-        """Jeśli RTStruct istnieje był już wcześniej ładowany to pobierz go ze słownika w postaci krotki
-         (lista obiektów Structure, nazwa pacjenta) lub pobierz krotke (None, None)."""
-        previouslyLoaded = utils.loaded_RTStructs.get(nextRTStructFile, (None, None))
-        newRT = previouslyLoaded[0]
+        # Jeśli RTStruct był już wcześniej ładowany (również w poprzednich sesjach) to zostanie pobrany z cache'a
+        self.startWorker(LoadWorker(load_rtstruct_task, nextRTStructFile, self.rtCache, self.dicom, self.dicomIndex),
+                         self.onRTStructLoaded)
 
-        if newRT is None:  # Jeśli RTStruct nie był wcześniej ładowany to spróbuj go załadować
-            try:
-                newRT, rtPatientName = utils.read_rtstruct(nextRTStructFile)
-            except utils.NotRTStructFileException as ex:
-                self.wrongFileMessage(ex)
-                return
-            self.currentPatientName = rtPatientName
-        else:
-            self.currentPatientName = previouslyLoaded[1]
+    def onRTStructLoaded(self, result):
+        """Obsługa zakończonego wczytywania pliku RTStruct (w wątku głównym)."""
+        newRT, self.currentPatientName, matchedDicom, matched, referencedCT = result
+        if self.reformatRenderer is not None:
+            self.setViewPlane(utils.AXIAL)  # Nowe kontury wyświetlane są na slice'u w widoku osiowym
 
         self.currentRT = newRT
+        if self.navigator is not None:
+            self.navigator.set_rtstruct(newRT)
+        if self.pendingCT is not None and self.pendingCT.patient_name == self.currentPatientName:
+            # Plik z danymi obrazowymi czekał na ten RTStruct - dopiero teraz wczytujemy jego dane obrazowe
+            self.loadCT(self.pendingCT.path)
+            return
         if self.dicom is not None:  # Jest załadowany do pamięci jakiś plik DICOM z danymi obrazowymi?
             ctPatientName = self.dicom.dcm.PatientName
             if self.currentPatientName == ctPatientName:    # Plik RTStruct pasuje do pacjenta?
+                if matched is None or matchedDicom is not self.dicom:
+                    matched = self.dicom.match_structures(newRT)
                 # wykorzystaj załadowany plik ct
-                self.plot_same_dicom_image(newRT)
+                self.plot_same_dicom_image(matched)
                 return
             else:
-                # wyczyść obraz
-                self.canvas.figure.clear()
-                ax = self.canvas.figure.subplots()
-                ax.set_facecolor("#232326")
-                self.canvas.draw()
+                self.clearCanvas()  # wyczyść obraz
                 print(f"Incompatible patient's names: CT={ctPatientName} | RT={self.currentPatientName}",
                       file=sys.stderr)
+        if referencedCT is not None:
+            # Pasujący slice CT został znaleziony w indeksie - wczytaj go bez pytania użytkownika o plik
+            self.statusBar().showMessage(f"Loading referenced CT slice from the index: {referencedCT.path}", 5000)
+            self.loadCT(referencedCT.path)
+            return
 
         # Wyświetl na upperLabel komunikat do użytkownika z prośbą o wczytanie
         self.upperLabel.setText(f"Please load CT image data for patient: {self.currentPatientName}")
@@ -183,6 +522,413 @@ class MainWindow(QMainWindow):
         # Poproś o załadowanie pasującego do RTStructa pliku z danymi obrazowymi
         self.loadCTFileDialog(self.currentPatientName)
 
+    def openComparisonFile(self):
+        """Załadowanie drugiego pliku RTStruct tego samego pacjenta, którego kontury zostaną naniesione liniami
+         przerywanymi na kontury wyświetlanego RTStructa (np. segmentacja automatyczna i poprawiona przez lekarza)."""
+        if self.dicom is None or self.currentRT is None:
+            self.statusBar().showMessage("Load a CT slice and an RTStruct before opening a comparison RTStruct", 5000)
+            return
+        fileFilter = "DICOM File (*.dcm)"
+        comparisonFile = QFileDialog.getOpenFileName(parent=self, caption="Select RTStruct file to compare",
+                                                     directory=os.getcwd(), filter=fileFilter)[0]
+        if comparisonFile == "":  # Nic nie rób w przypadku kliknięcia 'cancel' w oknie dialogowym wyboru pliku
+            return
+        self.startWorker(LoadWorker(load_comparison_task, comparisonFile, self.rtCache, self.dicom),
+                         self.onComparisonLoaded)
+
+    def onComparisonLoaded(self, result):
+        """Obsługa zakończonego wczytywania porównywanego pliku RTStruct (w wątku głównym)."""
+        structures, patientName = result
+        if self.dicom is None or patientName != self.dicom.dcm.PatientName:
+            self.statusBar().showMessage(f"Comparison RTStruct belongs to another patient: {patientName}", 5000)
+            return
+        self.setViewPlane(utils.AXIAL)  # Kontury porównywane są na slice'ach w widoku osiowym
+        self.compareRT = structures
+        if self.navigator is not None:
+            self.navigator.set_comparison(structures, comparison_metric)
+        self.updateComparison()
+
+    def clearComparison(self):
+        """Usunięcie konturów porównywanego RTStructa."""
+        self.compareRT = None
+        if self.navigator is not None:
+            self.navigator.set_comparison(None)
+        self.updateComparison()
+
+    def updateComparison(self, redraw=True):
+        """
+        Narysowanie liniami przerywanymi konturów porównywanego RTStructa i wyświetlenie na pasku statusu współczynników
+        Dice'a par struktur na wyświetlanym slice'u. Kontury i współczynniki wyznaczane są w wątkach roboczych razem
+        z wczytaniem slice'a (Slice.match_comparison) - w wątku głównym tylko po zmianie sposobu dopasowania konturów
+        lub struktur wyświetlanego slice'a.
+        :param redraw: flaga decydująca, czy od razu narysować kontury (False, gdy zaraz wyświetlany jest nowy slice)
+        :return: None
+        """
+        if self.renderer is None or self.dicom is None:
+            return
+        if self.compareRT is not None and not self.dicom.comparison_matches(self.compareRT):
+            self.dicom.match_comparison(self.compareRT, comparison_metric)
+        matched = self.dicom.compared_structures if self.compareRT is not None else {}
+        self.renderer.set_overlay(matched, redraw)
+        if matched and self.dicom.comparison_scores:
+            self.statusBar().showMessage("Slice Dice: " + ", ".join(f"{name} {dice:.3f}" for name, dice
+                                                                    in self.dicom.comparison_scores.items()))
+
+    def indexFolder(self):
+        """Indeksowanie w tle nagłówków plików DICOM z wybranego katalogu (np. Temat6)."""
+        root = QFileDialog.getExistingDirectory(parent=self, caption="Select DICOM folder to index",
+                                                directory=os.getcwd())
+        if root == "":  # Nic nie rób w przypadku kliknięcia 'cancel' w oknie dialogowym wyboru katalogu
+            return
+        if self.indexWorker is not None:
+            self.indexWorker.cancel()
+        cancel = threading.Event()
+        worker = LoadWorker(index_folder_task, self.dicomIndex, root, cancel, cancelEvent=cancel)
+        self.indexWorker = worker
+        worker.signals.progress.connect(lambda percent, message: self.statusBar().showMessage(message))
+        worker.signals.finished.connect(lambda counts: self.onFolderIndexed(worker, counts))
+        worker.signals.error.connect(lambda ex: catch_exceptions(type(ex), ex, ex.__traceback__))
+        self.threadPool.start(worker)
+
+    def onFolderIndexed(self, worker, counts):
+        """Wyświetlenie podsumowania indeksowania na pasku statusu."""
+        if worker is not self.indexWorker:
+            return
+        self.indexWorker = None
+        read, unchanged, removed = counts
+        self.statusBar().showMessage(f"Index updated: {read} files read, {unchanged} unchanged, {removed} removed",
+                                     5000)
+
+    def updateTimings(self):
+        """Odświeżenie na pasku statusu czasów ostatnich wykonań etapów i skuteczności cache'y."""
+        parts = []
+        for stage, label in STATUS_STAGES:
+            duration = profiling.last(stage)
+            if duration is not None:
+                parts.append(f"{label} {duration * 1000:.0f} ms")
+        for label, counter in (("RT cache", self.rtCache), ("slice cache", self.navigator)):
+            if counter is not None and counter.hits + counter.misses > 0:
+                parts.append(f"{label} {100 * counter.hits / (counter.hits + counter.misses):.0f}%")
+        self.timingLabel.setText(" | ".join(parts))
+
+    def exportTrace(self):
+        """Eksport śladu czasów etapów bieżącej sesji do pliku JSON lub CSV."""
+        path = QFileDialog.getSaveFileName(parent=self, caption="Export timing trace", directory=os.getcwd(),
+                                           filter="JSON (*.json);;CSV (*.csv)")[0]
+        if path == "":  # Nic nie rób w przypadku kliknięcia 'cancel' w oknie dialogowym
+            return
+        events = profiling.export_trace(path)
+        self.statusBar().showMessage(f"Exported {events} timing events to {path}", 5000)
+
+    def toggleCProfile(self, checked):
+        """Włączenie lub wyłączenie zbierania profilu cProfile - po wyłączeniu profil można zapisać do pliku."""
+        if checked:
+            profiling.start_profiling()
+            self.statusBar().showMessage("cProfile capture started", 5000)
+            return
+        path = QFileDialog.getSaveFileName(parent=self, caption="Save cProfile stats", directory=os.getcwd(),
+                                           filter="pstats (*.prof)")[0]
+        profiling.stop_profiling(path or None)
+        if path:
+            self.statusBar().showMessage(f"cProfile stats saved to {path}", 5000)
+
+    def setMatchMode(self, mode):
+        """Zmiana sposobu dopasowywania konturów do slice'ów i ponowne dopasowanie konturów wyświetlanego slice'a."""
+        self.matchMode = mode
+        if self.navigator is not None:
+            self.navigator.set_rtstruct(self.currentRT, mode)
+        if self.dicom is not None and self.currentRT is not None:
+            self.dicom.match_mode = mode
+            self.plot_same_dicom_image(self.dicom.match_structures(self.currentRT))
+
+    def attachSeries(self, dicom):
+        """
+        Przygotowanie nawigacji po serii, do której należy wyświetlany slice. Nagłówki serii wczytywane są w tle.
+        :param dicom: wyświetlany obiekt klasy utils.Slice
+        :return: None
+        """
+        if self.navigator is not None and self.navigator.volume.series_uid == dicom.dcm.SeriesInstanceUID:
+            self.navigator.index = self.navigator.volume.index_by_uid.get(dicom.UID, self.navigator.index)
+            return
+        self.closeSeries()
+        worker = LoadWorker(open_series_task, dicom.file_path)
+        self.seriesWorker = worker
+        worker.signals.finished.connect(lambda volume: self.onSeriesOpened(worker, volume))
+        worker.signals.error.connect(lambda ex: print(f"Cannot open series: {ex}", file=sys.stderr))
+        self.threadPool.start(worker)
+
+    def onSeriesOpened(self, worker, volume):
+        """Utworzenie nawigatora po wczytaniu nagłówków serii (o ile wyświetlany slice nadal należy do tej serii)."""
+        if worker is not self.seriesWorker or self.dicom is None or self.dicom.UID not in volume.index_by_uid:
+            return
+        self.seriesWorker = None
+        self.navigator = utils.SeriesNavigator(volume, self.currentRT, index=volume.index_by_uid[self.dicom.UID],
+                                               match_mode=self.matchMode)
+        if self.compareRT is not None:
+            self.navigator.set_comparison(self.compareRT, comparison_metric)
+        self.statusBar().showMessage(f"Series of {len(volume)} slices - use mouse wheel or Up/Down keys to browse",
+                                     5000)
+
+    def closeSeries(self):
+        """Zakończenie nawigacji po serii (np. po wczytaniu slice'a innego pacjenta)."""
+        if self.seriesWorker is not None:
+            self.seriesWorker.cancel()
+            self.seriesWorker = None
+        self.cancelReformat()
+        if self.navigator is not None:
+            self.navigator.close()
+            self.navigator = None
+
+    def setViewPlane(self, plane):
+        """
+        Zmiana płaszczyzny wyświetlanego obrazu. Przekroje czołowe i strzałkowe wymagają zdekodowania całej serii
+        wyświetlanego slice'a - dekodowanie odbywa się w osobnym zadaniu wątku roboczego (reformatWorker), które nie
+        przerywa trwającego wczytywania pliku.
+        :param plane: płaszczyzna obrazu (utils.AXIAL, utils.CORONAL lub utils.SAGITTAL)
+        :return: None
+        """
+        self.cancelReformat()
+        if plane == utils.AXIAL:
+            if self.reformatRenderer is not None:
+                self.closeReformat()
+                self.plot_new_dicom_image(self.navigator.current() if self.navigator is not None else self.dicom)
+            return
+        if self.navigator is None:
+            self.statusBar().showMessage("Coronal and sagittal views need a loaded CT series", 5000)
+            self._checkPlaneAction(self.viewPlane)
+            return
+        worker = LoadWorker(decode_series_task, self.navigator.volume, DECODE_WORKERS, DECODE_BACKEND)
+        self.reformatWorker = worker
+        worker.signals.progress.connect(lambda percent, message: self.onReformatProgress(worker, percent, message))
+        worker.signals.finished.connect(lambda volume: self.onReformatDecoded(worker, volume, plane))
+        worker.signals.error.connect(lambda ex: self.onReformatError(worker, ex))
+        self.progressBar.setValue(0)
+        self.progressBar.setVisible(True)
+        self.threadPool.start(worker)
+
+    def onReformatProgress(self, worker, percent, message):
+        """Wyświetlenie postępu dekodowania serii - o ile pasek postępu nie jest zajęty przez wczytywanie pliku."""
+        if worker is self.reformatWorker and self.currentWorker is None:
+            self.progressBar.setValue(percent)
+            self.statusBar().showMessage(message)
+
+    def onReformatDecoded(self, worker, volume, plane):
+        """Wyświetlenie przekroju po zdekodowaniu serii (wyniki zastąpionych zadań są pomijane)."""
+        if worker is not self.reformatWorker or worker.cancelled:
+            return
+        self.cancelReformat()
+        self.showReformat(volume, plane)
+
+    def onReformatError(self, worker, ex):
+        """Obsługa wyjątku zgłoszonego w trakcie dekodowania serii."""
+        if worker is not self.reformatWorker or worker.cancelled:
+            return
+        self.cancelReformat()
+        self._checkPlaneAction(self.viewPlane)
+        catch_exceptions(type(ex), ex, ex.__traceback__)
+
+    def cancelReformat(self):
+        """Anulowanie trwającego dekodowania serii dla przekroju (np. po powrocie do widoku osiowego)."""
+        if self.reformatWorker is None:
+            return
+        self.reformatWorker.cancel()
+        self.reformatWorker = None
+        if self.currentWorker is None:  # Pasek postępu należał do dekodowania serii
+            self.progressBar.setVisible(False)
+            self.statusBar().clearMessage()
+
+    def showReformat(self, volume, plane):
+        """Wyświetlenie przekroju serii płaszczyzną plane przechodzącą przez środek obrazu (w wątku głównym)."""
+        if self.navigator is None or self.navigator.volume is not volume:
+            return  # Seria została zamknięta w trakcie dekodowania
+        index = None
+        if self.reformatRenderer is not None:
+            index = self.reformatRenderer.index if self.reformatRenderer.axis == plane else None
+        elif self.renderer is not None:
+            self.renderer.disconnect()
+            self.renderer = None
+        self.canvas.figure.clear()
+        self.viewPlane = plane
+        self._checkPlaneAction(plane)
+        self.reformatRenderer = utils.ReformatRenderer(self.canvas.figure.subplots(), volume, plane, index)
+        self.reformatRenderer.set_window(*(self.displayWindow or (None, None)))
+        self.reformatRenderer.set_structures(self.currentRT)
+        self.reformatRenderer.set_crosshair(volume.z[self.navigator.index])
+        self.statusBar().showMessage("Use mouse wheel or Up/Down keys to move the plane, drag the dashed line to "
+                                     "select the axial slice", 5000)
+
+    def closeReformat(self):
+        """Zakończenie wyświetlania przekroju - kolejny slice zostanie narysowany na nowo utworzonych osiach."""
+        if self.reformatRenderer is None:
+            return
+        self.reformatRenderer = None
+        self.crosshairDrag = False
+        self.viewPlane = utils.AXIAL
+        self._checkPlaneAction(utils.AXIAL)
+        self.canvas.figure.clear()
+
+    def _checkPlaneAction(self, plane):
+        for action, actionPlane in zip(self.planeActions.actions(), (utils.AXIAL, utils.CORONAL, utils.SAGITTAL)):
+            action.setChecked(actionPlane == plane)
+
+    def activeRenderer(self):
+        """Obiekt rysujący obecnie wyświetlany obraz (slice lub przekrój serii) lub None."""
+        if self.reformatRenderer is not None:
+            return self.reformatRenderer
+        if self.renderer is not None and self.renderer.dicom is not None:
+            return self.renderer
+        return None
+
+    def onCanvasScroll(self, event):
+        """Przewijanie slice'ów serii kółkiem myszy."""
+        self.stepSlice(1 if event.button == "up" else -1)
+
+    def onCanvasKey(self, event):
+        """Przewijanie slice'ów serii klawiszami Up/Down (o 1 slice) i PageUp/PageDown (o 10 slice'ów)."""
+        steps = {"up": 1, "down": -1, "pageup": 10, "pagedown": -10}
+        if event.key in steps:
+            self.stepSlice(steps[event.key])
+
+    def setDisplayWindow(self, window):
+        """
+        Zmiana okna wyświetlania obrazu - podmieniane są jedynie dane obrazu, bez przebudowy rysunku.
+        :param window: okno (środek, szerokość) [HU] lub None - okno zapisane w pliku DICOM slice'a
+        :return: None
+        """
+        self.displayWindow = window
+        renderer = self.activeRenderer()
+        if renderer is not None:
+            renderer.set_window(*(window or (None, None)))
+
+    def onCanvasPress(self, event):
+        """
+        Rozpoczęcie zmiany okna wyświetlania prawym przyciskiem myszy lub (na przekroju) przeciągania lewym przyciskiem
+        linii położenia slice'a osiowego - gdy nie jest aktywne narzędzie toolbara.
+        """
+        renderer = self.activeRenderer()
+        if self.toolbar.mode or renderer is None:
+            return
+        if event.button == 3:
+            self.windowDrag = (event.x, event.y, *renderer.current_window())
+        elif event.button == 1 and self.reformatRenderer is not None and event.inaxes is self.reformatRenderer.axes:
+            self.crosshairDrag = True
+            self.onCanvasDrag(event)
+
+    def onCanvasDrag(self, event):
+        """Przeciąganie w poziomie zmienia szerokość okna, a w pionie - jego środek. Na przekroju przeciąganie lewym
+         przyciskiem wybiera slice wyświetlany po powrocie do widoku osiowego."""
+        if self.crosshairDrag and event.ydata is not None and self.navigator is not None:
+            volume = self.navigator.volume
+            self.navigator.index = int(np.abs(volume.z - event.ydata).argmin())
+            self.reformatRenderer.set_crosshair(volume.z[self.navigator.index])
+            self.statusBar().showMessage(f"Axial slice {self.navigator.index + 1}/{len(volume)}: "
+                                         f"z = {volume.z[self.navigator.index]:.1f}mm")
+            return
+        if self.windowDrag is None:
+            return
+        x, y, center, width = self.windowDrag
+        center += (event.y - y) * WINDOW_DRAG_SENSITIVITY
+        width = max(width + (event.x - x) * WINDOW_DRAG_SENSITIVITY, 1.0)
+        self.setDisplayWindow((center, width))
+        self.statusBar().showMessage(f"Window: C {center:.0f} / W {width:.0f}")
+
+    def onCanvasRelease(self, event):
+        """Zakończenie zmiany okna wyświetlania lub przeciągania linii położenia slice'a osiowego."""
+        self.crosshairDrag = False
+        if self.windowDrag is not None:
+            self.windowDrag = None
+            for action in self.windowActions.actions():
+                action.setChecked(False)  # Okno ustawione ręcznie nie odpowiada żadnemu z predefiniowanych okien
+
+    def stepSlice(self, delta):
+        """Wyświetlenie slice'a przesuniętego o delta względem bieżącego w obrębie serii (lub przesunięcie płaszczyzny
+         wyświetlanego przekroju o delta wierszy/kolumn obrazu)."""
+        if self.reformatRenderer is not None:
+            self.reformatRenderer.step(delta)
+            self.statusBar().showMessage(f"{self.viewPlane.capitalize()} plane {self.reformatRenderer.index + 1}/"
+                                         f"{self.navigator.volume.plane_count(self.viewPlane)}")
+            return
+        if self.navigator is None or self.dicom is None or self.currentWorker is not None:
+            return
+        # Slice spoza bufora wczytywany jest w tle - do tego czasu wyświetlany jest bieżący slice
+        navigator = self.navigator
+        dicom = navigator.step_async(delta, lambda index, future: self.sliceLoaded.emit(navigator, index, future))
+        if dicom is None:
+            self.statusBar().showMessage(f"Loading slice {navigator.index + 1}/{len(navigator.volume)}...")
+        elif dicom is not self.dicom:
+            self.plot_new_dicom_image(dicom)
+
+    def onSliceLoaded(self, navigator, index, future):
+        """Wyświetlenie slice'a wczytanego w tle - tylko jeśli nadal jest to ostatnio wybrany slice serii (kolejne kroki
+         przewijania w trakcie wczytywania unieważniają wcześniejsze)."""
+        if navigator is not self.navigator or index != navigator.index or self.reformatRenderer is not None:
+            return
+        if self.dicom is None or self.currentWorker is not None:
+            return
+        try:
+            dicom = future.result()  # Wczytywanie jest zakończone - bez czekania
+        except Exception as ex:
+            catch_exceptions(type(ex), ex, ex.__traceback__)
+            return
+        self.statusBar().clearMessage()
+        if dicom is not self.dicom:
+            self.plot_new_dicom_image(dicom)
+
+    def startWorker(self, worker, onFinished):
+        """
+        Uruchomienie zadania w puli wątków roboczych. Trwające zadanie zostaje anulowane - jego wynik nie jest już
+        potrzebny, bo użytkownik wybrał w międzyczasie inny plik.
+        :param worker: obiekt klasy LoadWorker
+        :param onFinished: metoda wywoływana w wątku głównym z wynikiem zadania
+        :return: None
+        """
+        if self.currentWorker is not None:
+            self.currentWorker.cancel()
+        self.currentWorker = worker
+        worker.signals.progress.connect(lambda percent, message: self.onWorkerProgress(worker, percent, message))
+        worker.signals.finished.connect(lambda result: self.onWorkerFinished(worker, onFinished, result))
+        worker.signals.error.connect(lambda ex: self.onWorkerError(worker, ex))
+        self.progressBar.setValue(0)
+        self.progressBar.setVisible(True)
+        self.threadPool.start(worker)
+
+    def onWorkerProgress(self, worker, percent, message):
+        """Wyświetlenie postępu trwającego zadania na pasku statusu."""
+        if worker is self.currentWorker:
+            self.progressBar.setValue(percent)
+            self.statusBar().showMessage(message)
+
+    def onWorkerFinished(self, worker, onFinished, result):
+        """Przekazanie wyniku zadania do metody onFinished - wyniki zadań zastąpionych nowszymi są pomijane."""
+        if worker is not self.currentWorker or worker.cancelled:
+            return
+        self.finishWorker()
+        onFinished(result)
+
+    def onWorkerError(self, worker, ex):
+        """Obsługa wyjątku zgłoszonego w zadaniu wątku roboczego."""
+        if worker is not self.currentWorker or worker.cancelled:
+            return
+        self.finishWorker()
+        if isinstance(ex, utils.WrongDICOMFileException):
+            self.wrongFileMessage(ex)
+        else:
+            catch_exceptions(type(ex), ex, ex.__traceback__)
+
+    def finishWorker(self):
+        """Ukrycie paska postępu po zakończeniu zadania (chyba że nadal trwa dekodowanie serii dla przekroju)."""
+        self.currentWorker = None
+        if self.reformatWorker is None:
+            self.progressBar.setVisible(False)
+            self.statusBar().clearMessage()
+
+    def closeEvent(self, event):
+        """Przerwanie indeksowania i zapis zaległych zmian indeksu cache'a RTStructów przy zamknięciu okna."""
+        if self.indexWorker is not None:
+            self.indexWorker.cancel()
+        self.rtCache.close()
+        QMainWindow.closeEvent(self, event)
+
     def wrongFileMessage(self, ex):
         """Metoda wyświetlająca okienko dialogowe w przypadku załadowania nieprawidłowego pliku."""
         errorMessage = QMessageBox()
@@ -230,56 +976,73 @@ class MainWindow(QMainWindow):
         if i.text() == "Open":
             self.openRTStructFile()
 
-    def plot_new_dicom_image(self, dicom_path, rt_struct):
+    def plot_new_dicom_image(self, dicom):
         """
-        Metoda odpowiedzialna za załadowanie i wyświetlenie nowego slice'a wraz z konturami struktur pobranymi
-        z pliku RTStruct.
-        :param dicom_path: ścieżka do pliku DICOM z danymi obrazowymi
-        :param rt_struct: ścieżka do pliku DICOM z danymi RTStruct
-        :return: nowo utworzony obiekt klasy utils.Slice
+        Metoda odpowiedzialna za wyświetlenie nowego slice'a wraz z dopasowanymi do niego konturami struktur.
+        :param dicom: obiekt klasy utils.Slice wczytany i dopasowany do RTStructa w wątku roboczym
+        :return: wyświetlany obiekt klasy utils.Slice
         """
         # if not self.isImageSet:
             # self.upperLabel.setText("/".join(dicom_path.split("/")[-4:]))
 
-        self.dicom = utils.Slice(dicom_path)
-        self.dicom_path = dicom_path
-        ctPatientName = self.dicom.dcm.PatientName
-        if ctPatientName == self.currentPatientName:    # Pacjent w RTStruct zgodny za pacjentem z danych obrazowych?
-            self.dicom.load_RTStruct(rt_struct)     # Wczytaj kontury struktur do utworzonego obiektu Slice
-            self.canvas.figure.clear()
-            ax = self.canvas.figure.subplots()
-            self.dicom.set_axes(ax)
-            self.dicom.draw_structures()    # Wyświetl obraz slice'a wraz z naniesionymi konturami struktur
-            self.canvas.draw()
-            self.setLabel(self.dicom_path)
-        else:   # Wyczyść płótno i poproś o załadowanie pasującego pliku DICOM z danymi RTStruct
-            self.currentPatientName = ctPatientName
-            # wyczyść obraz
+        self.dicom = dicom
+        self.dicom_path = dicom.file_path
+        self.pendingCT = None
+        if self.renderer is None:   # Osie tworzone są tylko raz - kolejne slice'y podmieniają jedynie dane obrazu
             self.canvas.figure.clear()
-            ax = self.canvas.figure.subplots()
-            ax.set_facecolor("#232326")
-            self.upperLabel.setText(f"Please load RTStruct contour data for patient: {ctPatientName}")
-            # self.upperLabel.setVisible(True)
-            # self.isImageSet = False
-            self.canvas.draw()
-            print(f"Incompatible patient's names: CT={ctPatientName} | RT={self.currentPatientName}",
-                  file=sys.stderr)
-            self.loadRTStructFileDialog(ctPatientName)
-
+            self.renderer = utils.SliceRenderer(self.canvas.figure.subplots())
+            self.renderer.window = self.displayWindow
+        self.dicom.set_axes(self.renderer.axes)
+        self.updateComparison(redraw=False)
+        self.renderer.show(self.dicom)    # Wyświetl obraz slice'a wraz z naniesionymi konturami struktur
+        self.setLabel(self.dicom_path)
         return self.dicom
 
-    def plot_same_dicom_image(self, rt_struct):
-        """Metoda odpowiedzialna za załadowanie danych RTStruct do obecnie załadowanego slice'a i wyświetlenie na nim
-         nowo naniesionych konturów."""
+    def requestMatchingRTStruct(self, header):
+        """
+        Metoda czyszcząca płótno i proszącą o załadowanie pliku RTStruct pasującego do wybranego pliku z danymi
+        obrazowymi (dane obrazowe tego pliku nie zostały jeszcze wczytane).
+        :param header: metadane (utils.DicomHeader) wybranego pliku z danymi obrazowymi
+        :return: None
+        """
+        ctPatientName = header.patient_name
+        self.currentPatientName = ctPatientName
+        self.dicom = None
+        self.pendingCT = header
+        self.upperLabel.setText(f"Please load RTStruct contour data for patient: {ctPatientName}")
+        # self.upperLabel.setVisible(True)
+        # self.isImageSet = False
+        self.clearCanvas()  # wyczyść obraz
+        print(f"Incompatible patient's names: CT={ctPatientName} | RT={self.currentPatientName}",
+              file=sys.stderr)
+        self.loadRTStructFileDialog(ctPatientName)
+
+    def plot_same_dicom_image(self, matched):
+        """Metoda odpowiedzialna za podmianę struktur obecnie załadowanego slice'a na struktury dopasowane z nowego
+         RTStructa i wyświetlenie na nim nowo naniesionych konturów.
+        :param matched: słownik struktur dopasowanych do slice'a (wynik utils.Slice.match_structures)
+        """
 
         # if not self.isImageSet:
         self.setLabel(self.dicom_path)
 
-        self.dicom.load_RTStruct(rt_struct)
+        self.dicom.structures = matched
+        # Podmiana samych konturów na niezmienionym obrazie slice'a
+        self.renderer.set_structures(matched, random.uniform(1, 2))  # losowa grubosc konturów żeby było widać zmianę RTStructa
+        self.dicom.compared_rtstruct = None  # Współczynniki Dice'a dotyczyły poprzednich struktur slice'a
+        self.updateComparison()
+
+    def clearCanvas(self):
+        """Wyczyszczenie płótna - kolejny slice zostanie narysowany na nowo utworzonych osiach."""
+        self.closeSeries()
+        self.closeReformat()
+        self.compareRT = None
+        if self.renderer is not None:
+            self.renderer.disconnect()
+            self.renderer = None
         self.canvas.figure.clear()
         ax = self.canvas.figure.subplots()
-        self.dicom.set_axes(ax)
-        self.dicom.draw_structures(random.uniform(1, 2))  # losowa grubosc konturów żeby było widać zmianę RTStructa
+        ax.set_facecolor("#232326")
         self.canvas.draw()
 
     def setLabel(self, path):
@@ -0,0 +1,191 @@
+import cProfile
+import csv
+import functools
+import json
+import pstats
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+"""Moduł z lekką instrumentacją czasu wykonania etapów wczytywania, dopasowywania i rysowania danych.
+
+Etapy oznaczane są dekoratorem timed lub menedżerem kontekstu stage. Każde wykonanie etapu zapisywane jest w śladzie
+sesji (nazwa etapu, czas rozpoczęcia, czas trwania, wątek), a dla każdego etapu przechowywane są statystyki: liczba
+wykonań, łączny i ostatni czas trwania. Koszt pomiaru to dwa odczyty zegara i jedno dodanie do kolejki - instrumentacja
+jest włączona na stałe. Ślad sesji można wyeksportować do pliku JSON lub CSV.
+
+Opcjonalnie można włączyć zbieranie profilu cProfile - profilowany jest wątek, który włączył zbieranie, oraz zadania
+uruchamiane przez funkcję profile_call (np. zadania wątków roboczych GUI). Zebrane profile łączone są w jeden plik pstats.
+
+Wymagane zewnętrzne biblioteki
+-----------------------------
+brak (tylko biblioteka standardowa)
+"""
+
+# Maksymalna liczba zdarzeń przechowywanych w śladzie sesji (najstarsze zdarzenia są usuwane)
+MAX_TRACE_EVENTS = 100000
+
+_lock = threading.Lock()
+_session_start = time.perf_counter()
+_trace = deque(maxlen=MAX_TRACE_EVENTS)
+_stats = {}
+
+# Stan zbierania profilu cProfile
+_profile = None
+_worker_profiles = []
+
+
+def record(name: str, start: float, duration: float):
+    """
+    Zapis wykonania etapu w śladzie sesji i w statystykach etapu.
+    :param name: nazwa etapu
+    :param start: czas rozpoczęcia (time.perf_counter)
+    :param duration: czas trwania [s]
+    :return: None
+    """
+    with _lock:
+        _trace.append((name, start - _session_start, duration, threading.current_thread().name))
+        count, total, _ = _stats.get(name, (0, 0.0, 0.0))
+        _stats[name] = (count + 1, total + duration, duration)
+
+
+@contextmanager
+def stage(name: str):
+    """Menedżer kontekstu mierzący czas wykonania bloku kodu jako etapu name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start, time.perf_counter() - start)
+
+
+def timed(name: str = None):
+    """
+    Dekorator mierzący czas wykonania funkcji jako etapu.
+    :param name: nazwa etapu (domyślnie kwalifikowana nazwa funkcji)
+    :return: dekorator
+    """
+    def decorator(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(stage_name, start, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def summary():
+    """
+    Statystyki wszystkich etapów.
+    :return: słownik {nazwa etapu: (liczba wykonań, łączny czas [s], czas ostatniego wykonania [s])}
+    """
+    with _lock:
+        return dict(_stats)
+
+
+def last(name: str):
+    """Czas ostatniego wykonania etapu [s] lub None, jeśli etap nie był jeszcze wykonany."""
+    with _lock:
+        entry = _stats.get(name)
+    return entry[2] if entry is not None else None
+
+
+def reset():
+    """Wyczyszczenie śladu i statystyk sesji."""
+    global _session_start
+    with _lock:
+        _trace.clear()
+        _stats.clear()
+        _session_start = time.perf_counter()
+
+
+def export_trace(path: str):
+    """
+    Eksport śladu sesji do pliku - format wybierany jest na podstawie rozszerzenia (.csv lub JSON dla pozostałych).
+    Plik JSON zawiera dodatkowo statystyki etapów.
+    :param path: ścieżka pliku
+    :return: liczba wyeksportowanych zdarzeń
+    """
+    with _lock:
+        events = list(_trace)
+        stats = dict(_stats)
+    if path.lower().endswith(".csv"):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["stage", "start_s", "duration_s", "thread"])
+            writer.writerows(events)
+    else:
+        with open(path, "w") as f:
+            json.dump({"events": [dict(zip(("stage", "start_s", "duration_s", "thread"), event)) for event in events],
+                       "stages": {name: {"count": count, "total_s": total, "last_s": last_duration}
+                                  for name, (count, total, last_duration) in stats.items()}}, f, indent=1)
+    return len(events)
+
+
+def is_profiling():
+    """Sprawdzenie, czy trwa zbieranie profilu cProfile."""
+    return _profile is not None
+
+
+def start_profiling():
+    """Włączenie zbierania profilu cProfile w bieżącym wątku i w zadaniach uruchamianych przez profile_call."""
+    global _profile
+    if _profile is not None:
+        return
+    _worker_profiles.clear()
+    _profile = cProfile.Profile()
+    _profile.enable()
+
+
+def stop_profiling(path: str = None):
+    """
+    Wyłączenie zbierania profilu cProfile.
+    :param path: ścieżka pliku, do którego zapisywany jest połączony profil (format pstats) - opcjonalnie
+    :return: obiekt pstats.Stats z połączonym profilem lub None, jeśli profil nie był zbierany
+    """
+    global _profile
+    if _profile is None:
+        return None
+    _profile.disable()
+    with _lock:
+        profiles = [_profile] + _worker_profiles
+        _worker_profiles.clear()
+    _profile = None
+    stats = None
+    for profile in profiles:
+        try:
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        except TypeError:  # Profil bez żadnych wywołań
+            continue
+    if stats is not None and path:
+        stats.dump_stats(path)
+    return stats
+
+
+def profile_call(func, *args, **kwargs):
+    """
+    Wywołanie funkcji - w trakcie zbierania profilu cProfile pod kontrolą osobnego profilera (np. w wątku roboczym).
+    Jeśli interpreter nie pozwala na kilka aktywnych profilerów jednocześnie, funkcja wywoływana jest bez profilowania.
+    """
+    if _profile is None:
+        return func(*args, **kwargs)
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        return func(*args, **kwargs)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profile.disable()
+        with _lock:
+            _worker_profiles.append(profile)
@@ -0,0 +1,249 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+import rtstruct_cache
+import utils
+
+"""Moduł rasteryzujący kontury struktur do masek binarnych na siatce pikseli obrazu CT.
+
+Kontury rasteryzowane są regułą parzystości (even-odd) metodą linii skanujących: dla każdej krawędzi konturu
+wyznaczane są punkty jej przecięcia ze środkami kolejnych wierszy pikseli, a piksel leży wewnątrz struktury, jeśli
+na lewo od jego środka leży nieparzysta liczba przecięć. Wszystkie krawędzie wszystkich konturów struktury na slice'u
+przetwarzane są jednocześnie operacjami na macierzach numpy (bez pętli po pikselach ani po konturach), a dzięki regule
+parzystości kontury wewnętrzne (dziury) wycinane są z masek automatycznie.
+
+Cała seria rasteryzowana jest równolegle (slice'y rozdzielane między procesy robocze). Wynik można zapisać do
+skompresowanego pliku .npz lub bezpośrednio do zmapowanego w pamięci pliku .npy.
+
+Przykład użycia:
+    python rasterize.py CT_DIR RTSTRUCT_FILE masks.npz --workers 8
+    python rasterize.py CT_DIR RTSTRUCT_FILE labels.npy --labels
+
+Wymagane zewnętrzne biblioteki
+-----------------------------
+numpy
+"""
+
+# Struktury z pliku RTStruct i geometria slice'ów przekazywane jednorazowo do każdego procesu roboczego
+_worker_rtstruct = None
+_worker_headers = None
+_worker_options = None
+
+
+def rasterize_contours(points, offsets, shape):
+    """
+    Funkcja rasteryzująca kontury (w układzie współrzędnych pikseli) do maski binarnej regułą parzystości.
+    Kontur nie musi być domknięty - krawędź między ostatnim i pierwszym punktem konturu dodawana jest automatycznie.
+    Piksel (wiersz, kolumna) ma środek w punkcie (x=kolumna, y=wiersz), tak jak na obrazie rysowanym przez imshow.
+    :param points: macierz N x 2 punktów (x, y) kolejnych konturów
+    :param offsets: indeksy początków kolejnych konturów w macierzy points (+ indeks końca ostatniego konturu)
+    :param shape: rozmiar maski (liczba wierszy, liczba kolumn)
+    :return: maska binarna o rozmiarze shape
+    """
+    rows, cols = shape
+    if len(points) == 0:
+        return np.zeros(shape, dtype=bool)
+
+    # Krawędzie konturów: punkt i -> punkt i + 1, a dla ostatniego punktu konturu -> pierwszy punkt konturu
+    following = np.arange(1, len(points) + 1)
+    following[offsets[1:] - 1] = offsets[:-1]
+    x0, y0 = points[:, 0], points[:, 1]
+    x1, y1 = points[following, 0], points[following, 1]
+
+    # Krawędź przecina środki wierszy r spełniających min(y0, y1) <= r < max(y0, y1) (krawędzie poziome - żadnego)
+    first_row = np.clip(np.ceil(np.minimum(y0, y1)), 0, rows).astype(np.int64)
+    stop_row = np.clip(np.ceil(np.maximum(y0, y1)), 0, rows).astype(np.int64)
+    crossings = np.maximum(stop_row - first_row, 0)
+    total = int(crossings.sum())
+    if total == 0:
+        return np.zeros(shape, dtype=bool)
+
+    # Rozwinięcie krawędzi do listy przecięć (krawędź, wiersz) - jedna pozycja na każde przecięcie
+    edge = np.repeat(np.arange(len(points)), crossings)
+    starts = np.cumsum(crossings) - crossings
+    row = first_row[edge] + np.arange(total) - np.repeat(starts, crossings)
+    x = x0[edge] + (row - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+
+    # Przecięcie w punkcie x przełącza przynależność wszystkich pikseli o środkach na prawo od x
+    column = np.clip(np.floor(x).astype(np.int64) + 1, 0, cols)
+    toggles = np.bincount(row * (cols + 1) + column, minlength=rows * (cols + 1)).reshape(rows, cols + 1)
+    return (np.cumsum(toggles[:, :cols], axis=1) & 1).astype(bool)
+
+
+def structure_mask(structure, shape):
+    """
+    Maska binarna struktury dopasowanej do slice'a (kontury w układzie współrzędnych pikseli - wynik
+    Slice.add_structure / Slice.match_structure).
+    :param structure: obiekt klasy Structure z konturami w układzie współrzędnych pikseli
+    :param shape: rozmiar maski (liczba wierszy, liczba kolumn)
+    :return: maska binarna o rozmiarze shape
+    """
+    return rasterize_contours(structure.points, structure.offsets, shape)
+
+
+def slice_masks(dicom):
+    """
+    Maski binarne wszystkich struktur załadowanych do slice'a.
+    :param dicom: obiekt klasy Slice z załadowanymi strukturami
+    :return: słownik {numer struktury: maska binarna}
+    """
+    shape = (dicom.dcm.Rows, dicom.dcm.Columns)
+    return {number: structure_mask(structure, shape) for number, structure in dicom.structures.items()}
+
+
+def label_map(masks, numbers, out=None):
+    """
+    Funkcja łącząca maski binarne struktur w jedną mapę etykiet - piksel przyjmuje numer struktury (ROINumber),
+    do której należy, a 0 poza strukturami. Przy nakładaniu się struktur wygrywa struktura późniejsza na liście.
+    Działa zarówno dla masek 2D (slice), jak i 3D (seria).
+    :param masks: macierz masek binarnych kolejnych struktur (pierwszy wymiar - struktura)
+    :param numbers: numery kolejnych struktur
+    :param out: macierz wynikowa (np. zmapowana w pamięci), domyślnie tworzona nowa macierz uint16
+    :return: mapa etykiet
+    """
+    if out is None:
+        out = np.zeros(masks.shape[1:], dtype=np.uint16)
+    else:
+        out[...] = 0
+    for mask, number in zip(masks, numbers):
+        out[mask] = number
+    return out
+
+
+def _init_worker(rtstruct, headers, options):
+    """Inicjalizacja procesu roboczego - zapamiętanie struktur, nagłówków slice'ów i parametrów rasteryzacji."""
+    global _worker_rtstruct, _worker_headers, _worker_options
+    _worker_rtstruct = rtstruct
+    _worker_headers = headers
+    _worker_options = options
+
+
+def _rasterize_slice(index):
+    """
+    Rasteryzacja wszystkich struktur jednego slice'a serii (wywoływane w procesie roboczym).
+    :param index: indeks slice'a w serii
+    :return: indeks slice'a, maski kolejnych struktur spakowane bitowo wzdłuż wierszy (np.packbits)
+    """
+    dicom = utils.Slice(index=index, header=_worker_headers[index])
+    dicom.match_mode = _worker_options["match_mode"]
+    shape = (dicom.dcm.Rows, dicom.dcm.Columns)
+    masks = np.zeros((len(_worker_rtstruct),) + shape, dtype=bool)
+    for i, structure in enumerate(_worker_rtstruct):
+        matched = dicom.match_structure(structure)
+        if matched is not None:
+            masks[i] = structure_mask(matched, shape)
+    # Spakowanie masek zmniejsza 8-krotnie ilość danych przesyłanych między procesami
+    return index, np.packbits(masks, axis=-1)
+
+
+def rasterize_series(volume, rtstruct, workers: int = None, match_mode: str = utils.MATCH_UID_Z, out=None,
+                     progress=None):
+    """
+    Funkcja rasteryzująca kontury wszystkich struktur na wszystkich slice'ach serii. Do dopasowania konturów potrzebne
+    są wyłącznie nagłówki slice'ów - dane obrazowe serii nie są dekodowane.
+    :param volume: obiekt klasy utils.Volume
+    :param rtstruct: lista obiektów klasy Structure utworzona na podstawie pliku DICOM z danymi RTStruct
+    :param workers: liczba procesów roboczych (domyślnie liczba rdzeni procesora, 1 - bez puli procesów)
+    :param match_mode: sposób dopasowywania konturów do slice'ów (Slice.match_mode)
+    :param out: macierz wynikowa bool o rozmiarze (liczba struktur, liczba slice'ów, wiersze, kolumny), np. zwrócona
+     przez open_masks_memmap (domyślnie tworzona w pamięci)
+    :param progress: funkcja wywoływana po każdym slice'u z argumentami (liczba gotowych slice'ów, liczba slice'ów)
+    :return: macierz masek binarnych (struktura, slice, wiersz, kolumna)
+    """
+    shape = (len(rtstruct),) + volume.shape
+    if out is None:
+        out = np.zeros(shape, dtype=bool)
+    elif out.shape != shape:
+        raise ValueError(f"Output array has shape {out.shape}, expected {shape}")
+
+    options = {"match_mode": match_mode}
+    indices = range(len(volume))
+    if workers == 1:
+        _init_worker(rtstruct, volume.headers, options)
+        results = map(_rasterize_slice, indices)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(rtstruct, volume.headers, options))
+        results = pool.imap_unordered(_rasterize_slice, indices, chunksize=4)
+    try:
+        for done, (index, packed) in enumerate(results, 1):
+            out[:, index] = np.unpackbits(packed, axis=-1, count=volume.shape[2]).astype(bool)
+            if progress is not None:
+                progress(done, len(volume))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return out
+
+
+def open_masks_memmap(path, shape, dtype=bool):
+    """
+    Utworzenie pliku .npy zmapowanego w pamięci - maski serii zapisywane są bezpośrednio na dysk zamiast do pamięci RAM.
+    :param path: ścieżka pliku .npy
+    :param shape: rozmiar macierzy (np. (liczba struktur, liczba slice'ów, wiersze, kolumny) lub rozmiar mapy etykiet)
+    :param dtype: typ danych macierzy (bool dla masek, np.uint16 dla mapy etykiet)
+    :return: macierz np.memmap
+    """
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+
+def save_masks_npz(path, masks, rtstruct, labels=None):
+    """
+    Zapis masek serii do skompresowanego pliku .npz razem z nazwami i numerami struktur.
+    :param path: ścieżka pliku .npz
+    :param masks: macierz masek binarnych (struktura, slice, wiersz, kolumna)
+    :param rtstruct: lista obiektów klasy Structure w kolejności pierwszego wymiaru masks
+    :param labels: opcjonalna mapa etykiet serii (wynik label_map)
+    :return: None
+    """
+    arrays = {"masks": masks,
+              "roi_names": np.array([str(structure.name) for structure in rtstruct]),
+              "roi_numbers": np.array([int(structure.number) for structure in rtstruct], dtype=np.int64)}
+    if labels is not None:
+        arrays["labels"] = labels
+    np.savez_compressed(path, **arrays)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rasterize RTStruct contours to binary masks on the CT pixel grid.")
+    parser.add_argument("ct_dir", help="directory with the DICOM files of the CT series")
+    parser.add_argument("rtstruct_path", help="DICOM RTStruct file")
+    parser.add_argument("output", help="output file: .npz (compressed) or .npy (memory-mapped)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("--labels", action="store_true",
+                        help="add a multi-label volume of ROI numbers (.npz) or write it instead of the masks (.npy)")
+    args = parser.parse_args()
+
+    cache = rtstruct_cache.RTStructCache()
+    structures, _ = cache.load(args.rtstruct_path)
+    cache.close()
+    volume = utils.Volume(args.ct_dir)
+    shape = (len(structures),) + volume.shape
+    to_npy = os.path.splitext(args.output)[1] == ".npy"
+    numbers = [structure.number for structure in structures]
+
+    start = time.perf_counter()
+    out = open_masks_memmap(args.output, shape) if to_npy and not args.labels else None
+    masks = rasterize_series(volume, structures, args.workers, out=out,
+                             progress=lambda done, total: print(f"\rRasterized {done}/{total} slices", end="",
+                                                                file=sys.stderr))
+    print(file=sys.stderr)
+    if to_npy and args.labels:
+        label_map(masks, numbers, out=open_masks_memmap(args.output, volume.shape, np.uint16)).flush()
+    elif to_npy:
+        masks.flush()
+    else:
+        save_masks_npz(args.output, masks, structures, label_map(masks, numbers) if args.labels else None)
+    volume.close()
+    print(f"Rasterized {len(structures)} structures on {len(volume)} slices in {time.perf_counter() - start:.1f}s")
+    for structure, mask in zip(structures, masks):
+        print(f"  {structure.number:>4} {structure.name}: {int(mask.sum())} voxels")
+
+
+if __name__ == "__main__":
+    main()
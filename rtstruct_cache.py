@@ -0,0 +1,443 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows - blokada pliku przez msvcrt
+    fcntl = None
+    import msvcrt
+
+import profiling
+import utils
+
+"""Moduł implementujący trwały (dyskowy) cache sparsowanych plików RTStruct.
+
+Przetwarzanie pliku RTStruct jest najwolniejszą operacją w programie, dlatego raz sparsowane struktury zapisywane są
+na dysku w zwartym formacie binarnym (płaskie macierze float z punktami konturów + macierze offsetów) i przy kolejnym
+otwarciu tego samego pliku - również w nowej sesji programu - wczytywane są bezpośrednio z cache'a.
+Wpis w cache'u identyfikowany jest przez ścieżkę pliku, jego rozmiar, czas modyfikacji i SOPInstanceUID, więc zmiana
+pliku na dysku automatycznie unieważnia odpowiadający mu wpis. Przy przekroczeniu limitu rozmiaru cache'a usuwane są
+najdawniej używane wpisy (LRU).
+
+Z jednego katalogu cache'a może korzystać jednocześnie kilka procesów (GUI, narzędzia wsadowe). Indeks zapisywany jest
+pod blokadą pliku index.lock - przed zapisem łączony jest z indeksem na dysku, więc wpisy dodane przez inne procesy
+nie giną, a pliki wpisów nieobecnych w indeksie usuwane są przy usuwaniu najdawniej używanych wpisów. Czasy ostatniego
+użycia wpisów zapisywane są na dysk najwyżej raz na INDEX_FLUSH_INTERVAL sekund (oraz przy zapisie nowego wpisu
+i metodą close), a nie przy każdym odczycie z cache'a.
+
+Wymagane zewnętrzne biblioteki
+-----------------------------
+numpy
+"""
+
+# Zmienne środowiskowe pozwalające skonfigurować cache bez zmiany kodu
+CACHE_DIR_ENV = "RTSTRUCT_CACHE_DIR"
+CACHE_SIZE_ENV = "RTSTRUCT_CACHE_SIZE_MB"
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "rtstruct_on_ct")
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024  # 1 GB
+
+INDEX_FILE_NAME = "index.json"
+LOCK_FILE_NAME = "index.lock"
+# Minimalny odstęp [s] między zapisami indeksu wywołanymi wyłącznie odczytami z cache'a (zmianą czasów użycia wpisów)
+INDEX_FLUSH_INTERVAL = 30.0
+FORMAT_VERSION = 2
+
+
+class RTStructCache:
+    """Klasa reprezentująca dyskowy cache sparsowanych plików RTStruct z pamięciowym cache'em ostatnio używanych wpisów.
+
+    Atrybuty
+    --------
+    cache_dir: str
+        katalog, w którym przechowywane są wpisy cache'a oraz ich indeks
+    max_bytes: int
+        maksymalny łączny rozmiar wpisów cache'a na dysku
+    memory_entries: int
+        liczba ostatnio używanych RTStructów przechowywanych dodatkowo w pamięci procesu
+    streaming: bool
+        flaga decydująca, czy pliki nieobecne w cache'u parsować strumieniowo (utils.read_rtstruct)
+    read_only: bool
+        flaga decydująca, czy cache jest tylko do odczytu - nowe wpisy trafiają wyłącznie do pamięci procesu, a indeks
+        i pliki wpisów na dysku nie są modyfikowane (np. w procesach roboczych korzystających z jednego katalogu cache'a)
+    hits: int
+        liczba odczytów obsłużonych przez cache
+    misses: int
+        liczba odczytów wymagających sparsowania pliku RTStruct
+    """
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = None, memory_entries: int = 4,
+                 streaming: bool = True, read_only: bool = False):
+        """
+        Inicjalizacja obiektu klasy RTStructCache
+        :param cache_dir: katalog cache'a (domyślnie zmienna środowiskowa RTSTRUCT_CACHE_DIR lub ~/.cache/rtstruct_on_ct)
+        :param max_bytes: limit rozmiaru cache'a w bajtach (domyślnie zmienna środowiskowa RTSTRUCT_CACHE_SIZE_MB lub 1 GB)
+        :param memory_entries: liczba RTStructów przechowywanych dodatkowo w pamięci procesu
+        :param streaming: flaga decydująca, czy pliki nieobecne w cache'u parsować strumieniowo
+        :param read_only: flaga decydująca, czy cache na dysku jest tylko do odczytu
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get(CACHE_DIR_ENV, DEFAULT_CACHE_DIR)
+        if max_bytes is None:
+            size_mb = os.environ.get(CACHE_SIZE_ENV)
+            max_bytes = int(float(size_mb) * 1024 * 1024) if size_mb else DEFAULT_MAX_BYTES
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.streaming = streaming
+        self.read_only = read_only
+        self.hits = self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.RLock()  # Cache może być używany jednocześnie przez kilka wątków roboczych GUI
+        self._removed = set()  # Wpisy usunięte przez ten proces od ostatniego zapisu indeksu
+        self._dirty = False  # Czasy użycia wpisów zmienione od ostatniego zapisu indeksu
+        self._flushed = time.time()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._index = self._read_index()
+
+    def __repr__(self):
+        return f"<cache_dir={self.cache_dir}, entries={len(self._index)}, size={self.size_bytes()}B>"
+
+    @profiling.timed("RTStructCache.load")
+    def load(self, rt_structure_filename):
+        """
+        Metoda zwracająca struktury z pliku RTStruct - z cache'a, a w razie jego braku po sparsowaniu pliku
+        funkcją utils.read_rtstruct (wynik parsowania jest zapisywany w cache'u).
+        :param rt_structure_filename: ścieżka do pliku DICOM z danymi RTStruct
+        :return: lista_struktur, nazwa_pacjenta
+        """
+        key = self.key_for(rt_structure_filename)
+        if key is not None:
+            with self._lock:
+                cached = self.get(rt_structure_filename, key)
+            if cached is not None:
+                return cached
+
+        # Parsowanie odbywa się poza blokadą - inne wątki mogą w tym czasie korzystać z cache'a
+        structures, patient_name = utils.read_rtstruct(rt_structure_filename, streaming=self.streaming)
+        with self._lock:
+            self.misses += 1
+            if key is not None:
+                self.put(rt_structure_filename, structures, patient_name, key)
+        return structures, patient_name
+
+    def key_for(self, rt_structure_filename):
+        """
+        Metoda wyznaczająca klucz wpisu w cache'u na podstawie ścieżki, rozmiaru, czasu modyfikacji i SOPInstanceUID pliku.
+        :param rt_structure_filename: ścieżka do pliku DICOM z danymi RTStruct
+        :return: klucz wpisu lub None, jeśli nie da się go wyznaczyć (np. plik nie jest plikiem RTStruct)
+        """
+        path = os.path.abspath(rt_structure_filename)
+        try:
+            stat = os.stat(path)
+            # Czytamy wyłącznie metadane - bez parsowania sekwencji z konturami
+            header = utils.probe_dicom(path)
+        except OSError:
+            return None
+        if header.kind != utils.RTSTRUCT or header.sop_uid is None:
+            return None
+        return hashlib.sha1(f"{path}|{stat.st_size}|{stat.st_mtime_ns}|{header.sop_uid}".encode()).hexdigest()
+
+    def get(self, rt_structure_filename, key=None):
+        """
+        Metoda zwracająca struktury z cache'a lub None, jeśli plik nie ma aktualnego wpisu w cache'u.
+        Nieaktualne wpisy dotyczące tej samej ścieżki (zmieniony plik) są przy okazji usuwane.
+        :param rt_structure_filename: ścieżka do pliku DICOM z danymi RTStruct
+        :param key: wyznaczony uprzednio klucz wpisu (opcjonalnie)
+        :return: (lista_struktur, nazwa_pacjenta) lub None
+        """
+        if key is None:
+            key = self.key_for(rt_structure_filename)
+            if key is None:
+                return None
+        self._drop_stale(os.path.abspath(rt_structure_filename), key)
+
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self._touch(key)
+            self.hits += 1
+            return self._memory[key]
+
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        try:
+            cached = _read_entry(self._entry_path(key))
+        except Exception as ex:  # Uszkodzony, niekompletny lub niedający się zdekodować wpis traktujemy jak jego brak
+            print(f"Dropping unreadable cache entry {key}: {ex}", file=sys.stderr)
+            self._remove(key)
+            self._sync_index()
+            return None
+
+        self._remember(key, cached)
+        self._touch(key)
+        self.hits += 1
+        return cached
+
+    def put(self, rt_structure_filename, structures, patient_name, key=None):
+        """
+        Metoda zapisująca sparsowane struktury w cache'u.
+        :param rt_structure_filename: ścieżka do pliku DICOM z danymi RTStruct
+        :param structures: lista obiektów klasy utils.Structure
+        :param patient_name: nazwa pacjenta z pliku RTStruct
+        :param key: wyznaczony uprzednio klucz wpisu (opcjonalnie)
+        :return: None
+        """
+        if key is None:
+            key = self.key_for(rt_structure_filename)
+            if key is None:
+                return
+        if self.read_only:
+            self._remember(key, (structures, patient_name))
+            return
+        path = os.path.abspath(rt_structure_filename)
+        stat = os.stat(path)
+        entry_path = self._entry_path(key)
+        self._remember(key, (structures, patient_name))
+
+        def add_entry():
+            # Plik wpisu zapisywany jest pod blokadą - inny proces nie uzna go w tym czasie za osierocony
+            _write_entry(entry_path, structures, patient_name)
+            self._index[key] = {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                                "bytes": os.path.getsize(entry_path), "last_access": time.time()}
+            self._drop_stale(path, key, write=False)
+            self._evict()
+        self._sync_index(add_entry)
+
+    def invalidate(self, rt_structure_filename):
+        """Usunięcie z cache'a wszystkich wpisów dotyczących podanego pliku."""
+        path = os.path.abspath(rt_structure_filename)
+
+        def remove_entries():
+            for key in [k for k, entry in self._index.items() if entry["path"] == path]:
+                self._remove(key)
+        self._sync_index(remove_entries)
+
+    def prune(self):
+        """Usunięcie z cache'a wpisów, których pliki źródłowe zniknęły lub zostały zmienione, oraz plików wpisów
+         nieobecnych w indeksie."""
+        def remove_stale():
+            for key, entry in list(self._index.items()):
+                try:
+                    stat = os.stat(entry["path"])
+                    stale = stat.st_size != entry["size"] or stat.st_mtime_ns != entry["mtime_ns"]
+                except OSError:
+                    stale = True
+                if stale:
+                    self._remove(key)
+            self._remove_orphans()
+        self._sync_index(remove_stale)
+
+    def evict(self):
+        """Usuwanie najdawniej używanych wpisów (również wpisów dodanych przez inne procesy) aż łączny rozmiar cache'a
+         zmieści się w limicie max_bytes oraz usunięcie plików wpisów nieobecnych w indeksie."""
+        self._sync_index(self._evict)
+
+    def clear(self):
+        """Usunięcie wszystkich wpisów cache'a."""
+        def remove_all():
+            for key in list(self._index):
+                self._remove(key)
+            self._remove_orphans()
+        self._sync_index(remove_all)
+
+    def flush(self):
+        """Zapis na dysk zmienionych czasów ostatniego użycia wpisów."""
+        with self._lock:
+            if self._dirty:
+                self._sync_index()
+
+    def close(self):
+        """Zakończenie korzystania z cache'a (np. przy zamknięciu programu) - zapis zaległych zmian indeksu."""
+        self.flush()
+
+    def size_bytes(self):
+        """Łączny rozmiar wpisów cache'a na dysku."""
+        return sum(entry["bytes"] for entry in self._index.values())
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def _remember(self, key, cached):
+        self._memory[key] = cached
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _touch(self, key):
+        """Zmiana czasu ostatniego użycia wpisu - indeks zapisywany jest najwyżej raz na INDEX_FLUSH_INTERVAL sekund."""
+        if key in self._index:
+            self._index[key]["last_access"] = time.time()
+            self._dirty = True
+            if time.time() - self._flushed >= INDEX_FLUSH_INTERVAL:
+                self._sync_index()
+
+    def _drop_stale(self, path, current_key, write=True):
+        stale = [k for k, entry in self._index.items() if entry["path"] == path and k != current_key]
+        for key in stale:
+            self._remove(key)
+        if stale and write:
+            self._sync_index()
+
+    def _evict(self):
+        by_access = sorted(self._index, key=lambda k: self._index[k]["last_access"])
+        total = self.size_bytes()
+        for key in by_access:
+            if total <= self.max_bytes:
+                break
+            total -= self._index[key]["bytes"]
+            self._remove(key)
+        self._remove_orphans()
+
+    def _remove_orphans(self):
+        """Usunięcie plików wpisów nieobecnych w indeksie (np. po przerwanym zapisie) - wywoływane pod blokadą indeksu."""
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz") and name[:-len(".npz")] not in self._index:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    def _remove(self, key):
+        self._index.pop(key, None)
+        self._memory.pop(key, None)
+        if self.read_only:
+            return
+        self._removed.add(key)
+        try:
+            os.remove(self._entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _sync_index(self, update=None):
+        """
+        Zapis indeksu pod blokadą pliku: indeks z dysku (z wpisami innych procesów) łączony jest z indeksem procesu,
+        następnie wywoływana jest funkcja update (zmieniająca połączony indeks), a wynik zapisywany jest na dysk.
+        :param update: funkcja bez argumentów modyfikująca self._index (opcjonalnie)
+        :return: None
+        """
+        if self.read_only:
+            return
+        with self._index_lock():
+            self._index = self._merge_index(self._read_index())
+            self._removed.clear()
+            if update is not None:
+                update()
+            self._write_index()
+        self._dirty = False
+        self._flushed = time.time()
+
+    def _merge_index(self, disk):
+        """Połączenie indeksu z dysku z indeksem procesu - wpisy usunięte przez ten proces są pomijane, a z dwóch wersji
+         tego samego wpisu wybierana jest ta z późniejszym czasem użycia. Wpisy nieobecne na dysku usunął inny proces."""
+        merged = {}
+        for key, entry in disk.items():
+            if key in self._removed:
+                continue
+            own = self._index.get(key)
+            merged[key] = own if own is not None and own["last_access"] >= entry["last_access"] else entry
+        return merged
+
+    @contextmanager
+    def _index_lock(self):
+        """Blokada pliku index.lock na czas odczytu, zmiany i zapisu indeksu (wyłączność między procesami)."""
+        with open(os.path.join(self.cache_dir, LOCK_FILE_NAME), "a+b") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, INDEX_FILE_NAME), "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if index.get("version") != FORMAT_VERSION:
+            return {}
+        # Wpisy, których plik z danymi zniknął, nie są już użyteczne
+        return {k: e for k, e in index["entries"].items() if os.path.exists(self._entry_path(k))}
+
+    def _write_index(self):
+        if self.read_only:
+            return
+        index_path = os.path.join(self.cache_dir, INDEX_FILE_NAME)
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": FORMAT_VERSION, "entries": self._index}, f)
+        os.replace(tmp_path, index_path)  # Atomowa podmiana - indeks nigdy nie jest zapisany w połowie
+
+
+def _write_entry(entry_path, structures, patient_name):
+    """
+    Zapis listy struktur do pliku .npz w postaci płaskich macierzy.
+    points - połączone macierze punktów wszystkich struktur (N x 3),
+    contour_offsets - indeksy początków konturów w macierzy points (+ indeks końca ostatniego konturu),
+    contour_uids - UID odniesienia każdego z konturów,
+    roi_offsets - indeksy pierwszych konturów kolejnych struktur (+ liczba wszystkich konturów).
+    """
+    points, contour_offsets, contour_uids, roi_offsets = [], [np.zeros(1, dtype=np.int64)], [], [0]
+    point_count = 0
+    for structure in structures:
+        points.append(structure.points)
+        contour_offsets.append(structure.offsets[1:] + point_count)
+        point_count += len(structure.points)
+        uids = np.empty(structure.contour_count(), dtype=object)
+        for uid, (first, stop) in structure.uid_index.items():
+            uids[first:stop] = uid
+        contour_uids.append(uids)
+        roi_offsets.append(roi_offsets[-1] + structure.contour_count())
+
+    tmp_path = entry_path + ".tmp.npz"
+    np.savez(tmp_path,
+             points=np.concatenate(points) if points else np.empty((0, 3)),
+             contour_offsets=np.concatenate(contour_offsets),
+             contour_uids=np.concatenate(contour_uids).astype(str) if contour_uids else np.empty(0, dtype=str),
+             roi_offsets=np.asarray(roi_offsets, dtype=np.int64),
+             roi_names=np.asarray([str(s.name) for s in structures], dtype=str),
+             roi_colors=np.asarray([list(s.color) for s in structures], dtype=np.int64).reshape(-1, 3),
+             roi_numbers=np.asarray([int(s.number) for s in structures], dtype=np.int64),
+             patient_name=np.asarray(str(patient_name)))
+    os.replace(tmp_path, entry_path)
+
+
+def _read_entry(entry_path):
+    """Odczyt listy struktur zapisanej funkcją _write_entry - punkty struktur są widokami na jedną wspólną macierz."""
+    with np.load(entry_path, allow_pickle=False) as data:
+        points = data["points"]
+        contour_offsets = data["contour_offsets"]
+        contour_uids = data["contour_uids"]
+        roi_offsets = data["roi_offsets"]
+        names, colors, numbers = data["roi_names"], data["roi_colors"], data["roi_numbers"]
+        patient_name = str(data["patient_name"])
+
+    structures = []
+    for i in range(len(names)):
+        first, stop = roi_offsets[i], roi_offsets[i + 1]
+        offsets = contour_offsets[first:stop + 1] - contour_offsets[first]
+        # Kontury tej samej struktury są pogrupowane po UID odniesienia - wyznaczamy granice kolejnych grup
+        uids = contour_uids[first:stop]
+        uid_index = {}
+        if stop > first:  # Struktura bez konturów (pusta ContourSequence) ma pusty indeks
+            bounds = np.concatenate(([0], np.flatnonzero(uids[1:] != uids[:-1]) + 1, [len(uids)]))
+            uid_index = {str(uids[b]): (int(b), int(e)) for b, e in zip(bounds[:-1], bounds[1:])}
+        structures.append(utils.Structure(str(names[i]), colors[i].tolist(), int(numbers[i]),
+                                          points[contour_offsets[first]:contour_offsets[stop]], offsets, uid_index))
+    return structures, patient_name
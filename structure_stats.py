@@ -0,0 +1,319 @@
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+import rasterize
+import rtstruct_cache
+import utils
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+"""Moduł wyznaczający statystyki geometryczne i densytometryczne (HU) struktur pliku RTStruct na całej serii CT.
+
+Geometria struktur wyznaczana jest bezpośrednio z konturów (we współrzędnych pacjenta, w mm): pola i obwody wszystkich
+konturów struktury liczone są jednocześnie wzorem Gaussa (shoelace) operacjami na macierzach numpy, kontury wewnętrzne
+(dziury - kontury leżące wewnątrz nieparzystej liczby innych konturów tego samego slice'a) odejmowane są od pola slice'a,
+a objętość struktury to suma pól slice'ów pomnożonych przez odstęp między slice'ami. Wyznaczane są też środek ciężkości
+i prostopadłościan ograniczający struktury.
+
+Statystyki HU (średnia, odchylenie standardowe, minimum, maksimum) wyznaczane są z pikseli wewnątrz masek struktur
+(moduł rasterize.py). Seria przetwarzana jest w jednym przebiegu - każdy slice dekodowany jest raz dla wszystkich
+struktur, a slice'y rozdzielane są między procesy robocze, które zwracają jedynie sumy częściowe.
+
+Wyniki zapisywane są do pliku CSV lub (jeśli dostępna jest biblioteka pandas) Parquet.
+
+Przykład użycia:
+    python structure_stats.py CT_DIR RTSTRUCT_FILE stats.csv --slices slice_areas.csv --workers 8
+
+Wymagane zewnętrzne biblioteki
+-----------------------------
+numpy
+pydicom
+pandas (opcjonalnie - zapis do formatu Parquet, wymaga też pyarrow)
+"""
+
+# Kolumny tabeli statystyk struktur i tabeli pól konturów na kolejnych slice'ach
+STRUCTURE_COLUMNS = ["roi_number", "roi_name", "slices", "contours", "volume_cm3", "centroid_x_mm", "centroid_y_mm",
+                     "centroid_z_mm", "min_x_mm", "min_y_mm", "min_z_mm", "max_x_mm", "max_y_mm", "max_z_mm",
+                     "voxels", "mask_volume_cm3", "hu_mean", "hu_std", "hu_min", "hu_max"]
+SLICE_COLUMNS = ["roi_number", "roi_name", "z_mm", "contours", "area_mm2", "perimeter_mm"]
+
+# Dokładność [mm], z jaką współrzędne 'z' konturów przypisywane są do tego samego slice'a
+Z_DECIMALS = 3
+
+# Struktury z pliku RTStruct i geometria slice'ów przekazywane jednorazowo do każdego procesu roboczego
+_worker_rtstruct = None
+_worker_headers = None
+_worker_options = None
+
+
+def contour_geometry(points, offsets):
+    """
+    Funkcja wyznaczająca wzorem Gaussa (shoelace) pola, obwody i momenty statyczne wszystkich konturów jednocześnie.
+    Kontur nie musi być domknięty - krawędź między ostatnim i pierwszym punktem konturu dodawana jest automatycznie.
+    :param points: macierz N x 2 lub N x 3 punktów kolejnych konturów (wykorzystywane są współrzędne x, y)
+    :param offsets: indeksy początków kolejnych konturów w macierzy points (+ indeks końca ostatniego konturu)
+    :return: pola ze znakiem (dodatnie dla konturów przeciwnych do ruchu wskazówek zegara), obwody, momenty statyczne
+     względem osi y i x (środek ciężkości konturu to moment / pole)
+    """
+    following = np.arange(1, len(points) + 1)
+    nonempty = offsets[:-1] < offsets[1:]
+    following[offsets[1:][nonempty] - 1] = offsets[:-1][nonempty]
+    x0, y0 = points[:, 0], points[:, 1]
+    x1, y1 = points[following, 0], points[following, 1]
+    cross = x0 * y1 - x1 * y0
+    area = _contour_sums(cross, offsets) / 2
+    perimeter = _contour_sums(np.hypot(x1 - x0, y1 - y0), offsets)
+    moment_x = _contour_sums((x0 + x1) * cross, offsets) / 6
+    moment_y = _contour_sums((y0 + y1) * cross, offsets) / 6
+    return area, perimeter, moment_x, moment_y
+
+
+def nesting_depth(points, offsets):
+    """
+    Funkcja wyznaczająca dla każdego konturu slice'a liczbę innych konturów, wewnątrz których leży (reguła parzystości
+    dla pierwszego punktu konturu) - kontury o nieparzystej głębokości to dziury. Wszystkie pary (punkt, krawędź)
+    sprawdzane są jednocześnie.
+    :param points: macierz N x 2 lub N x 3 punktów konturów jednego slice'a
+    :param offsets: indeksy początków kolejnych konturów w macierzy points (+ indeks końca ostatniego konturu)
+    :return: macierz głębokości kolejnych konturów
+    """
+    count = len(offsets) - 1
+    if count < 2:
+        return np.zeros(count, dtype=np.int64)
+    following = np.arange(1, len(points) + 1)
+    following[offsets[1:] - 1] = offsets[:-1]
+    edge_contour = np.repeat(np.arange(count), np.diff(offsets))
+    x0, y0 = points[:, 0], points[:, 1]
+    x1, y1 = points[following, 0], points[following, 1]
+
+    # Półprosta poprowadzona w prawo z pierwszego punktu każdego konturu (wiersze) i krawędzie konturów (kolumny)
+    px, py = points[offsets[:-1], 0][:, None], points[offsets[:-1], 1][:, None]
+    spans = (y0 > py) != (y1 > py)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+    crossings = spans & (x > px) & (edge_contour != np.arange(count)[:, None])
+    inside = np.zeros((count, count), dtype=np.int64)
+    np.add.at(inside, (np.nonzero(crossings)[0], edge_contour[np.nonzero(crossings)[1]]), 1)
+    return (inside & 1).sum(axis=1)
+
+
+def structure_geometry(structure, thickness: float = None):
+    """
+    Funkcja wyznaczająca geometrię struktury z jej konturów (we współrzędnych pacjenta).
+    :param structure: obiekt klasy Structure z konturami we współrzędnych pacjenta (wynik read_rtstruct)
+    :param thickness: odstęp między slice'ami [mm] (domyślnie mediana odstępów między płaszczyznami konturów)
+    :return: słownik z kolumnami tabeli statystyk (bez statystyk HU) i lista wierszy tabeli pól konturów na slice'ach
+    """
+    row = {"roi_number": structure.number, "roi_name": str(structure.name), "slices": 0,
+           "contours": structure.contour_count(), "volume_cm3": 0.0}
+    if structure.contour_count() == 0:
+        return row, []
+    points, offsets = structure.points, structure.offsets
+    area, perimeter, moment_x, moment_y = contour_geometry(points, offsets)
+
+    # Grupowanie konturów po płaszczyznach 'z' (kontury leżą w macierzy points posortowane po UID, a nie po 'z')
+    z = np.round(points[offsets[:-1], 2], Z_DECIMALS)
+    planes, plane_of_contour, contours_per_plane = np.unique(z, return_inverse=True, return_counts=True)
+    sign = np.sign(area)
+    for plane in np.nonzero(contours_per_plane > 1)[0]:
+        contour_ids = np.nonzero(plane_of_contour == plane)[0]
+        plane_points, plane_offsets = utils.gather_contours(points, offsets, contour_ids)
+        # Kontur wewnętrzny (dziura) odejmowany jest od pola slice'a niezależnie od kierunku obiegu konturu
+        sign[contour_ids] *= np.where(nesting_depth(plane_points, plane_offsets) & 1, -1, 1)
+    plane_area = np.bincount(plane_of_contour, sign * area, len(planes))
+    plane_perimeter = np.bincount(plane_of_contour, perimeter, len(planes))
+
+    if thickness is None:
+        thickness = float(np.median(np.diff(planes))) if len(planes) > 1 else 0.0
+    total_area = plane_area.sum()
+    row.update(slices=len(planes), volume_cm3=total_area * thickness / 1000)
+    if total_area > 0:
+        row.update(centroid_x_mm=(sign * moment_x).sum() / total_area,
+                   centroid_y_mm=(sign * moment_y).sum() / total_area,
+                   centroid_z_mm=(plane_area * planes).sum() / total_area)
+    low, high = points.min(axis=0), points.max(axis=0)
+    row.update(min_x_mm=low[0], min_y_mm=low[1], min_z_mm=low[2], max_x_mm=high[0], max_y_mm=high[1],
+               max_z_mm=high[2])
+
+    slice_rows = [{"roi_number": structure.number, "roi_name": str(structure.name), "z_mm": float(plane),
+                   "contours": int(contours), "area_mm2": float(plane_area_mm2), "perimeter_mm": float(length)}
+                  for plane, contours, plane_area_mm2, length in
+                  zip(planes, contours_per_plane, plane_area, plane_perimeter)]
+    return row, slice_rows
+
+
+def _contour_sums(values, offsets):
+    """Sumy wartości values (jedna wartość na punkt) w obrębie kolejnych konturów (kontury puste mają sumę 0)."""
+    sums = np.zeros(len(offsets) - 1)
+    nonempty = offsets[:-1] < offsets[1:]
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(values, offsets[:-1][nonempty])
+    return sums
+
+
+def _init_worker(rtstruct, headers, volume_args, options):
+    """Inicjalizacja procesu roboczego - zapamiętanie struktur, nagłówków slice'ów i parametrów oraz zmapowanie pliku
+     macierzy serii (utils.init_volume_worker)."""
+    global _worker_rtstruct, _worker_headers, _worker_options
+    _worker_rtstruct = rtstruct
+    _worker_headers = headers
+    _worker_options = options
+    utils.init_volume_worker(*volume_args)
+
+
+def _slice_hu_stats(index):
+    """
+    Sumy częściowe HU pikseli wewnątrz masek wszystkich struktur jednego slice'a (wywoływane w procesie roboczym).
+    Dane obrazowe slice'a dekodowane są (do wspólnego pliku macierzy serii) tylko wtedy, gdy pasuje do niego kontur
+    którejkolwiek struktury.
+    :param index: indeks slice'a w serii
+    :return: indeks slice'a, macierz (struktura, [liczba pikseli, suma, suma kwadratów, minimum, maksimum]),
+     flaga decydująca, czy slice został zdekodowany w tym wywołaniu
+    """
+    dicom = utils.Slice(index=index, header=_worker_headers[index])
+    dicom.match_mode = _worker_options["match_mode"]
+    shape = (dicom.dcm.Rows, dicom.dcm.Columns)
+    sums = np.zeros((len(_worker_rtstruct), 5))
+    sums[:, 3], sums[:, 4] = np.inf, -np.inf
+    hu, decoded = None, False
+    for i, structure in enumerate(_worker_rtstruct):
+        matched = dicom.match_structure(structure)
+        if matched is None:
+            continue
+        mask = rasterize.structure_mask(matched, shape)
+        if not mask.any():
+            continue
+        if hu is None:
+            pixels, decoded = utils.worker_pixel_array(index)
+            hu = dicom.to_hu(pixels)
+        values = hu[mask].astype(np.float64)
+        sums[i] = len(values), values.sum(), np.square(values).sum(), values.min(), values.max()
+    return index, sums, decoded
+
+
+def series_hu_stats(volume, rtstruct, workers: int = None, match_mode: str = utils.MATCH_UID_Z, progress=None):
+    """
+    Funkcja sumująca HU pikseli wewnątrz masek struktur na wszystkich slice'ach serii.
+    :param volume: obiekt klasy utils.Volume
+    :param rtstruct: lista obiektów klasy Structure utworzona na podstawie pliku DICOM z danymi RTStruct
+    :param workers: liczba procesów roboczych (domyślnie liczba rdzeni procesora, 1 - bez puli procesów)
+    :param match_mode: sposób dopasowywania konturów do slice'ów (Slice.match_mode)
+    :param progress: funkcja wywoływana po każdym slice'u z argumentami (liczba gotowych slice'ów, liczba slice'ów)
+    :return: macierz (struktura, [liczba pikseli, suma, suma kwadratów, minimum, maksimum]) dla całej serii
+    """
+    totals = np.zeros((len(rtstruct), 5))
+    totals[:, 3], totals[:, 4] = np.inf, -np.inf
+    initargs = (rtstruct, volume.headers, volume.worker_args(), {"match_mode": match_mode})
+    indices = range(len(volume))
+    if workers == 1:
+        _init_worker(*initargs)
+        results = map(_slice_hu_stats, indices)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs)
+        results = pool.imap_unordered(_slice_hu_stats, indices, chunksize=4)
+    try:
+        for done, (index, sums, decoded) in enumerate(results, 1):
+            if decoded:  # Slice zdekodowany w procesie roboczym jest już w pliku macierzy serii
+                volume.decoded[index] = True
+            totals[:, :3] += sums[:, :3]
+            totals[:, 3] = np.minimum(totals[:, 3], sums[:, 3])
+            totals[:, 4] = np.maximum(totals[:, 4], sums[:, 4])
+            if progress is not None:
+                progress(done, len(volume))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return totals
+
+
+def series_statistics(volume, rtstruct, workers: int = None, match_mode: str = utils.MATCH_UID_Z, progress=None):
+    """
+    Funkcja wyznaczająca statystyki geometryczne i HU wszystkich struktur na serii CT.
+    :param volume: obiekt klasy utils.Volume
+    :param rtstruct: lista obiektów klasy Structure utworzona na podstawie pliku DICOM z danymi RTStruct
+    :param workers: liczba procesów roboczych (domyślnie liczba rdzeni procesora, 1 - bez puli procesów)
+    :param match_mode: sposób dopasowywania konturów do slice'ów (Slice.match_mode)
+    :param progress: funkcja wywoływana po każdym slice'u z argumentami (liczba gotowych slice'ów, liczba slice'ów)
+    :return: lista wierszy tabeli statystyk struktur (STRUCTURE_COLUMNS), lista wierszy tabeli pól konturów na
+     slice'ach (SLICE_COLUMNS)
+    """
+    thickness = float(np.median(np.diff(volume.z))) if len(volume) > 1 else None
+    header = volume.headers[0]
+    row_spacing, column_spacing = (float(value) for value in header.PixelSpacing)
+    voxel_volume = row_spacing * column_spacing * (thickness or float(header.get("SliceThickness") or 0))
+
+    totals = series_hu_stats(volume, rtstruct, workers, match_mode, progress)
+    structure_rows, slice_rows = [], []
+    for structure, (count, total, squares, low, high) in zip(rtstruct, totals):
+        row, rows = structure_geometry(structure, thickness)
+        row.update(voxels=int(count), mask_volume_cm3=count * voxel_volume / 1000)
+        if count > 0:
+            mean = total / count
+            row.update(hu_mean=mean, hu_std=np.sqrt(max(squares / count - mean ** 2, 0.0)), hu_min=low, hu_max=high)
+        structure_rows.append(row)
+        slice_rows.extend(rows)
+    return structure_rows, slice_rows
+
+
+def write_table(path, rows, columns):
+    """
+    Zapis tabeli do pliku - format wybierany jest na podstawie rozszerzenia (.parquet lub CSV dla pozostałych).
+    :param path: ścieżka pliku
+    :param rows: lista wierszy (słowników {kolumna: wartość}, brakujące wartości zapisywane są jako puste)
+    :param columns: kolejność kolumn
+    :return: None
+    """
+    if os.path.splitext(path)[1].lower() == ".parquet":
+        if pandas is None:
+            raise ValueError("Writing Parquet files requires pandas (and pyarrow) - use a .csv output instead")
+        pandas.DataFrame(rows, columns=columns).to_parquet(path, index=False)
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: float(value) if isinstance(value, np.floating) else value
+                             for key, value in row.items()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute per-ROI geometry and HU statistics over a CT series.")
+    parser.add_argument("ct_dir", help="directory with the DICOM files of the CT series")
+    parser.add_argument("rtstruct_path", help="DICOM RTStruct file")
+    parser.add_argument("output", help="per-ROI statistics table (.csv or .parquet)")
+    parser.add_argument("--slices", help="optional per-slice contour area table (.csv or .parquet)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    args = parser.parse_args()
+
+    cache = rtstruct_cache.RTStructCache()
+    structures, _ = cache.load(args.rtstruct_path)
+    cache.close()
+    volume = utils.Volume(args.ct_dir)
+    start = time.perf_counter()
+    structure_rows, slice_rows = series_statistics(
+        volume, structures, args.workers,
+        progress=lambda done, total: print(f"\rProcessed {done}/{total} slices", end="", file=sys.stderr))
+    print(file=sys.stderr)
+    volume.close()
+    write_table(args.output, structure_rows, STRUCTURE_COLUMNS)
+    if args.slices:
+        write_table(args.slices, slice_rows, SLICE_COLUMNS)
+    print(f"Computed statistics of {len(structures)} structures on {len(volume)} slices "
+          f"in {time.perf_counter() - start:.1f}s")
+    for row in structure_rows:
+        print(f"  {row['roi_number']:>4} {row['roi_name']}: {row['volume_cm3']:.2f} cm3, "
+              f"mean HU {row.get('hu_mean', float('nan')):.1f}")
+
+
+if __name__ == "__main__":
+    main()
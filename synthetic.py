@@ -0,0 +1,223 @@
+import argparse
+import os
+from collections import namedtuple
+
+import numpy as np
+from pydicom.dataelem import RawDataElement
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, JPEG2000Lossless, JPEGLSLossless, RLELossless, generate_uid
+
+import utils
+
+"""Moduł generujący syntetyczne dane DICOM - serię CT i pasujący do niej plik RTStruct - do testów i benchmarków.
+
+Obraz CT to koło o gęstości tkanek miękkich na tle powietrza z niewielkim szumem, a struktury RTStruct to pofalowane
+elipsy rozmieszczone wokół środka obrazu. Obrazy i kontury zależą tylko od ziarna generatora liczb losowych (UID-y
+są generowane za każdym razem na nowo), a rozmiar danych - liczba slice'ów, rozmiar macierzy obrazu, liczba struktur,
+liczba konturów na slice i liczba punktów konturu - jest konfigurowalny. Dane obrazowe serii CT mogą być zapisane
+w postaci skompresowanej (RLE, a przy zainstalowanych wtyczkach pydicom również JPEG-LS i JPEG 2000).
+
+Przykład użycia:
+    python synthetic.py OUTPUT_DIR --slices 100 --size 512 --rois 20 --contours 4 --points 128
+    python synthetic.py OUTPUT_DIR --slices 200 --size 512 --compression rle
+
+Wymagane zewnętrzne biblioteki
+-----------------------------
+numpy
+pydicom
+"""
+
+CT_IMAGE_SOP_CLASS_UID = "1.2.840.10008.5.1.4.1.1.2"
+
+# Składnie transferu skompresowanych danych obrazowych (argument compression)
+COMPRESSIONS = {"rle": RLELossless, "jpeg-ls": JPEGLSLossless, "jpeg2000": JPEG2000Lossless}
+
+"""Opis wygenerowanej serii CT - UID-y serii i (posortowane po 'z') SOPInstanceUID-y, współrzędne 'z' i ścieżki slice'ów."""
+SyntheticSeries = namedtuple("SyntheticSeries", ["directory", "patient_name", "study_uid", "series_uid", "frame_uid",
+                                                 "sop_uids", "z", "file_paths", "size", "spacing"])
+
+
+def write_ct_series(directory: str, slices: int = 20, size: int = 256, spacing: float = 1.0, thickness: float = 2.5,
+                    patient_name: str = "Synthetic^Patient", seed: int = 0, compression: str = None):
+    """
+    Funkcja zapisująca syntetyczną serię CT (jeden plik DICOM na slice).
+    :param directory: katalog, w którym zapisywane są pliki serii
+    :param slices: liczba slice'ów
+    :param size: liczba wierszy i kolumn obrazu
+    :param spacing: rozmiar piksela [mm]
+    :param thickness: grubość slice'a i odstęp między slice'ami [mm]
+    :param patient_name: nazwa pacjenta
+    :param seed: ziarno generatora liczb losowych (szum obrazu)
+    :param compression: kompresja danych obrazowych - klucz słownika COMPRESSIONS (domyślnie bez kompresji)
+    :return: obiekt SyntheticSeries
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    study_uid, series_uid, frame_uid = generate_uid(), generate_uid(), generate_uid()
+    origin = -size * spacing / 2
+
+    # Koło o gęstości tkanek miękkich (ok. 40 HU) na tle powietrza (-1024 HU) - przy RescaleIntercept = -1024
+    rows, cols = np.mgrid[:size, :size]
+    body = ((rows - size / 2) ** 2 + (cols - size / 2) ** 2 < (0.35 * size) ** 2) * 1064
+
+    sop_uids, z, file_paths = [], [], []
+    for i in range(slices):
+        sop_uid = generate_uid()
+        ds = _file_dataset(CT_IMAGE_SOP_CLASS_UID, sop_uid, "CT", patient_name, study_uid, series_uid)
+        ds.FrameOfReferenceUID = frame_uid
+        ds.InstanceNumber = i + 1
+        ds.ImagePositionPatient = [origin, origin, i * thickness]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [spacing, spacing]
+        ds.SliceThickness = thickness
+        ds.Rows = ds.Columns = size
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.RescaleSlope, ds.RescaleIntercept = 1, -1024
+        ds.WindowCenter, ds.WindowWidth = 40, 400
+        ds.PixelData = (body + rng.integers(0, 50, (size, size))).astype(np.int16).tobytes()
+        if compression:
+            ds.compress(COMPRESSIONS[compression])
+
+        path = os.path.join(directory, f"1-{i + 1:04d}.dcm")
+        ds.save_as(path, enforce_file_format=True)
+        sop_uids.append(sop_uid)
+        z.append(i * thickness)
+        file_paths.append(path)
+    return SyntheticSeries(directory, patient_name, study_uid, series_uid, frame_uid, sop_uids, z, file_paths, size,
+                           spacing)
+
+
+def write_rtstruct(path: str, series, rois: int = 2, contours: int = 1, points: int = 64, reference_uids: bool = True,
+                   seed: int = 0):
+    """
+    Funkcja zapisująca syntetyczny plik RTStruct z konturami na każdym slice'u serii.
+    :param path: ścieżka zapisywanego pliku
+    :param series: obiekt SyntheticSeries, do którego odnoszą się kontury
+    :param rois: liczba struktur
+    :param contours: liczba konturów każdej struktury na każdym slice'u
+    :param points: liczba punktów każdego konturu
+    :param reference_uids: flaga decydująca, czy kontury mają ContourImageSequence z UID slice'a (bez niej kontury
+     można dopasować do slice'ów tylko po 'z')
+    :param seed: ziarno generatora liczb losowych (kształt konturów)
+    :return: None
+    """
+    rng = np.random.default_rng(seed)
+    ds = _file_dataset(utils.RTSTRUCT_SOP_CLASS_UID, generate_uid(), "RTSTRUCT", series.patient_name,
+                       series.study_uid, generate_uid())
+    ds.StructureSetLabel = "Synthetic"
+
+    referencedSeries = Dataset()
+    referencedSeries.SeriesInstanceUID = series.series_uid
+    referencedStudy = Dataset()
+    referencedStudy.ReferencedSOPInstanceUID = series.study_uid
+    referencedStudy.RTReferencedSeriesSequence = [referencedSeries]
+    frame = Dataset()
+    frame.FrameOfReferenceUID = series.frame_uid
+    frame.RTReferencedStudySequence = [referencedStudy]
+    ds.ReferencedFrameOfReferenceSequence = [frame]
+
+    # Struktury rozmieszczone na okręgu wokół środka obrazu, kontury jednej struktury - wokół środka struktury
+    extent = series.size * series.spacing
+    angle = np.linspace(0, 2 * np.pi, points, endpoint=False)
+    structureSetROIs, roiContours = [], []
+    for r in range(rois):
+        roi = Dataset()
+        roi.ROINumber = r + 1
+        roi.ReferencedFrameOfReferenceUID = series.frame_uid
+        roi.ROIName = f"ROI_{r + 1:03d}"
+        roi.ROIGenerationAlgorithm = "AUTOMATIC"
+        structureSetROIs.append(roi)
+
+        center = 0.2 * extent * np.array([np.cos(2 * np.pi * r / max(rois, 1)), np.sin(2 * np.pi * r / max(rois, 1))])
+        radius = 0.08 * extent / np.sqrt(contours)
+        roiContour = Dataset()
+        roiContour.ReferencedROINumber = r + 1
+        roiContour.ROIDisplayColor = [int(c) for c in rng.integers(0, 256, 3)]
+        contourSequence = []
+        for sop_uid, z in zip(series.sop_uids, series.z):
+            for k in range(contours):
+                offset = center + 0.1 * extent * np.array([np.cos(k), np.sin(k)]) * (k > 0)
+                wobble = 1 + 0.15 * np.sin(rng.integers(3, 8) * angle + rng.uniform(0, 2 * np.pi))
+                contourPoints = np.column_stack([offset[0] + radius * wobble * np.cos(angle),
+                                                 offset[1] + radius * wobble * np.sin(angle),
+                                                 np.full(points, z)])
+                contour = Dataset()
+                if reference_uids:
+                    contourImage = Dataset()
+                    contourImage.ReferencedSOPClassUID = CT_IMAGE_SOP_CLASS_UID
+                    contourImage.ReferencedSOPInstanceUID = sop_uid
+                    contour.ContourImageSequence = [contourImage]
+                contour.ContourGeometricType = "CLOSED_PLANAR"
+                contour.NumberOfContourPoints = points
+                contour[utils.CONTOUR_DATA_TAG] = _decimal_strings(contourPoints)
+                contourSequence.append(contour)
+        roiContour.ContourSequence = contourSequence
+        roiContours.append(roiContour)
+
+    ds.StructureSetROISequence = structureSetROIs
+    ds.ROIContourSequence = roiContours
+    ds.save_as(path, enforce_file_format=True)
+
+
+def generate_dataset(directory: str, slices: int = 20, size: int = 256, rois: int = 2, contours: int = 1,
+                     points: int = 64, reference_uids: bool = True, seed: int = 0, compression: str = None):
+    """
+    Funkcja generująca kompletny zestaw danych: serię CT w katalogu directory/ct i plik directory/rtstruct.dcm.
+    :return: katalog serii CT, ścieżka pliku RTStruct
+    """
+    ct_dir = os.path.join(directory, "ct")
+    rtstruct_path = os.path.join(directory, "rtstruct.dcm")
+    series = write_ct_series(ct_dir, slices, size, seed=seed, compression=compression)
+    write_rtstruct(rtstruct_path, series, rois, contours, points, reference_uids, seed)
+    return ct_dir, rtstruct_path
+
+
+def _file_dataset(sop_class_uid, sop_uid, modality, patient_name, study_uid, series_uid):
+    """Zbiór danych DICOM z nagłówkiem pliku i atrybutami wspólnymi dla serii CT i pliku RTStruct."""
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class_uid
+    meta.MediaStorageSOPInstanceUID = sop_uid
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(None, {}, file_meta=meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = sop_class_uid
+    ds.SOPInstanceUID = sop_uid
+    ds.Modality = modality
+    ds.PatientName = patient_name
+    ds.PatientID = patient_name.split("^")[0]
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    return ds
+
+
+def _decimal_strings(values):
+    """Element ContourData zapisany bezpośrednio jako surowe bajty - bez tworzenia obiektu DSfloat dla każdej liczby."""
+    raw = "\\".join(np.char.mod("%.2f", values.ravel())).encode("ascii")
+    if len(raw) % 2:
+        raw += b" "  # Wartości elementów DICOM muszą mieć parzystą długość
+    return RawDataElement(utils.CONTOUR_DATA_TAG, "DS", len(raw), raw, 0, False, True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic CT series and a matching RTStruct file.")
+    parser.add_argument("output_dir")
+    parser.add_argument("--slices", type=int, default=20)
+    parser.add_argument("--size", type=int, default=256, help="image rows and columns")
+    parser.add_argument("--rois", type=int, default=2)
+    parser.add_argument("--contours", type=int, default=1, help="contours per ROI per slice")
+    parser.add_argument("--points", type=int, default=64, help="points per contour")
+    parser.add_argument("--no-uids", action="store_true", help="omit ContourImageSequence (z-only matching)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compression", choices=list(COMPRESSIONS), help="compress the CT pixel data")
+    args = parser.parse_args()
+
+    ct_dir, rtstruct_path = generate_dataset(args.output_dir, args.slices, args.size, args.rois, args.contours,
+                                             args.points, not args.no_uids, args.seed, args.compression)
+    print(f"CT series: {ct_dir}\nRTStruct: {rtstruct_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pydicom
+import pytest
+
+# Moduły programu leżą w katalogu głównym repozytorium
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic  # noqa: E402
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    """Mała syntetyczna seria CT i pasujący do niej plik RTStruct z trzema strukturami."""
+    return synthetic.generate_dataset(str(tmp_path / "data"), slices=3, size=32, rois=3, points=16)
+
+
+@pytest.fixture
+def rtstruct(dataset):
+    """Plik RTStruct syntetycznego zestawu danych wczytany do obiektu pydicom (do modyfikacji w teście)."""
+    return pydicom.dcmread(dataset[1])
@@ -0,0 +1,29 @@
+import json
+import os
+
+import benchmark
+
+BASELINE_PATH = os.path.join(os.path.dirname(benchmark.__file__), "benchmark_baseline.json")
+
+
+def test_benchmark_tier_measures_every_operation(dataset):
+    results = benchmark.benchmark_tier(*dataset, repeat=1)
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+    assert set(results) == set(baseline["small"])  # Plik bazowy obejmuje wszystkie mierzone operacje
+    for result in results.values():
+        assert result["time"] > 0 and result["peak"] >= 0
+
+
+def test_find_regressions_against_baseline(dataset):
+    results = {"small": benchmark.benchmark_tier(*dataset, repeat=1)}
+    assert benchmark.find_regressions(results, results) == []
+
+    slower = {"small": {name: dict(result, time=result["time"] * 2 + benchmark.MIN_TIME_DELTA)
+                        for name, result in results["small"].items()}}
+    regressions = benchmark.find_regressions(slower, results)
+    assert len(regressions) == len(results["small"])
+    assert all(regression.startswith("small/") and ": time " in regression for regression in regressions)
+
+    noise = {"small": {"Slice.add_structure": {"time": 2e-6, "peak": 0}}}
+    assert benchmark.find_regressions(noise, {"small": {"Slice.add_structure": {"time": 1e-6, "peak": 0}}}) == []
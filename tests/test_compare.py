@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+import compare
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("RTSTRUCT_CACHE_DIR", str(tmp_path / "cache"))
+
+
+def test_self_comparison(dataset):
+    ct_dir, rtstruct_path = dataset
+    rows = compare.compare_batch([(ct_dir, rtstruct_path, rtstruct_path)], workers=1)
+    assert [row["roi_name"] for row in rows] == ["ROI_001", "ROI_002", "ROI_003"]
+    for row in rows:
+        assert row["dice"] == 1 and row["hausdorff_mm"] == 0 and row["reference_voxels"] > 0
+
+
+def test_single_patient_uses_slice_workers(dataset, monkeypatch):
+    ct_dir, rtstruct_path = dataset
+    serial = compare.compare_batch([(ct_dir, rtstruct_path, rtstruct_path)], workers=1)
+    used_workers = []
+    overlap_counts = compare.overlap_counts
+
+    def recording_overlap_counts(volume, pairs, workers=1, *args, **kwargs):
+        used_workers.append(workers)
+        return overlap_counts(volume, pairs, workers, *args, **kwargs)
+
+    monkeypatch.setattr(compare, "overlap_counts", recording_overlap_counts)
+    parallel = compare.compare_batch([(ct_dir, rtstruct_path, rtstruct_path)], workers=2)
+    assert used_workers == [2]
+    assert [row["reference_voxels"] for row in parallel] == [row["reference_voxels"] for row in serial]
+
+
+def test_batch_of_patients(dataset):
+    ct_dir, rtstruct_path = dataset
+    rows = compare.compare_batch([(ct_dir, rtstruct_path, rtstruct_path)] * 2, workers=2)
+    assert len(rows) == 6
+    assert np.allclose([row["dice"] for row in rows], 1)
@@ -0,0 +1,53 @@
+import os
+import shutil
+import threading
+
+import pytest
+
+import dicom_index
+import utils
+
+
+@pytest.fixture
+def index(tmp_path):
+    return dicom_index.DicomIndex(str(tmp_path / "index.sqlite"))
+
+
+def test_incremental_rescan(index, dataset):
+    root = os.path.dirname(dataset[0])
+    assert index.scan(root) == (4, 0, 0)  # 3 slice'y CT i plik RTStruct
+    assert index.scan(root) == (0, 4, 0)
+
+    removed = os.path.join(dataset[0], sorted(os.listdir(dataset[0]))[0])
+    os.remove(removed)
+    shutil.copyfile(dataset[1], os.path.join(root, "copy.dcm"))
+    assert index.scan(root) == (1, 3, 1)
+    assert len(index) == 4
+
+
+def test_resolve_ct(index, dataset):
+    index.scan(os.path.dirname(dataset[0]))
+    structures, patient_name = utils.read_rtstruct(dataset[1])
+    header = index.resolve_ct(dataset[1], structures, patient_name)
+    assert header.kind == utils.CT_IMAGE
+    assert header.sop_uid in structures[0].uid_index  # Slice, do którego odnoszą się kontury
+
+
+def test_resolve_ct_without_contour_uids(index, dataset, rtstruct):
+    for roiContour in rtstruct.ROIContourSequence:
+        for contour in roiContour.ContourSequence:
+            del contour.ContourImageSequence
+    rtstruct.save_as(dataset[1])
+    index.scan(os.path.dirname(dataset[0]))
+    structures, patient_name = utils.read_rtstruct(dataset[1])
+    header = index.resolve_ct(dataset[1], structures, patient_name)
+    series = index.series(header.series_uid)
+    assert len(series) == 3 and header == series[1]  # Środkowy slice serii wskazanej w nagłówku RTStructa
+
+
+def test_cancelled_scan_stops_between_chunks(index, dataset, monkeypatch):
+    monkeypatch.setattr(dicom_index, "SCAN_CHUNK", 1)
+    cancel = threading.Event()
+    read = index.scan(os.path.dirname(dataset[0]), workers=1, progress=lambda done, total: cancel.set(),
+                      cancel=cancel)[0]
+    assert read == 1 and len(index) == 1
@@ -0,0 +1,58 @@
+import threading
+
+import utils
+
+
+def test_step_async_does_not_block_and_reports_latest_slice(dataset):
+    ct_dir, rtstruct_path = dataset
+    structures, _ = utils.read_rtstruct(rtstruct_path)
+    volume = utils.Volume(ct_dir)
+    navigator = utils.SeriesNavigator(volume, structures, prefetch=0)
+    loaded, done = [], threading.Event()
+
+    def on_loaded(index, future):
+        loaded.append((index, future.result()))
+        done.set()
+
+    try:
+        assert navigator.step_async(2, on_loaded) is None  # Slice spoza bufora - wczytywany w tle
+        assert navigator.index == 2
+        assert done.wait(10)
+        index, dicom = loaded[-1]
+        assert index == 2 and dicom.UID == volume.headers[2].SOPInstanceUID
+        assert len(dicom.structures) == len(structures)
+
+        assert navigator.step_async(0, on_loaded) is dicom  # Slice z bufora zwracany od razu
+    finally:
+        navigator.close()
+        volume.close()
+
+
+def test_comparison_is_matched_and_scored_in_the_prefetch_worker(dataset):
+    ct_dir, rtstruct_path = dataset
+    structures, _ = utils.read_rtstruct(rtstruct_path)
+    volume = utils.Volume(ct_dir)
+    navigator = utils.SeriesNavigator(volume, structures, prefetch=0)
+    threads = []
+
+    def metric(dicom, compared):
+        threads.append(threading.current_thread() is threading.main_thread())
+        return {name: 1.0 for name in compared}
+
+    try:
+        navigator.set_comparison(structures, metric)
+        loaded, done = [], threading.Event()
+        navigator.step_async(1, lambda index, future: (loaded.append(future.result()), done.set()))
+        assert done.wait(10)
+        dicom = loaded[-1]
+        assert dicom.comparison_matches(structures)
+        assert set(dicom.compared_structures) == set(dicom.structures)
+        assert dicom.comparison_scores == {name: 1.0 for name in dicom.structures}
+        assert threads and not any(threads)  # Wynik porównania wyznaczony poza wątkiem głównym
+
+        navigator.set_comparison(None)  # Usunięcie porównania czyści bufor slice'ów
+        dicom = navigator.get(1)
+        assert dicom.compared_structures == {} and dicom.comparison_scores is None
+    finally:
+        navigator.close()
+        volume.close()
@@ -0,0 +1,41 @@
+import numpy as np
+from matplotlib.path import Path
+
+import rasterize
+
+
+def circle(cx, cy, radius, count=40):
+    angles = np.linspace(0, 2 * np.pi, count, endpoint=False)
+    return np.column_stack([cx + radius * np.cos(angles), cy + radius * np.sin(angles)])
+
+
+def reference_mask(contours, shape):
+    """Maska wzorcowa: środki pikseli wewnątrz nieparzystej liczby konturów (matplotlib Path)."""
+    rows, cols = np.mgrid[:shape[0], :shape[1]]
+    centres = np.column_stack([cols.ravel(), rows.ravel()])
+    inside = np.zeros(len(centres), dtype=bool)
+    for contour in contours:
+        inside ^= Path(contour).contains_points(centres)
+    return inside.reshape(shape)
+
+
+def test_rasterize_contours_matches_reference_mask_with_hole():
+    shape = (40, 48)
+    contours = [circle(20.3, 18.7, 14.2), circle(22.1, 17.4, 5.3, count=17)]  # Kontur zewnętrzny i dziura
+    points = np.concatenate(contours)
+    offsets = np.cumsum([0] + [len(contour) for contour in contours])
+
+    mask = rasterize.rasterize_contours(points, offsets, shape)
+    expected = reference_mask(contours, shape)
+    assert mask.dtype == bool and mask.shape == shape
+    assert np.array_equal(mask, expected)
+    assert not mask[17, 22] and mask[18, 10]  # Środek dziury poza maską, pierścień wewnątrz
+
+
+def test_rasterize_contours_clips_to_image_and_handles_empty_input():
+    square = np.array([[-5.5, -5.5], [10.5, -5.5], [10.5, 3.5], [-5.5, 3.5]])
+    mask = rasterize.rasterize_contours(square, np.array([0, 4]), (8, 8))
+    expected = np.zeros((8, 8), dtype=bool)
+    expected[:4, :] = True
+    assert np.array_equal(mask, expected)
+    assert not rasterize.rasterize_contours(np.empty((0, 2)), np.array([0]), (8, 8)).any()
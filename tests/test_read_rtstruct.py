@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+import utils
+
+
+def _read_both(path, rois=None):
+    """Wyniki wczytania pliku RTStruct w obu trybach: (zwykły, strumieniowy)."""
+    return utils.read_rtstruct(path, rois)[0], utils.read_rtstruct(path, rois, streaming=True)[0]
+
+
+def _summary(structures):
+    return [(s.name, int(s.number), s.contour_count()) for s in structures]
+
+
+def test_streaming_matches_regular(dataset):
+    regular, streaming = _read_both(dataset[1])
+    assert _summary(regular) == _summary(streaming)
+    for a, b in zip(regular, streaming):
+        np.testing.assert_array_equal(a.points, b.points)
+        assert a.uid_index == b.uid_index
+
+
+def test_names_matched_by_roi_number(dataset, rtstruct):
+    # Sekwencja nazw struktur w odwrotnej kolejności niż sekwencja konturów
+    rtstruct.StructureSetROISequence = list(reversed(rtstruct.StructureSetROISequence))
+    rtstruct.save_as(dataset[1])
+
+    for structures in _read_both(dataset[1]):
+        assert [(s.name, int(s.number)) for s in structures] == [("ROI_001", 1), ("ROI_002", 2), ("ROI_003", 3)]
+    for rois in (["ROI_001"], [3]):
+        regular, streaming = _read_both(dataset[1], rois)
+        assert _summary(regular) == _summary(streaming) and len(regular) == 1
+
+
+@pytest.mark.parametrize("empty", [False, True])
+def test_contour_without_data_is_skipped(dataset, rtstruct, empty):
+    contour = rtstruct.ROIContourSequence[0].ContourSequence[1]
+    if empty:
+        contour.ContourData = []
+    else:
+        del contour.ContourData
+    rtstruct.save_as(dataset[1])
+
+    regular, streaming = _read_both(dataset[1])
+    assert _summary(regular) == _summary(streaming)
+    assert [s.contour_count() for s in regular] == [2, 3, 3]
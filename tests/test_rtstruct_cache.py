@@ -0,0 +1,140 @@
+import json
+import multiprocessing
+import os
+import shutil
+
+import numpy as np
+
+import rtstruct_cache
+import utils
+
+
+def _assert_same(structures, expected):
+    assert [(s.name, s.number, s.contour_count()) for s in structures] == \
+           [(s.name, s.number, s.contour_count()) for s in expected]
+    for structure, reference in zip(structures, expected):
+        np.testing.assert_array_equal(structure.points, reference.points)
+        assert structure.uid_index == reference.uid_index
+
+
+def test_reload_roi_without_contours(tmp_path, dataset, rtstruct):
+    rtstruct.ROIContourSequence[1].ContourSequence = []
+    rtstruct.save_as(dataset[1])
+    expected, _ = utils.read_rtstruct(dataset[1])
+    assert expected[1].contour_count() == 0
+
+    cache_dir = str(tmp_path / "cache")
+    rtstruct_cache.RTStructCache(cache_dir).load(dataset[1])
+    cache = rtstruct_cache.RTStructCache(cache_dir)  # Nowa sesja - wpis czytany z dysku
+    structures, patient_name = cache.load(dataset[1])
+
+    assert cache.hits == 1 and cache.misses == 0
+    assert str(patient_name) == str(rtstruct.PatientName)
+    _assert_same(structures, expected)
+
+
+def test_undecodable_entry_is_evicted(tmp_path, dataset, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    rtstruct_cache.RTStructCache(cache_dir).load(dataset[1])
+
+    def broken_entry(entry_path):
+        raise IndexError("broken entry")
+
+    cache = rtstruct_cache.RTStructCache(cache_dir)
+    with monkeypatch.context() as patch:
+        patch.setattr(rtstruct_cache, "_read_entry", broken_entry)
+        assert cache.get(dataset[1]) is None
+    assert cache.size_bytes() == 0
+
+    structures, _ = cache.load(dataset[1])  # Plik parsowany ponownie i zapisywany w cache'u
+    assert cache.misses == 1
+    _assert_same(structures, utils.read_rtstruct(dataset[1])[0])
+
+
+def test_read_only_cache_does_not_write(tmp_path, dataset):
+    cache_dir = str(tmp_path / "cache")
+    cache = rtstruct_cache.RTStructCache(cache_dir, read_only=True)
+    structures, _ = cache.load(dataset[1])
+    assert cache.load(dataset[1])[0] is structures  # Drugi odczyt z pamięci procesu
+    assert os.listdir(cache_dir) == []
+
+    rtstruct_cache.RTStructCache(cache_dir).load(dataset[1])
+    index_mtime = os.stat(os.path.join(cache_dir, rtstruct_cache.INDEX_FILE_NAME)).st_mtime_ns
+    cache = rtstruct_cache.RTStructCache(cache_dir, read_only=True)
+    cache.load(dataset[1])
+    assert cache.hits == 1
+    assert os.stat(os.path.join(cache_dir, rtstruct_cache.INDEX_FILE_NAME)).st_mtime_ns == index_mtime
+
+
+def _copies(path, count, directory):
+    """Kopie pliku RTStruct pod różnymi ścieżkami - każda ma osobny wpis w cache'u."""
+    copies = []
+    for i in range(count):
+        copy = os.path.join(directory, f"rtstruct_{i}.dcm")
+        shutil.copyfile(path, copy)
+        copies.append(copy)
+    return copies
+
+
+def _index(cache_dir):
+    with open(os.path.join(cache_dir, rtstruct_cache.INDEX_FILE_NAME)) as f:
+        return json.load(f)["entries"]
+
+
+def test_hit_does_not_rewrite_index(tmp_path, dataset):
+    cache_dir = str(tmp_path / "cache")
+    rtstruct_cache.RTStructCache(cache_dir).load(dataset[1])
+    index_path = os.path.join(cache_dir, rtstruct_cache.INDEX_FILE_NAME)
+    written = os.stat(index_path).st_mtime_ns, _index(cache_dir)
+
+    cache = rtstruct_cache.RTStructCache(cache_dir)
+    for _ in range(3):
+        cache.load(dataset[1])
+    assert cache.hits == 3
+    assert (os.stat(index_path).st_mtime_ns, _index(cache_dir)) == written
+
+    cache.close()  # Zaległy czas użycia wpisu zapisywany jest przy zamknięciu
+    (entry,) = _index(cache_dir).values()
+    assert entry["last_access"] > next(iter(written[1].values()))["last_access"]
+
+
+def test_entries_of_other_instances_are_kept(tmp_path, dataset):
+    cache_dir = str(tmp_path / "cache")
+    first, second = _copies(dataset[1], 2, str(tmp_path))
+    a, b = rtstruct_cache.RTStructCache(cache_dir), rtstruct_cache.RTStructCache(cache_dir)
+    a.load(first)
+    b.load(second)  # b nie widział wpisu a - zapis indeksu nie może go usunąć
+    assert sorted(entry["path"] for entry in _index(cache_dir).values()) == [first, second]
+    assert rtstruct_cache.RTStructCache(cache_dir).get(first) is not None
+
+
+def test_evict_enforces_limit_across_instances(tmp_path, dataset):
+    cache_dir = str(tmp_path / "cache")
+    first, second = _copies(dataset[1], 2, str(tmp_path))
+    a = rtstruct_cache.RTStructCache(cache_dir)
+    a.load(first)
+    entry_bytes = a.size_bytes()
+    orphan = os.path.join(cache_dir, "0" * 40 + ".npz")
+    shutil.copyfile(os.path.join(cache_dir, next(iter(_index(cache_dir))) + ".npz"), orphan)
+
+    b = rtstruct_cache.RTStructCache(cache_dir, max_bytes=entry_bytes)
+    b.load(second)
+    assert [entry["path"] for entry in _index(cache_dir).values()] == [second]
+    assert sorted(name for name in os.listdir(cache_dir) if name.endswith(".npz")) == \
+           sorted(key + ".npz" for key in _index(cache_dir))
+
+
+def _load_in_process(args):
+    cache_dir, path = args
+    cache = rtstruct_cache.RTStructCache(cache_dir)
+    cache.load(path)
+    cache.close()
+
+
+def test_concurrent_processes_share_index(tmp_path, dataset):
+    cache_dir = str(tmp_path / "cache")
+    paths = _copies(dataset[1], 8, str(tmp_path))
+    with multiprocessing.Pool(4) as pool:
+        pool.map(_load_in_process, [(cache_dir, path) for path in paths])
+    assert sorted(entry["path"] for entry in _index(cache_dir).values()) == sorted(paths)
+    assert len([name for name in os.listdir(cache_dir) if name.endswith(".npz")]) == len(paths)
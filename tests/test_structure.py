@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+
+import utils
+
+
+def _structure(contours, z=0.0):
+    """Struktura z konturów 2D (macierze N x 2) leżących na płaszczyźnie 'z'."""
+    points = np.concatenate([np.column_stack([contour, np.full(len(contour), z)]) for contour in contours])
+    offsets = np.cumsum([0] + [len(contour) for contour in contours])
+    return utils.Structure("ROI", number=1, points=points, offsets=offsets)
+
+
+def _line_distance(point, a, b):
+    ab, ap = b - a, point - a
+    length = np.hypot(*ab)
+    return abs(ab[0] * ap[1] - ab[1] * ap[0]) / length if length > 0 else np.hypot(*ap)
+
+
+def _douglas_peucker(contour, tolerance):
+    """Rekurencyjna implementacja wzorcowa - indeksy punktów pozostawionych w konturze."""
+    def split(first, last):
+        if last - first < 2:
+            return []
+        distances = [_line_distance(contour[i], contour[first], contour[last]) for i in range(first + 1, last)]
+        farthest = int(np.argmax(distances))
+        if distances[farthest] <= tolerance:
+            return []
+        index = first + 1 + farthest
+        return split(first, index) + [index] + split(index, last)
+    return [0] + split(0, len(contour) - 1) + [len(contour) - 1]
+
+
+def test_simplified_keeps_endpoints_and_stays_within_tolerance():
+    rng = np.random.default_rng(7)
+    angles = np.linspace(0, 2 * np.pi, 200)
+    contours = [np.column_stack([c + (r + rng.normal(0, 0.6, len(angles))) * np.cos(angles),
+                                 c + (r + rng.normal(0, 0.6, len(angles))) * np.sin(angles)])
+                for c, r in ((0, 30), (5, 8))]
+    structure = _structure(contours)
+
+    for tolerance in utils.LOD_LEVELS:
+        lod = structure.simplified(tolerance)
+        assert lod is structure.simplified(tolerance)  # Wynik zapamiętany dla tolerancji
+        assert lod.contour_count() == structure.contour_count()
+        for contour, simplified in zip(structure.contours, lod.contours):
+            kept = _douglas_peucker(contour[:, :2], tolerance)
+            np.testing.assert_array_equal(simplified, contour[kept])
+            np.testing.assert_array_equal(simplified[[0, -1]], contour[[0, -1]])  # Końce konturu zachowane
+            # Każdy usunięty punkt leży nie dalej niż tolerance od odcinka uproszczonego konturu
+            for first, last in zip(kept[:-1], kept[1:]):
+                for point in contour[first + 1:last, :2]:
+                    assert _line_distance(point, contour[first, :2], contour[last, :2]) <= tolerance
+        assert len(lod.points) < len(structure.points)
+    assert structure.simplified(0) is structure
+
+
+def test_section_of_convex_contour_matches_analytic_chord():
+    # Romb |x - 10| + |y + 5| <= 8 na dwóch slice'ach - przekrój płaszczyzną to jeden odcinek na każdym slice'u
+    diamond = np.array([[18.0, -5.0], [10.0, 3.0], [2.0, -5.0], [10.0, -13.0]])
+    points = np.concatenate([np.column_stack([diamond, np.full(4, z)]) for z in (-2.5, 2.5)])
+    structure = utils.Structure("ROI", number=1, points=points, offsets=np.array([0, 4, 8]))
+
+    for position in (-12.5, -7.0, -5.0, 0.25, 2.9):
+        half = 8 - abs(position + 5)
+        expected = [[10 - half, 10 + half, -2.5], [10 - half, 10 + half, 2.5]]
+        np.testing.assert_allclose(structure.section(utils.CORONAL, position), expected)
+        np.testing.assert_allclose(utils.plane_intersections(points, structure.offsets, utils.CORONAL, position),
+                                   expected)
+    for position in (3.5, 10.0, 9.0):
+        half = 8 - abs(position - 10)
+        np.testing.assert_allclose(structure.section(utils.SAGITTAL, position),
+                                   [[-5 - half, -5 + half, -2.5], [-5 - half, -5 + half, 2.5]])
+
+    assert structure.section(utils.CORONAL, 20.0).shape == (0, 3)  # Płaszczyzna poza konturem
+    assert structure.section(utils.CORONAL, 0.25) is structure.section(utils.CORONAL, 0.25)  # Wynik zapamiętany
+
+
+def test_section_is_split_by_hole():
+    square = np.array([[0.0, 0.0], [10.0, 0.0], [10.0, 10.0], [0.0, 10.0]])
+    hole = np.array([[3.0, 3.0], [7.0, 3.0], [7.0, 7.0], [3.0, 7.0]])
+    structure = _structure([square, hole])
+    np.testing.assert_allclose(structure.section(utils.CORONAL, 5.0), [[0, 3, 0], [7, 10, 0]])
+
+
+def test_contours_near_z_selects_contours_within_tolerance():
+    square = np.array([[0.0, 0.0], [1.0, 0.0], [1.0, 1.0]])
+    z = [5.0, -2.5, 0.0, 2.5, 0.0, 1.2]
+    points = np.concatenate([np.column_stack([square, np.full(3, contour_z)]) for contour_z in z])
+    structure = utils.Structure("ROI", number=1, points=points, offsets=np.arange(0, 3 * len(z) + 1, 3))
+
+    np.testing.assert_array_equal(structure.contours_near_z(0.0, 1.25), [2, 4, 5])
+    np.testing.assert_array_equal(structure.contours_near_z(0.0, 2.5), [1, 2, 3, 4, 5])  # Granice włącznie
+    np.testing.assert_array_equal(structure.contours_near_z(5.0, 0.1), [0])
+    assert len(structure.contours_near_z(10.0, 1.0)) == 0
+
+
+def test_match_z_without_contour_uids_matches_uid_matching(dataset, rtstruct):
+    ct_dir, rtstruct_path = dataset
+    with_uids, _ = utils.read_rtstruct(rtstruct_path)
+    for roiContour in rtstruct.ROIContourSequence:
+        for contour in roiContour.ContourSequence:
+            del contour.ContourImageSequence
+    rtstruct.save_as(rtstruct_path)
+    without_uids, _ = utils.read_rtstruct(rtstruct_path)
+    assert all(set(structure.uid_index) == {""} for structure in without_uids)  # Kontury bez UID odniesienia
+
+    for name in sorted(os.listdir(ct_dir)):
+        dicom = utils.Slice(os.path.join(ct_dir, name))
+        dicom.match_mode = utils.MATCH_UID
+        expected = dicom.match_structures(with_uids)
+        assert expected and dicom.match_structures(without_uids) == {}  # Bez UID dopasowanie po UID nic nie znajduje
+
+        dicom.match_mode = utils.MATCH_Z
+        matched = dicom.match_structures(without_uids)
+        assert matched.keys() == expected.keys()
+        for number, structure in matched.items():
+            np.testing.assert_array_equal(structure.offsets, expected[number].offsets)
+            np.testing.assert_allclose(structure.points, expected[number].points)
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+import rasterize
+import structure_stats
+import utils
+
+
+def _ellipse(center, a, b, z, points=4000):
+    angle = np.linspace(0, 2 * np.pi, points, endpoint=False)
+    return np.column_stack([center[0] + a * np.cos(angle), center[1] + b * np.sin(angle), np.full(points, z)]).ravel()
+
+
+def test_geometry_of_ellipse_with_hole():
+    structure = utils.Structure("Ring", [255, 0, 0], 1)
+    # Trzy płaszczyzny co 2 mm, na każdej elipsa z okrągłą dziurą (obie obiegane w tym samym kierunku)
+    structure.set_contours({f"uid{k}": [_ellipse((10, -5), 30, 15, 2.0 * k), _ellipse((20, -5), 6, 6, 2.0 * k)]
+                            for k in range(3)})
+    row, slice_rows = structure_stats.structure_geometry(structure)
+
+    area = np.pi * (30 * 15 - 6 * 6)
+    assert [r["area_mm2"] for r in slice_rows] == pytest.approx([area] * 3, rel=1e-4)
+    assert row["slices"] == 3 and row["contours"] == 6
+    assert row["volume_cm3"] == pytest.approx(3 * area * 2.0 / 1000, rel=1e-4)
+    assert row["centroid_x_mm"] == pytest.approx((450 * 10 - 36 * 20) / 414, rel=1e-4)
+    assert row["centroid_y_mm"] == pytest.approx(-5, abs=1e-6)
+    assert row["centroid_z_mm"] == pytest.approx(2.0)
+    assert (row["min_x_mm"], row["max_x_mm"]) == pytest.approx((-20, 40))
+
+
+def test_hu_statistics_match_masks(dataset):
+    ct_dir, rtstruct_path = dataset
+    structures, _ = utils.read_rtstruct(rtstruct_path)
+    expected = [[] for _ in structures]
+    volume = utils.Volume(ct_dir)
+    for index in range(len(volume)):
+        dicom = volume.slice(index)
+        for i, structure in enumerate(structures):
+            matched = dicom.match_structure(structure)
+            if matched is not None:
+                mask = rasterize.structure_mask(matched, dicom.hu_array.shape)
+                expected[i].append(dicom.hu_array[mask])
+    volume.close()
+
+    for workers in (1, 2):
+        volume = utils.Volume(ct_dir)
+        rows, _ = structure_stats.series_statistics(volume, structures, workers=workers)
+        assert volume.decoded.all()  # Slice'y zdekodowane w procesach roboczych trafiają do macierzy serii
+        volume.close()
+        for row, values in zip(rows, expected):
+            values = np.concatenate(values).astype(np.float64)
+            assert row["voxels"] == len(values) > 0
+            assert row["hu_mean"] == pytest.approx(values.mean())
+            assert row["hu_std"] == pytest.approx(values.std())
+            assert (row["hu_min"], row["hu_max"]) == (values.min(), values.max())
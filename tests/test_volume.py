@@ -0,0 +1,27 @@
+import numpy as np
+import pydicom
+import pytest
+
+import utils
+
+
+@pytest.mark.parametrize("backend", [utils.DECODE_THREADS, utils.DECODE_PROCESSES])
+def test_parallel_decode_matches_serial(dataset, backend):
+    ct_dir = dataset[0]
+    serial, parallel = utils.Volume(ct_dir), utils.Volume(ct_dir)
+    try:
+        assert serial.decode_all(workers=1)
+        expected = np.asarray(serial.pixels).copy()
+        for index, path in enumerate(serial.file_paths):
+            np.testing.assert_array_equal(expected[index], pydicom.dcmread(path).pixel_array)
+
+        parallel.pixels[0] = serial.pixels[0]  # Slice zdekodowany wcześniej nie jest dekodowany ponownie
+        parallel.decoded[0] = True
+        progress = []
+        assert parallel.decode_all(lambda done, total: progress.append((done, total)), workers=2, backend=backend)
+        assert progress[0] == (1, len(serial)) and progress[-1] == (len(serial), len(serial))
+        assert parallel.decoded.all()
+        np.testing.assert_array_equal(np.asarray(parallel.pixels), expected)
+    finally:
+        serial.close()
+        parallel.close()
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+import utils
+
+WINDOWS = [(40, 400, 1.0, -1024.0), (-600, 1500, 1.0, -1024.0), (50, 1, 0.5, 0.0)]  # (środek, szerokość, slope, intercept)
+
+
+def _expected(pixels, center, width, slope, intercept):
+    """Kolory wzorcowe - okno liczone wprost z wartości HU przez window_levels."""
+    return utils.DISPLAY_COLORS[utils.window_levels(pixels.astype(np.float64) * slope + intercept, center, width)]
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.uint16])
+@pytest.mark.parametrize("center, width, slope, intercept", WINDOWS)
+def test_lut_window_matches_window_levels_for_16bit_pixels(dtype, center, width, slope, intercept):
+    info = np.iinfo(dtype)
+    rng = np.random.default_rng(3)
+    pixels = rng.integers(info.min, info.max, size=(64, 48), endpoint=True, dtype=dtype)
+    pixels[0, :4] = [info.min, info.max, 0, 1]
+
+    rgba = utils.apply_window(pixels, slope, intercept, center, width)
+    assert rgba.shape == pixels.shape + (4,) and rgba.dtype == np.uint8
+    np.testing.assert_array_equal(rgba, _expected(pixels, center, width, slope, intercept))
+
+    lut = utils.window_lut(dtype, slope, intercept, center, width)
+    assert len(lut) == 2 ** 16 and not lut.flags.writeable
+    assert lut is utils.window_lut(dtype, slope, intercept, center, width)  # Tablica zapamiętana dla okna
+    np.testing.assert_array_equal(lut[pixels.view(np.uint16)].view(np.uint8).reshape(rgba.shape), rgba)
+
+
+@pytest.mark.parametrize("center, width, slope, intercept", WINDOWS)
+def test_float_pixels_use_window_levels(center, width, slope, intercept):
+    pixels = np.linspace(-3000, 3000, 64 * 48, dtype=np.float32).reshape(64, 48)
+    np.testing.assert_array_equal(utils.apply_window(pixels, slope, intercept, center, width),
+                                  _expected(pixels, center, width, slope, intercept))
+
+
+def test_window_levels_reaches_black_and_white_at_window_edges():
+    levels = utils.window_levels([-161, -160, 40, 239, 240], 40, 400)
+    assert levels[0] == 0 and levels[-1] == 255 and 0 < levels[2] < 255
+    assert np.all(np.diff(levels.astype(int)) >= 0)
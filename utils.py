@@ -1,11 +1,25 @@
 import sys
 from matplotlib import pyplot as plt
+from matplotlib.collections import LineCollection, PolyCollection
+from matplotlib.lines import Line2D
 import numpy as np
 import pydicom
+import functools
 import glob
+import mmap
+import multiprocessing
 import os
+import struct
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pydicom.pixels import pixel_array as decode_pixel_data
 from shapely.geometry import Polygon
 
+import profiling
+
 """Moduł zajmujący się wczytywaniem, przetwarzaniem, kombinowaniem i rysowanie, danych obrazowych z DICOM i danych konturowych RTStruct.
 
 Wymagane zewnętrzne biblioteki
@@ -34,10 +48,6 @@ shapely
 # DIR3_DICOMS = glob.glob(os.path.join(DICOM_DIR_PATH3, "*dcm"))
 # DIR3_RTSTRUCTS = glob.glob(os.path.join(RTSTRUCT_DIR_PATH3, "*dcm"))
 
-"""Przetwarzanie RTStructu trwa długo dlatego raz wczytane przechowywane są w słowniku po nazwie pliku (taki jakby cache)
-pozwalający znacznie przyspieszyć wymianę RTStructów w czasie działania programu."""
-loaded_RTStructs = {}
-
 
 class WrongDICOMFileException(Exception):
     """Superklasa wyjątków zgłaszanych w przypadku problemów z przetwarzaniem pliku DICOM."""
@@ -54,48 +64,334 @@ class NotCTImageFileException(WrongDICOMFileException):
     pass
 
 
+# Rodzaje plików DICOM rozpoznawane przez funkcję probe_dicom
+CT_IMAGE = "CT image"
+RTSTRUCT = "RTStruct"
+OTHER = "other"
+
+# Tryby rysowania konturów struktur (atrybut Slice.render_mode)
+RENDER_LINES = "lines"  # osobne wywołanie plot() dla każdego konturu
+RENDER_COLLECTION = "collection"  # jeden obiekt LineCollection na strukturę
+RENDER_FILLED = "filled"  # jeden obiekt PolyCollection na strukturę (kontury z półprzezroczystym wypełnieniem)
+FILL_ALPHA = 0.3
+
+# Tryby dopasowywania konturów do slice'a (atrybut Slice.match_mode)
+MATCH_UID = "uid"  # po ReferencedSOPInstanceUID konturu
+MATCH_Z = "z"  # po współrzędnej 'z' konturu i slice'a (ImagePositionPatient[2])
+MATCH_UID_Z = "uid_z"  # po UID, a dla struktur bez konturów o pasującym UID - po współrzędnej 'z'
+# Tolerancja dopasowania po 'z' dla slice'ów bez atrybutu SliceThickness
+DEFAULT_Z_TOLERANCE = 0.5
+
+# Sposoby równoległego dekodowania danych obrazowych serii (Volume.decode_all)
+DECODE_THREADS = "threads"  # pula wątków - dla dekoderów zwalniających GIL (np. pillow dla JPEG)
+DECODE_PROCESSES = "processes"  # pula procesów zapisujących bezpośrednio do pliku macierzy serii (np. RLE w pydicom)
+
+# Płaszczyzny przekrojów serii
+AXIAL = "axial"  # slice'y serii (płaszczyzna z = const)
+CORONAL = "coronal"  # przekrój czołowy (płaszczyzna y = const)
+SAGITTAL = "sagittal"  # przekrój strzałkowy (płaszczyzna x = const)
+
+# Poziomy uproszczenia konturów (tolerancje algorytmu Douglasa-Peuckera w jednostkach współrzędnych konturów -
+# dla struktur dopasowanych do slice'a są to piksele obrazu) i dopuszczalny błąd uproszczenia na ekranie [px]
+LOD_LEVELS = (0.25, 0.5, 1.0, 2.0, 4.0)
+LOD_SCREEN_TOLERANCE = 1.0
+
+# Predefiniowane okna wyświetlania obrazu CT: {nazwa: (środek okna, szerokość okna)} [HU]
+WINDOW_PRESETS = {
+    "Soft tissue": (40, 400),
+    "Lung": (-600, 1500),
+    "Bone": (400, 1800),
+    "Brain": (40, 80),
+    "Liver": (60, 160),
+}
+# Mapa kolorów obrazu CT jako tablica 256 kolorów RGBA (uint8) - składana z tablicą LUT okna wyświetlania
+DISPLAY_COLORS = plt.get_cmap("bone")(np.linspace(0, 1, 256), bytes=True)
+
+RTSTRUCT_SOP_CLASS_UID = "1.2.840.10008.5.1.4.1.1.481.3"
+
+# Znaczniki czytane przez probe_dicom - wszystkie leżą w pliku przed sekwencjami konturów i danymi obrazowymi
+PROBE_TAGS = [pydicom.tag.Tag(keyword) for keyword in
+              ("SpecificCharacterSet", "SOPClassUID", "SOPInstanceUID", "Modality", "PatientName", "PatientID",
+               "StudyInstanceUID", "SeriesInstanceUID", "ImagePositionPatient", "Rows")]
+_LAST_PROBE_TAG = max(PROBE_TAGS)
+
+ROI_CONTOUR_TAG = pydicom.tag.Tag("ROIContourSequence")
+CONTOUR_DATA_TAG = pydicom.tag.Tag("ContourData")
+
+"""Metadane pliku DICOM zwracane przez funkcję probe_dicom - kind to jedna ze stałych CT_IMAGE, RTSTRUCT, OTHER."""
+DicomHeader = namedtuple("DicomHeader", ["path", "kind", "patient_name", "patient_id", "study_uid", "series_uid",
+                                         "sop_uid", "modality", "z"])
+
+
+def probe_dicom(file_path: str):
+    """
+    Funkcja wczytująca z pliku DICOM wyłącznie metadane potrzebne do jego klasyfikacji i dopasowania do pacjenta.
+    Odczyt kończy się na ostatnim potrzebnym znaczniku, więc nie są czytane ani dane obrazowe, ani dane konturowe -
+    czas działania nie zależy od rozmiaru pliku.
+    :param file_path: ścieżka do pliku DICOM
+    :return: obiekt DicomHeader
+    """
+    try:
+        with open(file_path, "rb") as f:
+            header = pydicom.filereader.read_partial(f, stop_when=lambda tag, vr, length: tag > _LAST_PROBE_TAG,
+                                                     specific_tags=PROBE_TAGS)
+    except pydicom.errors.InvalidDicomError:
+        return DicomHeader(file_path, OTHER, None, None, None, None, None, None, None)
+
+    modality = header.get("Modality")
+    if header.get("SOPClassUID") == RTSTRUCT_SOP_CLASS_UID or modality == "RTSTRUCT":
+        kind = RTSTRUCT
+    elif "Rows" in header and "ImagePositionPatient" in header:
+        kind = CT_IMAGE
+    else:
+        kind = OTHER
+    z = float(header.ImagePositionPatient[2]) if "ImagePositionPatient" in header else None
+    return DicomHeader(file_path, kind, header.get("PatientName"), header.get("PatientID"),
+                       header.get("StudyInstanceUID"), header.get("SeriesInstanceUID"), header.get("SOPInstanceUID"),
+                       modality, z)
+
+
 class Structure:
-    """Klasa reprezentująca pojedynczą strukturę - np. kości, skóra, płuco lewe, pęcherz itp."""
+    """Klasa reprezentująca pojedynczą strukturę - np. kości, skóra, płuco lewe, pęcherz itp.
+
+    Kontury struktury przechowywane są w jednej ciągłej macierzy punktów points, a granice poszczególnych konturów
+    wyznacza macierz offsets (kontur i to wiersze points[offsets[i]:offsets[i + 1]]). Kontury odnoszące się do tego
+    samego slice'a leżą w macierzy points obok siebie, a słownik uid_index przechowuje zakres ich indeksów.
+    Dla konturów we współrzędnych pacjenta budowany jest też indeks przestrzenny: posortowane współrzędne 'z' konturów
+    (z_sorted) i odpowiadające im indeksy konturów (z_order) - pozwala on dopasować kontury do slice'a po jego
+    położeniu, gdy UID odniesienia konturów nie wskazuje na slice.
+    Uproszczone wersje konturów (poziomy szczegółowości LOD) wyznaczane są z ważności punktów (_importance) i
+    zapamiętywane w słowniku _lod {tolerancja: uproszczona struktura}, a przekroje struktury płaszczyznami
+    czołowymi i strzałkowymi - w słowniku _sections {(płaszczyzna, położenie): odcinki przekroju}.
+    """
 
-    def __init__(self, name=None, color=None, number=None, contours=None):
+    __slots__ = ("name", "color", "number", "points", "offsets", "uid_index", "z_sorted", "z_order", "_importance",
+                 "_lod", "_sections")
+
+    def __init__(self, name=None, color=None, number=None, points=None, offsets=None, uid_index=None):
         """
         Inicjalizacja obiektu klasy Structure
         :param name: nazwa struktury reprezentowanej przez przechowywane w obiekcie kontury
         :param color: preferowany kolor konturów struktury
         :param number: numer struktury w danym pliku RTStruct
-        :param contours: kontury danej struktury w postaci macierzy 3D punktów (we współrzędnych odnoszących się
-         do położenia pacjenta w przestrzeni, a nie we współrzędnych odnoszących się do pikseli obrazu)
+        :param points: punkty wszystkich konturów struktury w postaci macierzy N x 3 (we współrzędnych odnoszących się
+         do położenia pacjenta w przestrzeni) lub N x 2 (we współrzędnych odnoszących się do pikseli obrazu)
+        :param offsets: indeksy początków kolejnych konturów w macierzy points (+ indeks końca ostatniego konturu)
+        :param uid_index: słownik {UID odniesienia: (indeks pierwszego konturu, indeks za ostatnim konturem)}
         """
         self.name = name
         self.color = color
         self.number = number
-        self.contours = contours
+        self.points = points
+        self.offsets = offsets
+        self.uid_index = uid_index if uid_index is not None else {}
+        self.z_sorted = self.z_order = None
+        self._importance = None
+        self._lod = {}
+        self._sections = {}
+        if points is not None and points.shape[1] == 3:
+            self.build_z_index()
 
     def __repr__(self):
-        len_points = len(self.contours) if self.contours is not None else 0
-        return f"<name={self.name}, color={self.color}, number={self.number}, contours: {len_points} contours>"
+        return f"<name={self.name}, color={self.color}, number={self.number}, contours: {self.contour_count()} contours>"
+
+    @property
+    def contours(self):
+        """Lista macierzy punktów kolejnych konturów (widoki na macierz points, bez kopiowania danych)."""
+        if self.points is None:
+            return []
+        return np.split(self.points, self.offsets[1:-1])
+
+    def contour_count(self):
+        """Liczba konturów struktury."""
+        return len(self.offsets) - 1 if self.offsets is not None else 0
+
+    def set_contours(self, contours):
+        """
+        Metoda konwertująca kontury pogrupowane po UID odniesienia do ciągłej macierzy punktów.
+        Konwersja wykonywana jest jednorazowo przy parsowaniu pliku RTStruct.
+        :param contours: słownik {UID odniesienia: [lista wektorów punktów konturu (ContourData)]}
+        :return: None
+        """
+        arrays = []
+        self.uid_index = {}
+        for uid, uid_contours in contours.items():
+            first = len(arrays)
+            arrays.extend(np.asarray(contour, dtype=np.float64).reshape(-1, 3) for contour in uid_contours)
+            self.uid_index[uid] = (first, len(arrays))
+
+        self.offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(contour) for contour in arrays], out=self.offsets[1:])
+        self.points = np.concatenate(arrays) if arrays else np.empty((0, 3))
+        self._importance = None
+        self._lod = {}
+        self._sections = {}
+        self.build_z_index()
+
+    def build_z_index(self):
+        """Budowa indeksu przestrzennego - kontury posortowane po współrzędnej 'z' (kontury RTStruct są płaskie,
+         więc 'z' konturu to 'z' jego pierwszego punktu)."""
+        z = self.points[self.offsets[:-1], 2]
+        self.z_order = np.argsort(z, kind="stable")
+        self.z_sorted = z[self.z_order]
+
+    def contours_near_z(self, z: float, tolerance: float):
+        """
+        Wyszukiwanie binarne konturów leżących w odległości co najwyżej tolerance od płaszczyzny 'z'.
+        :param z: współrzędna 'z' płaszczyzny (np. slice'a)
+        :param tolerance: maksymalna odległość konturu od płaszczyzny
+        :return: posortowana macierz indeksów konturów
+        """
+        first = np.searchsorted(self.z_sorted, z - tolerance, side="left")
+        stop = np.searchsorted(self.z_sorted, z + tolerance, side="right")
+        return np.sort(self.z_order[first:stop])
+
+    def simplified(self, tolerance: float):
+        """
+        Struktura z konturami uproszczonymi algorytmem Douglasa-Peuckera - wynik zapamiętywany jest dla każdej
+        tolerancji, a ważność punktów (wspólna dla wszystkich tolerancji) wyznaczana jest tylko raz.
+        :param tolerance: maksymalna odległość usuniętych punktów od uproszczonego konturu (0 - bez uproszczenia)
+        :return: obiekt Structure (self dla tolerancji 0)
+        """
+        if tolerance <= 0 or self.points is None:
+            return self
+        lod = self._lod.get(tolerance)
+        if lod is None:
+            if self._importance is None:
+                self._importance = contour_importance(self.points, self.offsets)
+            points, offsets = select_points(self.points, self.offsets, self._importance > tolerance)
+            lod = Structure(self.name, self.color, self.number, points, offsets, self.uid_index)
+            self._lod[tolerance] = lod
+        return lod
+
+    def build_lod(self, levels=LOD_LEVELS):
+        """Wyznaczenie z góry uproszczonych konturów dla wszystkich poziomów szczegółowości (np. w wątku roboczym)."""
+        for level in levels:
+            self.simplified(level)
+
+    def section(self, axis: str, position: float):
+        """
+        Przekrój struktury płaszczyzną czołową lub strzałkową - wynik zapamiętywany jest dla każdego położenia
+        płaszczyzny, więc ponowne przejście przez to samo położenie nie wymaga obliczeń.
+        :param axis: płaszczyzna przekroju (CORONAL lub SAGITTAL)
+        :param position: położenie płaszczyzny (współrzędna 'y' dla CORONAL, 'x' dla SAGITTAL) [mm]
+        :return: macierz K x 3 odcinków przekroju (początek, koniec, 'z') - wynik plane_intersections
+        """
+        key = (axis, position)
+        section = self._sections.get(key)
+        if section is None:
+            section = plane_intersections(self.points, self.offsets, axis, position)
+            self._sections[key] = section
+        return section
 
 
 class Slice:
     """Klasa reprezentująca plik z danymi obrazowymi DICOM (pojedynczy slice) w kombinacji z pasującymi do niego
      strukturami z RTStruct."""
 
-    def __init__(self, file_path: str = None):
+    @profiling.timed("Slice.__init__")
+    def __init__(self, file_path: str = None, volume=None, index: int = None, header=None):
         """
         Inicjalizacja obiektu klasy DicomFile
         :param file_path: ścieżka pliku DICOM zawierającego dane obrazowe
+        :param volume: obiekt klasy Volume, którego widokiem ma być tworzony slice (zamiast wczytywania pliku file_path)
+        :param index: indeks slice'a w obiekcie volume
+        :param header: nagłówek pliku DICOM bez danych obrazowych - slice wyłącznie z geometrią (np. do dopasowania
+         i rasteryzacji konturów w procesach roboczych)
         """
-        if file_path is not None:
+        self.volume = volume
+        if header is not None:
+            self.index = index
+            self.file_path = file_path
+            self.dcm = header
+            self._init_geometry()
+        elif volume is not None:
+            # Slice jako tani widok na serię - nagłówek jest już wczytany, a piksele dekodowane są dopiero na żądanie
+            self.index = index
+            self.file_path = volume.file_paths[index]
+            self.dcm = volume.headers[index]
+            self._init_geometry()
+        elif file_path is not None:
             self.file_path = file_path
+            # Szybkie odrzucenie pliku bez danych obrazowych - przed wczytaniem całego pliku
+            if probe_dicom(file_path).kind != CT_IMAGE:
+                raise NotCTImageFileException("Passed DICOM file is not CT image data file")
             self.dcm = pydicom.dcmread(file_path)
             try:
                 self.dcm.PixelData  # Jeśli załadowany DICOM nie ma atrybutu PixelData to nie zawiera danych obrazowych
             except AttributeError:
                 raise NotCTImageFileException("Passed DICOM file is not CT image data file")
-            self.UID = self.dcm.SOPInstanceUID
-            self.z = self.dcm.ImagePositionPatient[2]
-            self.structures = {}
-            self.axes = plt  # Podpięcie pyplota do utworzonego obiektu - wykorzystywane przy testowaniu modułu.
+            self._init_geometry()
+
+    def _init_geometry(self):
+        """Inicjalizacja atrybutów slice'a wyznaczanych na podstawie nagłówka pliku DICOM."""
+        self.UID = self.dcm.SOPInstanceUID
+        self.z = self.dcm.ImagePositionPatient[2]
+        # Parametry przekształcenia współrzędnych 'przestrzennych' na piksele obrazu
+        self.origin = np.asarray(self.dcm.ImagePositionPatient[:2], dtype=np.float64)
+        self.spacing = np.asarray(self.dcm.PixelSpacing, dtype=np.float64)
+        self.structures = {}
+        # Kontury porównywanego RTStructa dopasowane do slice'a i wynik porównania (Slice.match_comparison)
+        self.compared_rtstruct = None
+        self.compared_match_mode = None
+        self.compared_structures = {}
+        self.comparison_scores = None
+        self.axes = plt  # Podpięcie pyplota do utworzonego obiektu - wykorzystywane przy testowaniu modułu.
+        self.render_mode = RENDER_COLLECTION
+        self.match_mode = MATCH_UID_Z
+        # Kontur pasuje do slice'a po 'z', jeśli leży w obrębie grubości slice'a
+        thickness = self.dcm.get("SliceThickness")
+        self.z_tolerance = float(thickness) / 2 if thickness else DEFAULT_Z_TOLERANCE
+        # Parametry przekształcenia wartości pikseli na jednostki Hounsfielda (HU = slope * wartość + intercept)
+        self.slope = float(self.dcm.get("RescaleSlope", 1) or 1)
+        self.intercept = float(self.dcm.get("RescaleIntercept", 0) or 0)
+        self._hu = None
+        self._display = None
+
+    @property
+    def pixel_array(self):
+        """Dane obrazowe slice'a - dla slice'a będącego widokiem na serię pobierane ze wspólnej macierzy obiektu Volume."""
+        if self.volume is not None:
+            return self.volume.pixel_array(self.index)
+        return self.dcm.pixel_array
+
+    @property
+    def hu_array(self):
+        """Obraz slice'a w jednostkach Hounsfielda (float32) - przeliczany raz i zapamiętywany."""
+        if self._hu is None:
+            self._hu = self.to_hu(self.pixel_array)
+        return self._hu
+
+    def to_hu(self, pixels):
+        """Przekształcenie modalności - wartości pikseli slice'a przeliczone na jednostki Hounsfielda (float32)."""
+        return pixels.astype(np.float32) * self.slope + self.intercept
+
+    def default_window(self):
+        """
+        Okno wyświetlania zapisane w pliku DICOM (WindowCenter/WindowWidth - pierwsze z okien, jeśli jest ich kilka),
+        a w razie jego braku okno obejmujące cały zakres wartości obrazu.
+        :return: środek okna, szerokość okna [HU]
+        """
+        center, width = self.dcm.get("WindowCenter"), self.dcm.get("WindowWidth")
+        if center is not None and width is not None:
+            first = lambda value: float(value[0] if isinstance(value, pydicom.multival.MultiValue) else value)
+            return first(center), first(width)
+        low, high = float(self.hu_array.min()), float(self.hu_array.max())
+        return (low + high) / 2, max(high - low, 1.0)
+
+    def display_array(self, window=None):
+        """
+        Obraz slice'a gotowy do wyświetlenia - wartości pikseli przekształcone tablicą LUT okna wyświetlania
+        bezpośrednio na kolory RGBA (matplotlib nie musi już normalizować obrazu). Wynik dla ostatniego okna jest
+        zapamiętywany.
+        :param window: okno wyświetlania (środek, szerokość) [HU], domyślnie okno z pliku DICOM (default_window)
+        :return: macierz (wiersze, kolumny, 4) uint8
+        """
+        if window is None:
+            window = self.default_window()
+        if self._display is None or self._display[0] != window:
+            self._display = window, apply_window(self.pixel_array, self.slope, self.intercept, *window)
+        return self._display[1]
 
     def __repr__(self):
         return f"<file_path={self.file_path}, z={self.z}, structures={len(self.structures)}>"
@@ -106,28 +402,60 @@ class Slice:
         :param structure: obiekt klasy Structure, którego kontury próbujemy sparować ze slicem self
         :return: None
         """
+        newStructure = self.match_structure(structure)
+        if newStructure is not None:
+            """Jeśli nowa struktura zawiera kontury to dodaj ją do słownika struktur slice'a - jako klucz wykorzystaj
+            numer struktury pobrany uprzednio z pliku RTStruct."""
+            self.structures[newStructure.number] = newStructure
 
-        # Tworzymy nowy obiekt Structure, który będzie zawierał wyłącznie pasujące do slice'a self kontury
-        newStructure = Structure(structure.name, np.divide(structure.color, 255), structure.number, [])
+    def match_structure(self, structure):
+        """
+        Metoda tworząca nowy obiekt Structure zawierający wyłącznie pasujące do slice'a self kontury przekazanej
+        struktury (w układzie współrzędnych pikseli obrazu). Nie modyfikuje słownika struktur slice'a.
+        Sposób dopasowania konturów wybiera atrybut self.match_mode.
+        :param structure: obiekt klasy Structure, którego kontury próbujemy sparować ze slicem self
+        :return: nowy obiekt klasy Structure lub None, jeśli żaden kontur struktury nie pasuje do slice'a
+        """
+        if self.match_mode != MATCH_Z and self.UID in structure.uid_index:
+            # wybranie zakresu konturów, które mają jako UID odniesienia slice self
+            first, stop = structure.uid_index[self.UID]
+            start_point, stop_point = structure.offsets[first], structure.offsets[stop]
+            points = structure.points[start_point:stop_point, :2]
+            offsets = structure.offsets[first:stop + 1] - start_point
+        elif self.match_mode != MATCH_UID and structure.z_sorted is not None:
+            # wybranie konturów leżących w obrębie slice'a self (np. RTStruct bez UID odniesienia lub z innej serii)
+            contour_ids = structure.contours_near_z(float(self.z), self.z_tolerance)
+            if len(contour_ids) == 0:
+                return None
+            points, offsets = gather_contours(structure.points, structure.offsets, contour_ids)
+            points = points[:, :2]
+        else:  # niektóre struktury nie zawierają żadnych konturów pasujących do slice'a self
+            return None
 
-        try:
-            # wybranie tych konturów które mają jako UID odniesienia slice self
-            for contour in structure.contours[self.UID]:
-                # Przekształcenie wektora punktów konturu w macierz 3D
-                contour = np.array(contour).reshape(-1, 3)
-                """Przejście ze współrzędnych 'przestrzennych' na odpowiadające punktom piksele
-                obrazu + opuszczenie składowej 'z' punktów konturu (sprawdziliśmy już, że dany kontur pasuje do slice'a
-                więc składowe 'z' punktów są dalej zbędne)."""
-                nodes2D = (contour[:, :2] - self.dcm.ImagePositionPatient[:2]) / self.dcm.PixelSpacing
-                newStructure.contours.append(nodes2D)
-        except KeyError:  # niektóre struktury nie zawierają żadnych konturów pasujących do slice'a self
-            pass
-
-        if len(newStructure.contours) > 0:
-            """Jeśli nowa struktura zawiera kontury to dodaj ją do słownika struktur
-             slice'a - jako klucz wykorzystaj numer struktury pobrany uprzednio z pliku RTStruct."""
-            self.structures[newStructure.number] = newStructure
+        """Przejście ze współrzędnych 'przestrzennych' na odpowiadające punktom piksele obrazu jednym przekształceniem
+        dla wszystkich konturów naraz + opuszczenie składowej 'z' punktów konturu (sprawdziliśmy już, że kontury pasują
+        do slice'a więc składowe 'z' punktów są dalej zbędne)."""
+        nodes2D = (points - self.origin) / self.spacing
+
+        return Structure(structure.name, np.divide(structure.color, 255), structure.number, nodes2D, offsets,
+                         {self.UID: (0, len(offsets) - 1)})
+
+    @profiling.timed("Slice.match_structures")
+    def match_structures(self, rtstruct):
+        """
+        Metoda dopasowująca do slice'a self kontury wszystkich struktur z listy bez modyfikowania słownika struktur
+        slice'a - może być wywoływana w wątku roboczym, gdy slice jest jednocześnie wyświetlany.
+        :param rtstruct: lista obiektów klasy Structure utworzona uprzednio na podstawie pliku DICOM z danymi RTStruct
+        :return: słownik {numer struktury: obiekt Structure z pasującymi konturami}
+        """
+        matched = {}
+        for struct in rtstruct:
+            newStructure = self.match_structure(struct)
+            if newStructure is not None:
+                matched[newStructure.number] = newStructure
+        return matched
 
+    @profiling.timed("Slice.load_RTStruct")
     def load_RTStruct(self, rtstruct, clear_current_structures: bool = True):
         """
         Metoda ładująca obiekt listę obiektów Structure do slice'a self.
@@ -138,8 +466,31 @@ class Slice:
         if clear_current_structures:
             # Wyczyść słownik struktur z załadowanych uprzednio struktur
             self.structures.clear()
-        for struct in rtstruct:
-            self.add_structure(struct)
+        self.structures.update(self.match_structures(rtstruct))
+
+    def build_lod(self, levels=LOD_LEVELS):
+        """Wyznaczenie z góry uproszczonych konturów wszystkich struktur slice'a (np. w wątku roboczym)."""
+        for structure in list(self.structures.values()) + list(self.compared_structures.values()):
+            structure.build_lod(levels)
+
+    def match_comparison(self, rtstruct, metric=None):
+        """
+        Dopasowanie do slice'a konturów porównywanego RTStructa (rysowanych na konturach struktur slice'a) i wyznaczenie
+        wyniku porównania - wywoływane w wątku roboczym, dzięki czemu wątek GUI jedynie podmienia rysowane kontury.
+        :param rtstruct: lista obiektów klasy Structure porównywanego RTStructa (None - bez porównania)
+        :param metric: funkcja metric(slice, dopasowane struktury porównywane) zwracająca wynik porównania (np. słownik
+         {nazwa struktury: Dice}) zapamiętywany w atrybucie comparison_scores - opcjonalnie
+        :return: None
+        """
+        matched = self.match_structures(rtstruct) if rtstruct is not None else {}
+        self.comparison_scores = metric(self, matched) if metric is not None and matched else None
+        self.compared_structures = matched
+        self.compared_rtstruct = rtstruct
+        self.compared_match_mode = self.match_mode
+
+    def comparison_matches(self, rtstruct):
+        """Sprawdzenie, czy kontury porównywane dopasowano do slice'a z RTStructa rtstruct i w bieżącym trybie."""
+        return self.compared_rtstruct is rtstruct and self.compared_match_mode == self.match_mode
 
     def draw_contour(self, contour, color='red', name: str = 'nolabel', lw: float = 0.5):
         """
@@ -165,12 +516,31 @@ class Slice:
         :param lw: grubość linii konturu
         :return: None
         """
+        if self.render_mode != RENDER_LINES:
+            self.draw_structure_collection(structure, lw, filled=self.render_mode == RENDER_FILLED)
+            return
         # Wyciągnięcie pierwszej macierzy 2D konturu w celu zapobiegnięcia duplikacji wpisów w legendzie.
         first_contour, *contours = structure.contours
         self.draw_contour(first_contour, structure.color, structure.name, lw)  # Label ustawiany tylko raz na strukturę.
         for contour in contours:
             self.draw_contour(contour, structure.color, lw=lw)  # W kolejnych konturach tej samej struktury nie ustawiamy labela.
 
+    def draw_structure_collection(self, structure, lw: float = 0.5, filled: bool = False):
+        """
+        Metoda rysująca wszystkie kontury struktury jednym obiektem LineCollection (lub PolyCollection dla
+        wypełnionych konturów) zamiast osobnego obiektu Line2D dla każdego konturu.
+        :param structure: obiekt klasy Structure, którego kontury mają zostać narysowane na obrazie
+        :param lw: grubość linii konturu
+        :param filled: flaga decydująca, czy kontury mają zostać wypełnione półprzezroczystym kolorem struktury
+        :return: obiekt kolekcji dodany do osi
+        """
+        axes = self.get_axes()
+        collection = structure_collection(structure, lw, filled)
+        axes.add_collection(collection)
+        axes.add_line(legend_proxy(structure, lw))
+        return collection
+
+    @profiling.timed("Slice.draw_structures")
     def draw_structures(self, lw: float = 0.9):
         """
         Metoda rysująca obraz slice'a + kontury wszystkich struktur skojarzonych ze slicem self (kontury wszystkich struktur
@@ -178,7 +548,7 @@ class Slice:
         :param lw: grubość linii konturu
         :return: None
         """
-        self.axes.imshow(self.dcm.pixel_array, plt.cm.bone)
+        self.axes.imshow(self.display_array())
         for structure in self.structures.values():
             self.draw_structure(structure, lw)
         self.axes.legend()
@@ -203,32 +573,1088 @@ class Slice:
         """
         self.axes = axes
 
+    def get_axes(self):
+        """Zwraca obiekt osi matplotliba, na którym rysowany jest slice (również gdy podpięty jest pyplot)."""
+        return self.axes.gca() if self.axes is plt else self.axes
+
+
+class SliceRenderer:
+    """Klasa przechowująca trwały stan rysowania slice'a na osiach matplotliba (wykorzystywana przez GUI).
+
+    Zamiast czyszczenia rysunku i rysowania wszystkiego od nowa przy każdej zmianie:
+    - zmiana slice'a podmienia jedynie dane obrazu (AxesImage.set_data),
+    - zmiana RTStructa podmienia kolekcje konturów tylko tych struktur, które się zmieniły,
+    - kontury i legenda są obiektami 'animowanymi' - rysowane są na zapamiętanym tle (obraz + osie) techniką blittingu,
+      więc ich podmiana nie wymaga ponownej rasteryzacji obrazu slice'a,
+    - rysowane są kontury uproszczone do poziomu szczegółowości (Structure.simplified) dobranego do bieżącego
+      przybliżenia osi - przy każdym pełnym przerysowaniu (np. po przybliżeniu lub przesunięciu) poziom jest
+      sprawdzany i w razie potrzeby podmieniane są jedynie wierzchołki kolekcji,
+    - kontury drugiego, porównywanego RTStructa (set_overlay) rysowane są w ten sam sposób liniami przerywanymi.
+
+    Atrybuty
+    --------
+    axes: matplotlib.axes.Axes
+        osie, na których rysowany jest slice
+    image: matplotlib.image.AxesImage
+        obraz slice'a
+    artists: dict
+        słownik {numer struktury: (obiekt Structure, kolekcja konturów, zastępczy obiekt legendy)}
+    overlay: dict
+        słownik {numer struktury: (obiekt Structure, kolekcja konturów, zastępczy obiekt legendy)} struktur
+        porównywanego RTStructa
+    background: object
+        zapamiętane tło (obraz + osie bez konturów) używane przy blittingu
+    level: float
+        tolerancja uproszczenia obecnie rysowanych konturów (0 - kontury pełne)
+    window: tuple
+        okno wyświetlania (środek, szerokość) [HU] lub None - okno zapisane w pliku DICOM wyświetlanego slice'a
+    """
+
+    def __init__(self, axes, lw: float = 0.9, filled: bool = False, lod: bool = True):
+        """
+        Inicjalizacja obiektu klasy SliceRenderer
+        :param axes: osie matplotliba, na których rysowany będzie slice
+        :param lw: grubość linii konturów
+        :param filled: flaga decydująca, czy kontury mają być wypełnione półprzezroczystym kolorem struktury
+        :param lod: flaga decydująca, czy rysować kontury uproszczone zależnie od przybliżenia
+        """
+        self.axes = axes
+        self.canvas = axes.figure.canvas
+        self.lw = lw
+        self.filled = filled
+        self.lod = lod
+        self.level = 0.0
+        self.window = None
+        self.dicom = None
+        self.image = None
+        self.legend = None
+        self.artists = {}
+        self.overlay = {}
+        self.background = None
+        self._draw_cid = self.canvas.mpl_connect("draw_event", self._on_draw)
+        self.axes.set_xlabel("x [mm]")
+        self.axes.set_ylabel("y [mm]")
+
+    @profiling.timed("SliceRenderer.show")
+    def show(self, dicom):
+        """
+        Wyświetlenie slice'a dicom wraz z jego strukturami. Jeśli rozmiar obrazu się nie zmienił, podmieniane są
+        jedynie dane obrazu. Zmiana obrazu wymaga pełnego przerysowania (w trakcie którego zapamiętywane jest nowe tło).
+        :param dicom: obiekt klasy Slice
+        :return: None
+        """
+        pixels = dicom.display_array(self.window)
+        if self.image is None or self.image.get_array().shape != pixels.shape:
+            if self.image is not None:
+                self.image.remove()
+            self.image = self.axes.imshow(pixels)
+        else:
+            self.image.set_data(pixels)
+        self.axes.set_title(f"{dicom.dcm.PatientName} | z = {dicom.z}mm")
+        self.dicom = dicom
+        self._swap_structures(dicom.structures)
+        self.canvas.draw_idle()
+
+    @profiling.timed("SliceRenderer.set_structures")
+    def set_structures(self, structures, lw: float = None):
+        """
+        Podmiana wyświetlanych struktur - nowe kolekcje tworzone są tylko dla zmienionych struktur, a kontury
+        rysowane są na zapamiętanym tle bez ponownej rasteryzacji obrazu slice'a.
+        :param structures: słownik {numer struktury: obiekt Structure} (np. Slice.structures)
+        :param lw: nowa grubość linii konturów (zmiana grubości wymusza podmianę wszystkich kolekcji)
+        :return: None
+        """
+        force = lw is not None and lw != self.lw
+        if lw is not None:
+            self.lw = lw
+        self._swap_structures(structures, force)
+        self.blit()
+
+    def set_overlay(self, structures, redraw: bool = True):
+        """
+        Podmiana struktur porównywanego RTStructa rysowanych liniami przerywanymi na konturach wyświetlanych struktur.
+        :param structures: słownik {numer struktury: obiekt Structure} dopasowanych do slice'a (pusty - bez porównania)
+        :param redraw: flaga decydująca, czy od razu narysować kontury (False, gdy zaraz wyświetlany jest nowy slice)
+        :return: None
+        """
+        for _, collection, _ in self.overlay.values():
+            collection.remove()
+        self.overlay = {}
+        for number, structure in structures.items():
+            collection = LineCollection(contour_rings(structure.simplified(self.level)), colors=[structure.color],
+                                        linewidths=self.lw, linestyles="--")
+            collection.set_animated(True)
+            self.axes.add_collection(collection, autolim=False)
+            proxy = Line2D([], [], color=structure.color, lw=self.lw, ls="--", label=f"{structure.name} (compared)")
+            self.overlay[number] = structure, collection, proxy
+        self._update_legend()
+        if redraw:
+            self.blit()
+
+    def set_window(self, center: float = None, width: float = None):
+        """
+        Zmiana okna wyświetlania - podmieniane są jedynie dane obrazu (tablica LUT nowego okna), bez przebudowy rysunku.
+        :param center: środek okna [HU] (None - okno zapisane w pliku DICOM wyświetlanego slice'a)
+        :param width: szerokość okna [HU]
+        :return: None
+        """
+        self.window = (float(center), max(float(width), 1.0)) if center is not None else None
+        if self.dicom is not None:
+            self.image.set_data(self.dicom.display_array(self.window))
+            self.canvas.draw_idle()
+
+    def current_window(self):
+        """Okno wyświetlania (środek, szerokość) wyświetlanego slice'a."""
+        if self.window is None and self.dicom is not None:
+            return self.dicom.default_window()
+        return self.window
+
+    def blit(self):
+        """Narysowanie konturów i legendy na zapamiętanym tle (lub pełne przerysowanie, jeśli tła jeszcze nie ma)."""
+        if self.background is None or not self.canvas.supports_blit:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self._draw_overlays(self.canvas.get_renderer())
+        self.canvas.blit(self.axes.bbox)
+
+    def disconnect(self):
+        """Odłączenie obiektu od płótna - wywoływane przed wyczyszczeniem rysunku."""
+        self.canvas.mpl_disconnect(self._draw_cid)
+        self.background = None
+
+    def _swap_structures(self, structures, force: bool = False):
+        for number in list(self.artists):
+            structure, collection, _ = self.artists[number]
+            if force or structures.get(number) is not structure:
+                collection.remove()
+                del self.artists[number]
+        for number, structure in structures.items():
+            if number not in self.artists:
+                collection = structure_collection(structure.simplified(self.level), self.lw, self.filled)
+                collection.set_animated(True)
+                self.axes.add_collection(collection, autolim=False)
+                self.artists[number] = structure, collection, legend_proxy(structure, self.lw)
+        self._update_legend()
+
+    def _update_legend(self):
+        if self.legend is not None:
+            self.legend.remove()
+            self.legend = None
+        handles = [proxy for _, _, proxy in self.artists.values()] + [proxy for _, _, proxy in self.overlay.values()]
+        if handles:
+            # Stałe położenie legendy - wyszukiwanie położenia 'best' sprawdza kolizje ze wszystkimi konturami
+            self.legend = self.axes.legend(handles=handles, loc="upper right")
+            self.legend.set_animated(True)
+
+    def lod_level(self):
+        """
+        Wybór poziomu szczegółowości konturów - największej tolerancji z LOD_LEVELS, której błąd na ekranie przy
+        bieżących granicach osi i rozmiarze osi w pikselach nie przekracza LOD_SCREEN_TOLERANCE.
+        :return: tolerancja uproszczenia konturów (0 - kontury pełne)
+        """
+        if not self.lod:
+            return 0.0
+        x0, x1 = self.axes.get_xlim()
+        y0, y1 = self.axes.get_ylim()
+        # Liczba pikseli ekranu na jednostkę współrzędnych konturów (mniejsza z dwóch osi - bardziej zachowawcza)
+        density = min(self.axes.bbox.width / max(abs(x1 - x0), 1e-9), self.axes.bbox.height / max(abs(y1 - y0), 1e-9))
+        levels = [level for level in LOD_LEVELS if level * density <= LOD_SCREEN_TOLERANCE]
+        return max(levels) if levels else 0.0
+
+    def _set_level(self, level):
+        """Podmiana wierzchołków kolekcji konturów, jeśli zmienił się poziom szczegółowości."""
+        if level == self.level:
+            return
+        self.level = level
+        for structure, collection, _ in list(self.artists.values()) + list(self.overlay.values()):
+            rings = contour_rings(structure.simplified(level))
+            if isinstance(collection, PolyCollection):
+                collection.set_verts(rings)
+            else:
+                collection.set_segments(rings)
+
+    def _draw_overlays(self, renderer):
+        for _, collection, _ in list(self.artists.values()) + list(self.overlay.values()):
+            collection.draw(renderer)
+        if self.legend is not None:
+            self.legend.draw(renderer)
+
+    def _on_draw(self, event):
+        """Po pełnym przerysowaniu zapamiętaj tło (bez obiektów animowanych) i dorysuj na nim kontury."""
+        if self.canvas.is_saving():
+            # Zapisywany do pliku obraz ma inną rozdzielczość niż ekran - pełne kontury i bez zmiany tła ekranu
+            level = self.level
+            self._set_level(0.0)
+            self._draw_overlays(event.renderer)
+            self._set_level(level)
+            return
+        self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+        self._set_level(self.lod_level())
+        self._draw_overlays(event.renderer)
+
+
+class ReformatRenderer:
+    """Klasa rysująca przekrój czołowy lub strzałkowy serii CT z przekrojami struktur (wykorzystywana przez GUI).
+
+    Obraz przekroju to widok na wspólną macierz zdekodowanej serii (Volume.reformat) przekształcony tablicą LUT okna
+    wyświetlania, a przekroje struktur wyznaczane są dla wszystkich konturów struktury jednocześnie i zapamiętywane
+    dla każdego położenia płaszczyzny (Structure.section). Przesunięcie płaszczyzny podmienia jedynie dane obrazu
+    i wierzchołki kolekcji, więc przewijanie przekrojów odbywa się w tempie interaktywnym.
+
+    Atrybuty
+    --------
+    axes: matplotlib.axes.Axes
+        osie, na których rysowany jest przekrój
+    volume: Volume
+        seria ze zdekodowanymi danymi obrazowymi wszystkich slice'ów
+    axis: str
+        płaszczyzna przekroju (CORONAL lub SAGITTAL)
+    index: int
+        indeks wiersza (CORONAL) lub kolumny (SAGITTAL) obrazu, przez który przechodzi płaszczyzna przekroju
+    image: matplotlib.image.AxesImage
+        obraz przekroju
+    artists: dict
+        słownik {numer struktury: (obiekt Structure, kolekcja przekrojów, zastępczy obiekt legendy)}
+    crosshair: matplotlib.lines.Line2D
+        pozioma linia zaznaczająca położenie slice'a wyświetlanego w widoku osiowym
+    window: tuple
+        okno wyświetlania (środek, szerokość) [HU] lub None - okno zapisane w pliku DICOM pierwszego slice'a serii
+    """
+
+    def __init__(self, axes, volume, axis: str, index: int = None, lw: float = 0.9):
+        """
+        Inicjalizacja obiektu klasy ReformatRenderer
+        :param axes: osie matplotliba, na których rysowany będzie przekrój
+        :param volume: obiekt klasy Volume ze zdekodowanymi danymi obrazowymi (Volume.decode_all)
+        :param axis: płaszczyzna przekroju (CORONAL lub SAGITTAL)
+        :param index: początkowy indeks wiersza lub kolumny obrazu (domyślnie środek obrazu)
+        :param lw: grubość linii w legendzie
+        """
+        self.axes = axes
+        self.canvas = axes.figure.canvas
+        self.volume = volume
+        self.axis = axis
+        self.lw = lw
+        self.index = volume.plane_count(axis) // 2 if index is None else index
+        self.window = None
+        self.artists = {}
+        self.legend = None
+        first = volume.slice(0)
+        self._rescale = (first.slope, first.intercept)
+        self._default_window = first.default_window()
+        self.image = self.axes.imshow(self._display(), origin="lower", extent=volume.reformat_extent(axis))
+        self.crosshair = self.axes.axhline(volume.z[0], color="yellow", lw=0.8, ls="--", visible=False)
+        self.axes.set_xlabel("x [mm]" if axis == CORONAL else "y [mm]")
+        self.axes.set_ylabel("z [mm]")
+        self._set_title()
+
+    def show(self, index: int):
+        """
+        Przesunięcie płaszczyzny przekroju - podmieniane są dane obrazu i wierzchołki kolekcji przekrojów struktur.
+        :param index: indeks wiersza (CORONAL) lub kolumny (SAGITTAL) obrazu
+        :return: None
+        """
+        self.index = min(max(index, 0), self.volume.plane_count(self.axis) - 1)
+        self.image.set_data(self._display())
+        for structure, collection, _ in self.artists.values():
+            collection.set_verts(self._section_rects(structure))
+        self._set_title()
+        self.canvas.draw_idle()
+
+    def step(self, delta: int):
+        """Przesunięcie płaszczyzny przekroju o delta wierszy lub kolumn obrazu."""
+        self.show(self.index + delta)
+
+    def set_structures(self, rtstruct):
+        """
+        Podmiana wyświetlanych struktur.
+        :param rtstruct: lista obiektów klasy Structure z konturami we współrzędnych pacjenta (wynik read_rtstruct)
+        :return: None
+        """
+        for _, collection, _ in self.artists.values():
+            collection.remove()
+        self.artists = {}
+        for structure in rtstruct or []:
+            color = np.divide(structure.color, 255)
+            # Bez krawędzi - krawędzie sąsiednich prostokątów tworzyłyby poziome pasy między slice'ami
+            collection = PolyCollection(self._section_rects(structure), facecolors=[(*color, FILL_ALPHA)],
+                                        linewidths=0)
+            self.axes.add_collection(collection, autolim=False)
+            proxy = Line2D([], [], color=color, lw=self.lw, label=structure.name)
+            self.artists[structure.number] = structure, collection, proxy
+
+        if self.legend is not None:
+            self.legend.remove()
+            self.legend = None
+        if self.artists:
+            self.legend = self.axes.legend(handles=[proxy for _, _, proxy in self.artists.values()], loc="upper right")
+        self.canvas.draw_idle()
+
+    def set_crosshair(self, z: float):
+        """Przesunięcie linii zaznaczającej położenie slice'a widoku osiowego na wysokość 'z' [mm]."""
+        self.crosshair.set_ydata([z, z])
+        self.crosshair.set_visible(True)
+        self.canvas.draw_idle()
+
+    def set_window(self, center: float = None, width: float = None):
+        """
+        Zmiana okna wyświetlania - podmieniane są jedynie dane obrazu.
+        :param center: środek okna [HU] (None - okno zapisane w pliku DICOM pierwszego slice'a serii)
+        :param width: szerokość okna [HU]
+        :return: None
+        """
+        self.window = (float(center), max(float(width), 1.0)) if center is not None else None
+        self.image.set_data(self._display())
+        self.canvas.draw_idle()
+
+    def current_window(self):
+        """Okno wyświetlania (środek, szerokość) przekroju."""
+        return self.window if self.window is not None else self._default_window
+
+    def position(self):
+        """Położenie płaszczyzny przekroju we współrzędnych pacjenta [mm]."""
+        return self.volume.plane_position(self.axis, self.index)
+
+    def _display(self):
+        return apply_window(self.volume.reformat(self.axis, self.index), *self._rescale, *self.current_window())
+
+    def _section_rects(self, structure):
+        """Odcinki przekroju struktury jako prostokąty o wysokości równej odstępowi między slice'ami."""
+        start, stop, z = structure.section(self.axis, self.position()).T
+        half = self.volume.slice_thickness() / 2
+        return np.stack([np.column_stack([start, z - half]), np.column_stack([stop, z - half]),
+                         np.column_stack([stop, z + half]), np.column_stack([start, z + half])], axis=1)
+
+    def _set_title(self):
+        coordinate = "y" if self.axis == CORONAL else "x"
+        self.axes.set_title(f"{self.volume.headers[0].PatientName} | {self.axis} {coordinate} = {self.position():.1f}mm")
+
+
+class Volume:
+    """Klasa reprezentująca serię plików DICOM z danymi obrazowymi (wszystkie slice'y z jednego katalogu).
+
+    Przy tworzeniu obiektu wczytywane są wyłącznie nagłówki plików (bez danych obrazowych). Dane obrazowe kolejnych
+    slice'ów dekodowane są dopiero na żądanie do wspólnej dla wszystkich widoków macierzy 3D zmapowanej w pamięci
+    (np.memmap na pliku tymczasowym), a w pamięci RAM utrzymywanych jest najwyżej max_resident_slices ostatnio
+    używanych slice'ów - pozostałe strony macierzy zwalniane są do pliku tymczasowego.
 
-def read_rtstruct(rt_structure_filename):
+    Atrybuty
+    --------
+    file_paths: list
+        ścieżki plików DICOM kolejnych slice'ów posortowanych po współrzędnej ImagePositionPatient[2]
+    headers: list
+        nagłówki (bez danych obrazowych) kolejnych slice'ów
+    z: np.ndarray
+        współrzędne 'z' kolejnych slice'ów
+    index_by_uid: dict
+        słownik {SOPInstanceUID: indeks slice'a w serii}
+    pixels: np.memmap
+        macierz 3D (slice, wiersz, kolumna) z danymi obrazowymi serii
+    decoding_plugin: str
+        nazwa wtyczki pydicom dekodującej dane obrazowe ("" - pierwsza dostępna wtyczka)
+    """
+
+    def __init__(self, directory: str, series_uid: str = None, max_resident_slices: int = 32,
+                 decoding_plugin: str = ""):
+        """
+        Inicjalizacja obiektu klasy Volume
+        :param directory: katalog zawierający pliki DICOM serii CT
+        :param series_uid: SeriesInstanceUID wybieranej serii (potrzebny, gdy katalog zawiera więcej niż jedną serię)
+        :param max_resident_slices: maksymalna liczba zdekodowanych slice'ów utrzymywanych w pamięci RAM
+        :param decoding_plugin: nazwa wtyczki dekodującej pydicom (np. "pillow", "pylibjpeg", "gdcm"; domyślnie
+         pierwsza dostępna wtyczka dla składni transferu pliku)
+        """
+        headers = []
+        for path in glob.glob(os.path.join(directory, "*.dcm")):
+            header = pydicom.dcmread(path, stop_before_pixels=True)
+            if "ImagePositionPatient" not in header or "Rows" not in header:
+                continue  # Pomijamy pliki niezawierające danych obrazowych (np. RTStruct w tym samym katalogu)
+            if series_uid is None:
+                series_uid = header.SeriesInstanceUID
+            if header.SeriesInstanceUID == series_uid:
+                headers.append((float(header.ImagePositionPatient[2]), path, header))
+        if not headers:
+            raise NotCTImageFileException(f"No CT image data files found in {directory}")
+
+        headers.sort(key=lambda entry: entry[0])
+        self.directory = directory
+        self.series_uid = series_uid
+        self.z = np.array([entry[0] for entry in headers])
+        self.file_paths = [entry[1] for entry in headers]
+        self.headers = [entry[2] for entry in headers]
+        self.index_by_uid = {header.SOPInstanceUID: i for i, header in enumerate(self.headers)}
+
+        first = self.headers[0]
+        dtype = np.dtype(f"{'i' if first.PixelRepresentation else 'u'}{first.BitsAllocated // 8}")
+        self.shape = (len(self.headers), first.Rows, first.Columns)
+        fd, self._pixels_path = tempfile.mkstemp(prefix="volume_", suffix=".raw")
+        os.close(fd)
+        self.pixels = np.memmap(self._pixels_path, dtype=dtype, mode="w+", shape=self.shape)
+        # Usunięcie pliku tymczasowego razem z obiektem (lub przy zamknięciu programu)
+        self._finalizer = weakref.finalize(self, _remove_file, self._pixels_path)
+
+        self.decoded = np.zeros(len(self.headers), dtype=bool)
+        self.max_resident_slices = max_resident_slices
+        self.decoding_plugin = decoding_plugin
+        self._resident = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return f"<directory={self.directory}, slices={len(self)}, decoded={int(self.decoded.sum())}>"
+
+    def __len__(self):
+        return len(self.headers)
+
+    @classmethod
+    def from_slice_path(cls, file_path: str, **kwargs):
+        """Utworzenie obiektu Volume z serii, do której należy podany plik DICOM z danymi obrazowymi."""
+        header = pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=["SeriesInstanceUID"])
+        return cls(os.path.dirname(file_path), header.SeriesInstanceUID, **kwargs)
+
+    def slice(self, index: int):
+        """Zwraca obiekt klasy Slice będący widokiem na slice o podanym indeksie."""
+        return Slice(volume=self, index=index)
+
+    def slice_by_uid(self, uid):
+        """Zwraca obiekt klasy Slice będący widokiem na slice o podanym SOPInstanceUID."""
+        return self.slice(self.index_by_uid[uid])
+
+    def pixel_array(self, index: int):
+        """
+        Zwraca dane obrazowe slice'a o podanym indeksie jako widok na wspólną macierz pixels,
+        dekodując je z pliku DICOM przy pierwszym użyciu.
+        :param index: indeks slice'a w serii
+        :return: macierz 2D z danymi obrazowymi slice'a
+        """
+        if not self.decoded[index]:
+            # Dekodowanie poza blokadą - kilka wątków (np. prefetch) może dekodować różne slice'y jednocześnie
+            with profiling.stage("Volume.decode"):
+                pixels = decode_pixel_data(self.file_paths[index], decoding_plugin=self.decoding_plugin)
+            with self._lock:
+                if not self.decoded[index]:
+                    self.pixels[index] = pixels
+                    self.decoded[index] = True
+        with self._lock:
+            self._resident[index] = True
+            self._resident.move_to_end(index)
+            while len(self._resident) > self.max_resident_slices:
+                self._release(self._resident.popitem(last=False)[0])
+        return self.pixels[index]
+
+    def decode_all(self, progress=None, workers: int = None, backend: str = DECODE_THREADS, cancel=None):
+        """
+        Równoległe dekodowanie danych obrazowych wszystkich (jeszcze niezdekodowanych) slice'ów serii bezpośrednio
+        do odpowiadających im wierszy wspólnej macierzy pixels - bez składania serii z osobnych macierzy slice'ów.
+        W puli procesów każdy proces zapisuje zdekodowane slice'y do zmapowanego w pamięci pliku macierzy, więc
+        dane obrazowe nie są przesyłane między procesami.
+        :param progress: funkcja wywoływana po każdym slice'u z argumentami (liczba gotowych slice'ów, liczba slice'ów) -
+         wyjątek zgłoszony przez tę funkcję przerywa dekodowanie
+        :param workers: liczba wątków lub procesów (domyślnie liczba rdzeni procesora, 1 - dekodowanie w bieżącym wątku)
+        :param backend: DECODE_THREADS lub DECODE_PROCESSES
+        :param cancel: opcjonalny obiekt threading.Event - jego ustawienie przerywa dekodowanie
+        :return: True, jeśli zdekodowano wszystkie slice'y, False po przerwaniu przez cancel
+        """
+        pending = [index for index in range(len(self)) if not self.decoded[index]]
+        done = len(self) - len(pending)
+        if progress is not None:
+            progress(done, len(self))
+        if not pending:
+            return True
+        workers = workers or os.cpu_count() or 1
+
+        if workers == 1:
+            results = (self._decode_into(index) for index in pending)
+            stop = None
+        elif backend == DECODE_PROCESSES:
+            pool = multiprocessing.Pool(min(workers, len(pending)), initializer=init_volume_worker,
+                                        initargs=self.worker_args()[:4])
+            tasks = [(index, self.file_paths[index]) for index in pending]
+            results = pool.imap_unordered(_decode_into_file, tasks, chunksize=max(len(pending) // (workers * 4), 1))
+            stop = pool.terminate
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode")
+            results = (future.result() for future in
+                       as_completed([executor.submit(self._decode_into, index) for index in pending]))
+            stop = lambda: executor.shutdown(wait=True, cancel_futures=True)
+
+        try:
+            with profiling.stage("Volume.decode_all"):
+                for index in results:
+                    self.decoded[index] = True
+                    done += 1
+                    if progress is not None:
+                        progress(done, len(self))
+                    if cancel is not None and cancel.is_set():
+                        return False
+        finally:
+            if stop is not None:
+                stop()
+        return True
+
+    def worker_args(self):
+        """
+        Argumenty funkcji init_volume_worker - procesy robocze widzą macierz serii wyłącznie przez plik, więc
+        zdekodowane dotąd slice'y są najpierw zapisywane na dysk.
+        :return: krotka (ścieżka pliku macierzy, typ danych, rozmiar, wtyczka dekodująca, ścieżki plików slice'ów,
+         flagi zdekodowanych slice'ów)
+        """
+        self.pixels.flush()
+        return (self._pixels_path, self.pixels.dtype.str, self.shape, self.decoding_plugin, self.file_paths,
+                self.decoded.copy())
+
+    def _decode_into(self, index):
+        """Dekodowanie slice'a do jego wiersza macierzy pixels (w wątku dekodującym)."""
+        self.pixels[index] = decode_pixel_data(self.file_paths[index], decoding_plugin=self.decoding_plugin)
+        return index
+
+    def plane_count(self, axis: str):
+        """Liczba położeń płaszczyzny przekroju (slice'ów, wierszy lub kolumn obrazu)."""
+        return self.shape[{AXIAL: 0, CORONAL: 1, SAGITTAL: 2}[axis]]
+
+    def plane_position(self, axis: str, index: int):
+        """
+        Położenie płaszczyzny przekroju o podanym indeksie we współrzędnych pacjenta.
+        :param axis: płaszczyzna przekroju (AXIAL, CORONAL lub SAGITTAL)
+        :param index: indeks slice'a (AXIAL), wiersza (CORONAL) lub kolumny (SAGITTAL) obrazu
+        :return: współrzędna 'z', 'y' lub 'x' płaszczyzny [mm]
+        """
+        if axis == AXIAL:
+            return float(self.z[index])
+        origin, spacing = self._in_plane_geometry()
+        # Ta sama konwencja co w Slice.match_structure: x = origin[0] + kolumna * spacing[0]
+        return float(origin[1] + index * spacing[1]) if axis == CORONAL else float(origin[0] + index * spacing[0])
+
+    def reformat(self, axis: str, index: int):
+        """
+        Przekrój serii płaszczyzną czołową lub strzałkową jako widok na macierz pixels (bez kopiowania danych).
+        Dane obrazowe wszystkich slice'ów muszą być zdekodowane (decode_all).
+        :param axis: płaszczyzna przekroju (CORONAL lub SAGITTAL)
+        :param index: indeks wiersza (CORONAL) lub kolumny (SAGITTAL) obrazu
+        :return: macierz 2D (slice, kolumna lub wiersz obrazu)
+        """
+        return self.pixels[:, index, :] if axis == CORONAL else self.pixels[:, :, index]
+
+    def reformat_extent(self, axis: str):
+        """Zakres współrzędnych pacjenta (poziomo 'x' lub 'y', pionowo 'z') obrazu przekroju - argument extent imshow."""
+        origin, spacing = self._in_plane_geometry()
+        i = 0 if axis == CORONAL else 1
+        count = self.shape[2] if axis == CORONAL else self.shape[1]
+        half_thickness = self.slice_thickness() / 2
+        return (origin[i] - spacing[i] / 2, origin[i] + (count - 0.5) * spacing[i],
+                self.z[0] - half_thickness, self.z[-1] + half_thickness)
+
+    def slice_thickness(self):
+        """Odstęp między slice'ami serii [mm] (mediana odstępów, a dla serii z jednym slice'm - SliceThickness)."""
+        if len(self) > 1:
+            return float(np.median(np.diff(self.z)))
+        return float(self.headers[0].get("SliceThickness") or 2 * DEFAULT_Z_TOLERANCE)
+
+    def _in_plane_geometry(self):
+        first = self.headers[0]
+        return (np.asarray(first.ImagePositionPatient[:2], dtype=np.float64),
+                np.asarray(first.PixelSpacing, dtype=np.float64))
+
+    def close(self):
+        """Zwolnienie macierzy pixels i usunięcie pliku tymczasowego."""
+        self._resident.clear()
+        self.pixels = None
+        self._finalizer()
+
+    def _release(self, index):
+        """Zapis zdekodowanego slice'a do pliku tymczasowego i zwolnienie zajmowanych przez niego stron pamięci."""
+        raw = getattr(self.pixels, "_mmap", None)
+        if raw is None or not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        slice_bytes = self.pixels[0].nbytes
+        # madvise działa na całych stronach pamięci - zwalniamy tylko strony leżące w całości w obrębie slice'a
+        start = -(-index * slice_bytes // mmap.PAGESIZE) * mmap.PAGESIZE
+        stop = (index + 1) * slice_bytes // mmap.PAGESIZE * mmap.PAGESIZE
+        if stop > start:
+            raw.flush(start, stop - start)
+            raw.madvise(mmap.MADV_DONTNEED, start, stop - start)
+
+
+class SeriesNavigator:
+    """Klasa odpowiadająca za przechodzenie po kolejnych slice'ach serii z wyprzedzającym wczytywaniem (prefetch).
+
+    Ostatnio używane slice'y (ze zdekodowanymi danymi obrazowymi i dopasowanymi konturami) przechowywane są w buforze
+    LRU o ograniczonym rozmiarze. Po każdym kroku w tle wczytywanych jest prefetch kolejnych slice'ów w kierunku ruchu
+    i połowa tej liczby slice'ów w kierunku przeciwnym, dzięki czemu przewijanie serii nie czeka na dekodowanie.
+    Metoda step_async nie blokuje wywołującego wątku (GUI) - slice spoza bufora wczytywany jest w tle, a o jego
+    gotowości informuje funkcja zwrotna.
+
+    Atrybuty
+    --------
+    volume: Volume
+        seria, po której odbywa się nawigacja
+    index: int
+        indeks bieżącego slice'a w serii
+    cache_size: int
+        maksymalna liczba slice'ów przechowywanych w buforze
+    prefetch: int
+        liczba slice'ów wczytywanych z wyprzedzeniem w kierunku ruchu
+    compared_rtstruct: list
+        lista obiektów klasy Structure porównywanego RTStructa dopasowywana do slice'ów razem ze strukturami (lub None)
+    comparison_metric: callable
+        funkcja wyznaczająca w wątku roboczym wynik porównania dla każdego slice'a (Slice.match_comparison)
+    hits: int
+        liczba slice'ów pobranych z bufora lub z trwającego wczytywania w tle
+    misses: int
+        liczba slice'ów, na których wczytanie trzeba było czekać od początku
+    """
+
+    def __init__(self, volume, rtstruct=None, index: int = 0, cache_size: int = 32, prefetch: int = 4,
+                 workers: int = 2, match_mode: str = MATCH_UID_Z):
+        """
+        Inicjalizacja obiektu klasy SeriesNavigator
+        :param volume: obiekt klasy Volume
+        :param rtstruct: lista obiektów klasy Structure, których kontury dopasowywane są do slice'ów
+        :param index: indeks początkowego slice'a
+        :param cache_size: maksymalna liczba slice'ów przechowywanych w buforze
+        :param prefetch: liczba slice'ów wczytywanych z wyprzedzeniem w kierunku ruchu
+        :param workers: liczba wątków wczytujących slice'y w tle
+        :param match_mode: sposób dopasowywania konturów do slice'ów (Slice.match_mode)
+        """
+        self.volume = volume
+        self.rtstruct = rtstruct
+        self.match_mode = match_mode
+        self.compared_rtstruct = None
+        self.comparison_metric = None
+        self.index = index
+        self.cache_size = cache_size
+        self.prefetch = prefetch
+        self.hits = self.misses = 0
+        # Bufor zdekodowanych danych obrazowych wolumenu nie może być mniejszy niż bufor slice'ów
+        volume.max_resident_slices = max(volume.max_resident_slices, cache_size + prefetch)
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+
+    def __repr__(self):
+        return f"<volume={self.volume}, index={self.index}, cached={len(self._cache)}>"
+
+    def set_rtstruct(self, rtstruct, match_mode: str = None):
+        """Zmiana struktur dopasowywanych do slice'ów (lub sposobu dopasowania) - bufor z dopasowanymi konturami
+         jest czyszczony."""
+        with self._lock:
+            self.rtstruct = rtstruct
+            if match_mode is not None:
+                self.match_mode = match_mode
+            self._clear()
+
+    def set_comparison(self, rtstruct, metric=None):
+        """
+        Zmiana porównywanego RTStructa dopasowywanego do slice'ów w wątkach roboczych (Slice.match_comparison) - bufor
+        slice'ów jest czyszczony.
+        :param rtstruct: lista obiektów klasy Structure porównywanego RTStructa (None - bez porównania)
+        :param metric: funkcja wyznaczająca wynik porównania dla slice'a (Slice.match_comparison) - opcjonalnie
+        :return: None
+        """
+        with self._lock:
+            self.compared_rtstruct = rtstruct
+            self.comparison_metric = metric
+            self._clear()
+
+    def _clear(self):
+        self._cache.clear()
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+
+    def current(self):
+        """Zwraca bieżący slice."""
+        return self.get(self.index)
+
+    def step(self, delta: int):
+        """
+        Przejście o delta slice'ów (z ograniczeniem do zakresu serii) i uruchomienie wczytywania sąsiednich slice'ów.
+        :param delta: liczba slice'ów, o którą przesuwamy się w serii (ujemna - w kierunku mniejszych 'z')
+        :return: nowy bieżący obiekt klasy Slice
+        """
+        self.index = min(max(self.index + delta, 0), len(self.volume) - 1)
+        dicom = self.get(self.index)
+        self._schedule_prefetch(1 if delta >= 0 else -1)
+        return dicom
+
+    def step_async(self, delta: int, callback):
+        """
+        Przejście o delta slice'ów bez czekania na wczytanie slice'a spoza bufora - slice wczytywany jest w tle,
+        a po zakończeniu wczytywania wywoływana jest (w wątku roboczym) funkcja callback(indeks, future). Przy szybkim
+        przewijaniu wczytywanie slice'ów, od których się oddaliliśmy, jest anulowane (callback nie jest wtedy wywoływany).
+        :param delta: liczba slice'ów, o którą przesuwamy się w serii
+        :param callback: funkcja wywoływana z indeksem slice'a i zakończonym obiektem Future (wynik lub wyjątek)
+        :return: nowy bieżący obiekt klasy Slice, jeśli był w buforze, w przeciwnym razie None
+        """
+        self.index = min(max(self.index + delta, 0), len(self.volume) - 1)
+        index = self.index
+        with self._lock:
+            dicom = self._cache.get(index)
+            if dicom is not None:
+                self.hits += 1
+                self._cache.move_to_end(index)
+            elif index in self._pending:
+                self.hits += 1
+                future = self._pending[index]
+            else:
+                self.misses += 1
+                future = self._pending[index] = self._executor.submit(self._load, index)
+        if dicom is None:
+            future.add_done_callback(lambda done: None if done.cancelled() else callback(index, done))
+        self._schedule_prefetch(1 if delta >= 0 else -1)
+        return dicom
+
+    def get(self, index: int):
+        """
+        Zwraca slice o podanym indeksie ze zdekodowanymi danymi obrazowymi i dopasowanymi konturami - z bufora,
+        z trwającego wczytywania w tle lub wczytany na miejscu.
+        :param index: indeks slice'a w serii
+        :return: obiekt klasy Slice
+        """
+        with self._lock:
+            if index in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(index)
+                return self._cache[index]
+            future = self._pending.get(index)
+        if future is not None and not future.cancel():
+            self.hits += 1
+            return future.result()  # Slice jest właśnie wczytywany w tle - poczekaj na wynik
+        self.misses += 1
+        return self._load(index)
+
+    def close(self):
+        """Zatrzymanie wczytywania w tle."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _load(self, index):
+        rtstruct, match_mode = self.rtstruct, self.match_mode
+        compared, metric = self.compared_rtstruct, self.comparison_metric
+        dicom = self.volume.slice(index)
+        dicom.pixel_array  # Dekodowanie danych obrazowych
+        dicom.match_mode = match_mode
+        if rtstruct is not None:
+            dicom.load_RTStruct(rtstruct)
+        if compared is not None:
+            dicom.match_comparison(compared, metric)
+        dicom.build_lod()
+        with self._lock:
+            self._pending.pop(index, None)
+            # Nie zapamiętuj konturów z RTStructa podmienionego w trakcie wczytywania
+            if rtstruct is self.rtstruct and match_mode == self.match_mode and compared is self.compared_rtstruct:
+                self._cache[index] = dicom
+                self._cache.move_to_end(index)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return dicom
+
+    def _schedule_prefetch(self, direction):
+        ahead = [self.index + direction * i for i in range(1, self.prefetch + 1)]
+        behind = [self.index - direction * i for i in range(1, max(self.prefetch // 2, 1) + 1)]
+        wanted = {i for i in ahead + behind + [self.index] if 0 <= i < len(self.volume)}
+        with self._lock:
+            # Anuluj wczytywanie slice'ów, od których się oddaliliśmy (poza bieżącym)
+            for index in [i for i in self._pending if i not in wanted]:
+                if self._pending[index].cancel():
+                    del self._pending[index]
+            for index in ahead + behind:
+                if index in wanted and index not in self._cache and index not in self._pending:
+                    self._pending[index] = self._executor.submit(self._load, index)
+
+
+def window_lut(dtype, slope: float, intercept: float, center: float, width: float):
+    """
+    Tablica LUT przekształcająca wartości pikseli (o typie dtype, najwyżej 16-bitowe) bezpośrednio na kolory RGBA
+    obrazu w danym oknie wyświetlania. Tablica indeksowana jest wartościami pikseli zinterpretowanymi jako liczby
+    bez znaku (macierz.view(uint)), więc jej zastosowanie nie wymaga żadnych obliczeń na obrazie. Tablice są
+    zapamiętywane dla ostatnio używanych okien.
+    :param dtype: typ danych pikseli
+    :param slope: RescaleSlope
+    :param intercept: RescaleIntercept
+    :param center: środek okna [HU]
+    :param width: szerokość okna [HU]
+    :return: macierz (2 ** bity,) uint32 - kolor RGBA każdej wartości zapisany jako jedna liczba 32-bitowa
+    """
+    return _window_lut(np.dtype(dtype).str, float(slope), float(intercept), float(center), float(width))
+
+
+@functools.lru_cache(maxsize=32)
+def _window_lut(dtype, slope, intercept, center, width):
+    dtype = np.dtype(dtype)
+    stored = np.arange(2 ** (8 * dtype.itemsize)).astype(f"u{dtype.itemsize}").view(dtype)
+    # Kolory RGBA jako liczby 32-bitowe - odczyt z tablicy to jedna operacja take zamiast kopiowania wierszy
+    lut = DISPLAY_COLORS.view(np.uint32).ravel()[window_levels(stored * slope + intercept, center, width)]
+    lut.flags.writeable = False  # Tablica współdzielona przez wszystkie slice'y
+    return lut
+
+
+def window_levels(hu, center: float, width: float):
+    """Liniowe okno wyświetlania (DICOM PS3.3 C.11.2.1.2) - przekształcenie wartości HU na poziomy szarości 0-255."""
+    scaled = ((np.asarray(hu, dtype=np.float64) - (center - 0.5)) / max(width - 1, 1) + 0.5) * 255
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def apply_window(pixels, slope: float, intercept: float, center: float, width: float):
+    """
+    Przekształcenie obrazu na kolory RGBA w danym oknie wyświetlania - dla obrazów co najwyżej 16-bitowych jednym
+    odczytem z tablicy LUT, dla pozostałych przez przeliczenie wartości HU.
+    :return: macierz (wiersze, kolumny, 4) uint8
+    """
+    if pixels.dtype.kind in "iu" and pixels.dtype.itemsize <= 2:
+        lut = window_lut(pixels.dtype, slope, intercept, center, width)
+        rgba = np.take(lut, pixels.view(f"u{pixels.dtype.itemsize}"))
+        return rgba.view(np.uint8).reshape(pixels.shape + (4,))
+    return DISPLAY_COLORS[window_levels(pixels * slope + intercept, center, width)]
+
+
+def structure_collection(structure, lw: float = 0.5, filled: bool = False):
+    """
+    Funkcja tworząca jedną kolekcję matplotliba ze wszystkich konturów struktury (w układzie współrzędnych pikseli).
+    :param structure: obiekt klasy Structure
+    :param lw: grubość linii konturu
+    :param filled: flaga decydująca, czy tworzona jest PolyCollection z półprzezroczystym wypełnieniem
+    :return: obiekt LineCollection lub PolyCollection (jeszcze niedodany do osi)
+    """
+    rings = contour_rings(structure)
+    if filled:
+        return PolyCollection(rings, facecolors=[(*structure.color, FILL_ALPHA)], edgecolors=[structure.color],
+                              linewidths=lw)
+    return LineCollection(rings, colors=[structure.color], linewidths=lw)
+
+
+def contour_rings(structure):
+    """Lista domkniętych konturów struktury (widoki na jedną macierz punktów) - dane kolekcji matplotliba."""
+    points, offsets = close_contours(structure.points, structure.offsets)
+    return np.split(points, offsets[1:-1])
+
+
+def legend_proxy(structure, lw: float = 0.5):
+    """Pusta linia jako zastępczy obiekt legendy - wpis w legendzie wygląda tak jak w trybie RENDER_LINES."""
+    return Line2D([], [], color=structure.color, lw=lw, label=structure.name)
+
+
+def gather_contours(points, offsets, contour_ids):
+    """
+    Funkcja wybierająca z macierzy punktów kontury o podanych indeksach (bez pętli po konturach).
+    :param points: macierz punktów kolejnych konturów
+    :param offsets: indeksy początków kolejnych konturów w macierzy points (+ indeks końca ostatniego konturu)
+    :param contour_ids: indeksy wybieranych konturów
+    :return: macierz punktów wybranych konturów, offsety wybranych konturów
+    """
+    starts = offsets[contour_ids]
+    lengths = offsets[contour_ids + 1] - starts
+    new_offsets = np.zeros(len(contour_ids) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    point_ids = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return points[point_ids], new_offsets
+
+
+def close_contours(points, offsets):
+    """
+    Funkcja domykająca kontury - na końcu każdego konturu dopisywany jest jego pierwszy punkt (bez pętli po konturach).
+    :param points: macierz punktów kolejnych konturów
+    :param offsets: indeksy początków kolejnych konturów w macierzy points (+ indeks końca ostatniego konturu)
+    :return: macierz punktów domkniętych konturów, offsety domkniętych konturów
+    """
+    closed = np.insert(points, offsets[1:], points[offsets[:-1]], axis=0)
+    return closed, offsets + np.arange(len(offsets))
+
+
+def contour_importance(points, offsets):
+    """
+    Funkcja wyznaczająca ważność punktów konturów w algorytmie Douglasa-Peuckera - punkt pozostaje w konturze
+    uproszczonym z tolerancją t wtedy i tylko wtedy, gdy jego ważność jest większa od t. Pierwszy i ostatni punkt
+    konturu mają ważność nieskończoną. Algorytm przetwarza jednocześnie wszystkie odcinki wszystkich konturów na danym
+    poziomie podziału (bez rekurencji i bez pętli po konturach).
+    :param points: macierz punktów kolejnych konturów (wykorzystywane są współrzędne x, y)
+    :param offsets: indeksy początków kolejnych konturów w macierzy points (+ indeks końca ostatniego konturu)
+    :return: macierz ważności punktów
+    """
+    xy = points[:, :2]
+    importance = np.zeros(len(points))
+    first, last = offsets[:-1], offsets[1:] - 1
+    importance[first[last >= first]] = importance[last[last >= first]] = np.inf
+    # Odcinki do podziału: indeks początku, indeks końca i najmniejsza odległość podziału na drodze do odcinka
+    start, end = first, last
+    bound = np.full(len(start), np.inf)
+    while True:
+        inner = end - start - 1
+        active = inner > 0
+        start, end, bound, inner = start[active], end[active], bound[active], inner[active]
+        if len(start) == 0:
+            break
+        # Rozwinięcie odcinków do listy ich punktów wewnętrznych
+        segment_first = np.cumsum(inner) - inner
+        segment = np.repeat(np.arange(len(start)), inner)
+        index = np.repeat(start + 1 - segment_first, inner) + np.arange(segment_first[-1] + inner[-1])
+        a, ab = xy[start][segment], (xy[end] - xy[start])[segment]
+        ap = xy[index] - a
+        length = np.hypot(ab[:, 0], ab[:, 1])
+        # Odległość punktu od prostej przez końce odcinka (od początku odcinka, gdy jego końce się pokrywają)
+        distance = np.where(length > 0, np.abs(ab[:, 0] * ap[:, 1] - ab[:, 1] * ap[:, 0]) / np.maximum(length, 1e-300),
+                            np.hypot(ap[:, 0], ap[:, 1]))
+        farthest = np.maximum.reduceat(distance, segment_first)
+        candidates = np.where(distance == farthest[segment], np.arange(len(distance)), len(distance))
+        split = index[np.minimum.reduceat(candidates, segment_first)]
+
+        # Punkty leżące na prostej (odległość 0) nie są potrzebne przy żadnej tolerancji - odcinek nie jest dzielony
+        divided = farthest > 0
+        split, bound = split[divided], np.minimum(farthest, bound)[divided]
+        importance[split] = bound
+        start, end = np.concatenate([start[divided], split]), np.concatenate([split, end[divided]])
+        bound = np.concatenate([bound, bound])
+    return importance
+
+
+def select_points(points, offsets, keep):
+    """
+    Funkcja wybierająca z konturów punkty wskazane maską (bez pętli po konturach).
+    :param points: macierz punktów kolejnych konturów
+    :param offsets: indeksy początków kolejnych konturów w macierzy points (+ indeks końca ostatniego konturu)
+    :param keep: maska punktów pozostawianych w konturach
+    :return: macierz wybranych punktów, offsety konturów w tej macierzy
+    """
+    kept_before = np.concatenate([[0], np.cumsum(keep)])
+    return points[keep], kept_before[offsets]
+
+
+def plane_intersections(points, offsets, axis: str, position: float):
+    """
+    Funkcja wyznaczająca przekrój konturów (we współrzędnych pacjenta) płaszczyzną czołową lub strzałkową - przecięcia
+    wszystkich krawędzi wszystkich konturów z płaszczyzną wyznaczane są jednocześnie (bez pętli po konturach).
+    Przecięcia leżące na tej samej płaszczyźnie 'z' łączone są w odcinki regułą parzystości, więc kontury wewnętrzne
+    (dziury) dzielą odcinki przekroju.
+    :param points: macierz N x 3 punktów kolejnych konturów
+    :param offsets: indeksy początków kolejnych konturów w macierzy points (+ indeks końca ostatniego konturu)
+    :param axis: płaszczyzna przekroju (CORONAL - płaszczyzna y = position, SAGITTAL - płaszczyzna x = position)
+    :param position: położenie płaszczyzny [mm]
+    :return: macierz K x 3 odcinków przekroju (początek, koniec, 'z') - początek i koniec to współrzędne 'x'
+     (CORONAL) lub 'y' (SAGITTAL) [mm], odcinki posortowane po 'z' i po początku
+    """
+    if points is None or len(points) == 0:
+        return np.empty((0, 3))
+    across, along = (1, 0) if axis == CORONAL else (0, 1)
+    following = np.arange(1, len(points) + 1)
+    following[offsets[1:] - 1] = offsets[:-1]
+
+    # Krawędź przecina płaszczyznę, jeśli jej końce leżą po różnych stronach (reguła półotwarta - wierzchołek leżący
+    # na płaszczyźnie liczony jest raz, więc każdy kontur ma parzystą liczbę przecięć)
+    a0, a1 = points[:, across], points[following, across]
+    edges = np.nonzero((a0 > position) != (a1 > position))[0]
+    if len(edges) == 0:
+        return np.empty((0, 3))
+    t = (position - a0[edges]) / (a1[edges] - a0[edges])
+    b = points[edges, along] + t * (points[following[edges], along] - points[edges, along])
+    # 'z' konturu to 'z' jego pierwszego punktu (kontury RTStruct są płaskie)
+    contour_of_point = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    z = points[offsets[:-1], 2][contour_of_point[edges]]
+
+    order = np.lexsort((b, z))
+    b, z = b[order], z[order]
+    return np.column_stack([b[0::2], b[1::2], z[0::2]])
+
+
+# Macierz serii (zmapowany w pamięci plik), wtyczka dekodująca, ścieżki plików i flagi zdekodowanych slice'ów procesu
+# roboczego korzystającego z danych obrazowych serii (Volume.decode_all, statystyki HU struktur)
+_decode_pixels = None
+_decode_plugin = None
+_decode_paths = None
+_decode_done = None
+
+
+def init_volume_worker(pixels_path, dtype, shape, decoding_plugin, file_paths=None, decoded=None):
+    """
+    Inicjalizacja procesu roboczego korzystającego z danych obrazowych serii - zmapowanie pliku macierzy serii
+    do pamięci procesu. Argumenty zwraca metoda Volume.worker_args.
+    :param file_paths: ścieżki plików slice'ów (potrzebne funkcji worker_pixel_array)
+    :param decoded: flagi slice'ów zdekodowanych już do pliku macierzy serii
+    :return: None
+    """
+    global _decode_pixels, _decode_plugin, _decode_paths, _decode_done
+    _decode_pixels = np.memmap(pixels_path, dtype=dtype, mode="r+", shape=shape)
+    _decode_plugin = decoding_plugin
+    _decode_paths = file_paths
+    _decode_done = np.array(decoded, dtype=bool) if decoded is not None else None
+
+
+def worker_pixel_array(index: int):
+    """
+    Dane obrazowe slice'a w procesie roboczym (init_volume_worker) - odczytywane z pliku macierzy serii, a przy
+    pierwszym użyciu dekodowane do niego tą samą funkcją co w Volume.pixel_array. Proces główny powinien oznaczyć
+    slice'y zdekodowane w procesach roboczych w Volume.decoded.
+    :param index: indeks slice'a w serii
+    :return: macierz 2D z danymi obrazowymi slice'a, flaga decydująca, czy slice został zdekodowany w tym wywołaniu
+    """
+    if _decode_done[index]:
+        return _decode_pixels[index], False
+    _decode_pixels[index] = decode_pixel_data(_decode_paths[index], decoding_plugin=_decode_plugin)
+    _decode_done[index] = True
+    return _decode_pixels[index], True
+
+
+def _decode_into_file(task):
+    """
+    Dekodowanie slice'a bezpośrednio do pliku macierzy serii (wywoływane w procesie roboczym).
+    :param task: krotka (indeks slice'a, ścieżka pliku DICOM)
+    :return: indeks slice'a
+    """
+    index, path = task
+    _decode_pixels[index] = decode_pixel_data(path, decoding_plugin=_decode_plugin)
+    return index
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@profiling.timed("read_rtstruct")
+def read_rtstruct(rt_structure_filename, rois=None, streaming: bool = False):
     """
     Funkcja wczytująca plik DICOM z danymi RTStruct do postaci listy obiektów Structure wyciągniętych z pliku.
-    Przetworzenie pliku z danymi RTStruct jest czasochłonne, dlatego raz wyciągnięta z pliku lista struktur przechowywana
-    jest w słowniku globalnym loaded_RTStructs - kluczem słownika jest ścieżka pliku z danymi RTStruct.
+    Przetworzenie pliku z danymi RTStruct jest czasochłonne, dlatego w programie pliki RTStruct wczytywane są przez
+    trwały cache z modułu rtstruct_cache, który wywołuje tę funkcję tylko dla plików nieobecnych jeszcze w cache'u.
     :param rt_structure_filename: ścieżka do pliku DICOM z danymi RTStruct
+    :param rois: nazwy lub numery wczytywanych struktur (domyślnie wszystkie struktury)
+    :param streaming: flaga decydująca, czy struktury wczytywać strumieniowo - po jednej (mniejsze zużycie pamięci)
     :return: lista_struktur, nazwa_pacjenta
     """
+    # Szybkie odrzucenie pliku niebędącego RTStructem - przed wczytaniem całego pliku
+    if probe_dicom(rt_structure_filename).kind != RTSTRUCT:
+        raise NotRTStructFileException("Passed DICOM file is not RTStruct data file")
+    if streaming:
+        return _read_rtstruct_streaming(rt_structure_filename, rois)
+
     rt_structure = pydicom.dcmread(rt_structure_filename)
     structures = []
     try:
-        for roiContour, roiStructureSet in zip(rt_structure.ROIContourSequence, rt_structure.StructureSetROISequence):
+        # Nazwy struktur przypisywane są po numerach (ROINumber) - kolejność obu sekwencji nie musi być zgodna
+        names = {roi.ROINumber: roi.get("ROIName") for roi in rt_structure.StructureSetROISequence}
+        for roiContour in rt_structure.ROIContourSequence:
+            number = roiContour.ReferencedROINumber
+            if not _roi_selected(rois, names.get(number), number):
+                continue
             structure = Structure()
             try:
-                structure.name = roiStructureSet.ROIName  # Wyciągnięcie nazwy struktury (np. kości, płuco lewe itp.)
+                structure.name = names.get(number)  # Wyciągnięcie nazwy struktury (np. kości, płuco lewe itp.)
                 structure.color = roiContour.ROIDisplayColor  # Wyciągnięcie preferowanego koloru konturów struktury
                 structure.number = roiContour.ReferencedROINumber  # Wyciągnięcie numeru struktury w strukturze pliku RTStruct
 
                 """Utworzenie słownika konturów indeksowanego po współrzędnej UID odniesienia
                  {UID odniesienia: [lista wektorów punktów konturu]}."""
 
-                structure.contours = {}
+                contours = {}
                 for seq in roiContour.ContourSequence:
-                    structure.contours.setdefault(seq.ContourImageSequence[0].ReferencedSOPInstanceUID, []).append(
-                        seq.ContourData)
+                    contourData = seq.get("ContourData")
+                    if not contourData:
+                        # Obsługa przypadku, gdy w konturze brakuje danych - pomijany jest tylko ten kontur
+                        print(f"Empty contour data for {structure}", file=sys.stderr)
+                        continue
+                    contours.setdefault(_referenced_uid(seq), []).append(contourData)
+                structure.set_contours(contours)  # Jednorazowa konwersja konturów do ciągłej macierzy punktów
                 structures.append(structure)
             except AttributeError:
                 # Obsługa przypadku, gdy w strukturze brakuje danych konturowych
@@ -236,12 +1662,81 @@ def read_rtstruct(rt_structure_filename):
     except AttributeError:
         raise NotRTStructFileException("Passed DICOM file is not RTStruct data file")
 
-    # Zapamiętanie struktur z pliku w słowniku globalnym
-    loaded_RTStructs[rt_structure_filename] = structures, rt_structure.PatientName
+    return structures, rt_structure.PatientName
+
+
+def _read_rtstruct_streaming(rt_structure_filename, rois=None):
+    """
+    Strumieniowe wczytywanie pliku RTStruct. Najpierw wczytywana jest część pliku poprzedzająca sekwencję
+    ROIContourSequence (metadane i nazwy struktur), a następnie elementy sekwencji ROIContourSequence czytane są
+    z pliku pojedynczo. Wartości ContourData każdej struktury konwertowane są bezpośrednio z surowych bajtów do macierzy
+    numpy, po czym element sekwencji jest porzucany - w pamięci nigdy nie znajduje się cała sekwencja konturów.
+    :param rt_structure_filename: ścieżka do pliku DICOM z danymi RTStruct
+    :param rois: nazwy lub numery wczytywanych struktur (domyślnie wszystkie struktury)
+    :return: lista_struktur, nazwa_pacjenta
+    """
+    with open(rt_structure_filename, "rb") as f:
+        # Wczytanie pliku do początku sekwencji ROIContourSequence (strumień zatrzymuje się na jej nagłówku)
+        rt_structure = pydicom.filereader.read_partial(f, stop_when=lambda tag, vr, length: tag == ROI_CONTOUR_TAG)
+        transfer_syntax = rt_structure.file_meta.TransferSyntaxUID
+        if transfer_syntax.is_deflated:  # Skompresowanego zbioru danych nie da się czytać strumieniowo
+            return read_rtstruct(rt_structure_filename, rois)
+        implicit, little = transfer_syntax.is_implicit_VR, transfer_syntax.is_little_endian
+        encoding = pydicom.charset.convert_encodings(rt_structure.get("SpecificCharacterSet", "ISO_IR 6"))
+
+        names = {roi.ROINumber: roi.get("ROIName") for roi in rt_structure.get("StructureSetROISequence", [])}
+        endian = "<" if little else ">"
+        header = f.read(8)
+        if len(header) < 8 or struct.unpack(endian + "HH", header[:4]) != (0x3006, 0x0039):
+            raise NotRTStructFileException("Passed DICOM file is not RTStruct data file")
+        length = struct.unpack(endian + "L", header[4:] if implicit else f.read(4))[0]
+        end = None if length == 0xFFFFFFFF else f.tell() + length
+
+        structures = []
+        while end is None or f.tell() < end:
+            roiContour = pydicom.filereader.read_sequence_item(f, implicit, little, encoding)
+            if roiContour is None:  # Znacznik końca sekwencji o niezdefiniowanej długości
+                break
+            number = roiContour.get("ReferencedROINumber")
+            if number is None or not _roi_selected(rois, names.get(number), number):
+                continue
+            structure = Structure(names.get(number), roiContour.get("ROIDisplayColor"), number)
+            if structure.color is None or "ContourSequence" not in roiContour:
+                # Obsługa przypadku, gdy w strukturze brakuje danych konturowych
+                print(f"Empty data for {structure}", file=sys.stderr)
+                continue
+
+            contours = {}
+            for seq in roiContour.ContourSequence:
+                # Surowe bajty ContourData ('x\\y\\z\\...') parsowane są bezpośrednio przez numpy
+                element = seq.get_item(CONTOUR_DATA_TAG)
+                if element is None or not element.value:
+                    # Obsługa przypadku, gdy w konturze brakuje danych - pomijany jest tylko ten kontur
+                    print(f"Empty contour data for {structure}", file=sys.stderr)
+                    continue
+                raw = element.value
+                contours.setdefault(_referenced_uid(seq), []).append(
+                    np.fromstring(raw.decode("ascii"), dtype=np.float64, sep="\\"))
+            structure.set_contours(contours)
+            structures.append(structure)
+            del roiContour, contours  # Element sekwencji nie jest już potrzebny
 
     return structures, rt_structure.PatientName
 
 
+def _referenced_uid(contour):
+    """UID odniesienia konturu - kontury bez ContourImageSequence (pusty UID) można dopasować do slice'a tylko po 'z'."""
+    imageSequence = contour.get("ContourImageSequence")
+    return imageSequence[0].ReferencedSOPInstanceUID if imageSequence else ""
+
+
+def _roi_selected(rois, name, number):
+    """Sprawdzenie, czy struktura o podanej nazwie i numerze należy do wybranych struktur rois."""
+    if rois is None:
+        return True
+    return name in rois or str(number) in {str(roi) for roi in rois}
+
+
 if __name__ == "__main__":
     read_rtstruct(
         pydicom.read_file(r"Temat6/Pediatric-CT-SEG-02AC04B6/09-21-2005-NA-CT-35474/2.000000-RTSTRUCT-86390/1-1.dcm"))